@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+# part of OnyxBackupVM
+# Copyright (c) 2017-2020 OnyxFire, Inc.
+	
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# End-to-end benchmark of OnyxBackupVM against a simulated pool (see
+# simulator.py and xe in this directory). For each pool size it times VM list
+# processing, vm-exports, vdi-exports, and host backups of a few VMs/hosts and
+# rotation of their backup history, reporting wall time, XenAPI calls, xe
+# commands run, and export throughput. Exports failing part way are run as
+# well and must be reported as errors without keeping any backup file.
+# Requires the XenAPI python module
+#
+# usage: python benchmarks/backups.py [--vms 10,1000,10000] [--latency 0.001] [--json results.json]
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from contextlib import contextmanager
+from os.path import abspath, dirname, join
+from time import time
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+import onyxbackup.data as data
+import onyxbackup.service as service
+from simulator import SimulatedPool, SimulatorServer
+
+BENCH_DIR = dirname(abspath(__file__))
+
+def make_config(backup_dir, args):
+	return {
+		'backend': args.backend, 'backup_dir': backup_dir, 'store_type': 'file', 'space_threshold': 1,
+		'max_backups': args.max_backups, 'keep_daily': 0, 'keep_weekly': 0, 'keep_monthly': 0, 'delete_interval': 0,
+		'compress': False, 'compress_type': 'gzip', 'compress_level': 6, 'compress_workers': 2,
+		'vdi_export_format': 'raw', 'vdi_sparse': True, 'vdi_resume': False,
+		'vdi_resume_retries': 3, 'vdi_resume_segment': 256, 'checksum': bool(args.checksum),
+		'checksum_type': args.checksum or 'sha256',
+		'checksum_block_size': 64, 'checksum_sha256': False, 'xva_index': True, 'cbt_enabled': False, 'cbt_full_interval': 6,
+		'max_parallel_exports': args.parallel, 'max_parallel_disks': 2, 'teardown_workers': 2, 'export_buffer_size': 4, 'export_buffers': 2,
+		'verify_workers': 4, 'verify_io_limit': 2, 'verify_threads': 2, 'metrics_dir': '',
+		'progress_interval': 60, 'status_file': '',
+		'vm_exports': ['.*'], 'vdi_exports': [], 'excludes': ['vm00000', 'test-.*']}
+
+def count_lines(file):
+	if not os.path.exists(file):
+		return 0
+	with open(file) as f:
+		return sum(1 for line in f)
+
+def get_size(path):
+	size = 0
+	for root, dirs, files in os.walk(path):
+		size += sum(os.path.getsize(join(root, file)) for file in files)
+	return size
+
+def list_files(path):
+	return set(join(root, file) for root, dirs, files in os.walk(path) for file in files)
+
+def measure(name, vm_count, pool, backup_dir, xe_log, func, verbose=False):
+	"""
+		Run func and collect wall time, simulator call counts, xe commands
+		run, and bytes written to backup_dir during it
+	"""
+	pool.reset_stats()
+	xe_before = count_lines(xe_log)
+	size_before = get_size(backup_dir)
+	with quiet(verbose):
+		start = time()
+		errors = func() or 0
+		elapsed = time() - start
+	stats = pool.get_stats()
+	written = max(0, get_size(backup_dir) - size_before)
+	return {'scenario': name, 'vms': vm_count, 'seconds': elapsed, 'calls': stats['calls'], 'logins': stats['logins'],
+		'xe': count_lines(xe_log) - xe_before, 'bytes': written, 'errors': errors,
+		'mb_per_second': written / 1048576.0 / elapsed if elapsed else 0}
+
+@contextmanager
+def quiet(verbose=False):
+	"""
+		Hide output OnyxBackupVM prints unless verbose
+	"""
+	if verbose:
+		yield
+		return
+	stdout = sys.stdout
+	sys.stdout = open(os.devnull, 'w')
+	try:
+		yield
+	finally:
+		sys.stdout.close()
+		sys.stdout = stdout
+
+def run_pool(vm_count, args):
+	results = []
+	pool = SimulatedPool(vm_count, args.disks, args.hosts, args.disk_size * 1048576, args.data_fraction, args.latency)
+	server = SimulatorServer(pool).start()
+	work_dir = tempfile.mkdtemp(prefix='onyxbackup-bench-')
+	xe_log = join(work_dir, 'xe.log')
+	os.environ['SIM_XE_LOG'] = xe_log
+	os.environ['SIM_XE_LATENCY'] = str(args.xe_latency)
+	os.environ['SIM_XE_HOSTS'] = str(args.hosts)
+	os.environ['SIM_XE_EXPORT_SIZE'] = str(args.disk_size * 1048576)
+	backup_dir = join(work_dir, 'exports')
+	os.mkdir(backup_dir)
+	svc = service.XenApiService(make_config(backup_dir, args), data.XenRemote('root', '', server.url), BENCH_DIR)
+	try:
+		results.append(measure('process_vm_lists', vm_count, pool, backup_dir, xe_log, svc.process_vm_lists, args.verbose))
+		vms = [vm for vm in svc.config['vm_exports']]
+		svc.config['vm_exports'] = vms[:args.backups]
+		svc.config['vdi_exports'] = vms[args.backups:args.backups * 2]
+
+		def run(function):
+			def run_function():
+				function()
+				if svc._teardown is not None:
+					svc._teardown.finish()
+				return svc.status['error']
+			return run_function
+		results.append(measure('backup_vm', vm_count, pool, backup_dir, xe_log, run(svc.backup_vm), args.verbose))
+		results.append(measure('backup_vdi', vm_count, pool, backup_dir, xe_log, run(svc.backup_vdi), args.verbose))
+		results.append(measure('backup_hosts', vm_count, pool, backup_dir, xe_log, run(svc.backup_hosts), args.verbose))
+
+		def fail_exports():
+			pool.fail_exports = 0.375
+			files = list_files(backup_dir)
+			errors = 0
+			try:
+				for function in [svc.backup_vm, svc.backup_vdi]:
+					errors += run(function)()
+			finally:
+				pool.fail_exports = None
+			jobs = len(svc.config['vm_exports']) + len(svc.config['vdi_exports'])
+			kept = sorted(file for file in list_files(backup_dir) - files if file.endswith(('.xva', '.raw', '.meta')))
+			if kept or errors != jobs:
+				raise RuntimeError('Failed exports not reported: {} errors for {} jobs, kept {}'.format(errors, jobs, kept))
+			return errors
+		if args.backend == 'xenapi':
+			results.append(measure('failed_exports', vm_count, pool, backup_dir, xe_log, fail_exports, args.verbose))
+
+		def rotate():
+			retention = svc._get_retention()
+			for vm in vms[:args.backups]:
+				path = join(backup_dir, vm)
+				for i in range(args.history):
+					base = join(path, 'backup_20200101-{:06d}'.format(i))
+					for file in [base + '.xva', base + '.meta']:
+						open(file, 'w').close()
+					svc._catalog.add_backup(base + '.xva', base + '.meta', 'vm')
+			for vm in vms[:args.backups]:
+				svc._rotate_backups(retention, join(backup_dir, vm))
+			svc._deleter.finish()
+			return 0
+		results.append(measure('rotate_backups', vm_count, pool, backup_dir, xe_log, rotate, args.verbose))
+	finally:
+		with quiet(args.verbose):
+			svc.close()
+		server.stop()
+		if not args.keep:
+			shutil.rmtree(work_dir, True)
+	return results
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark OnyxBackupVM against a simulated pool')
+	parser.add_argument('--vms', default='10,1000,10000', help='Comma separated pool sizes')
+	parser.add_argument('--disks', type=int, default=1, help='Disks per VM')
+	parser.add_argument('--hosts', type=int, default=2, help='Hosts in the pool')
+	parser.add_argument('--disk-size', type=int, default=8, help='Size of each disk in MB')
+	parser.add_argument('--data-fraction', type=float, default=0.5, help='Fraction of each disk holding data')
+	parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to each XenAPI call')
+	parser.add_argument('--xe-latency', type=float, default=0.0, help='Seconds added to each xe command')
+	parser.add_argument('--backend', default='xenapi', choices=['xe', 'xenapi'], help='Backend to benchmark')
+	parser.add_argument('--parallel', type=int, default=1, help='max_parallel_exports')
+	parser.add_argument('--checksum', default='', choices=['', 'xxh3', 'blake3', 'sha256'],
+		help='checksum_type to hash xenapi exports with')
+	parser.add_argument('--backups', type=int, default=5, help='VMs backed up with each of vm-export and vdi-export')
+	parser.add_argument('--history', type=int, default=50, help='Old backups per VM rotated by rotate_backups')
+	parser.add_argument('--max-backups', type=int, default=4, help='max_backups')
+	parser.add_argument('--json', metavar='FILE', help='Write results to FILE as JSON')
+	parser.add_argument('--keep', action='store_true', help='Keep the temporary backup directory')
+	parser.add_argument('--verbose', action='store_true', help='Show OnyxBackupVM output')
+	args = parser.parse_args()
+
+	logging.basicConfig(format='%(message)s')
+	logging.getLogger('onyxbackup').setLevel(logging.INFO if args.verbose else logging.ERROR)
+
+	results = []
+	print('{:<17} {:>6} {:>9} {:>8} {:>7} {:>6} {:>9} {:>8} {:>7}'.format(
+		'scenario', 'vms', 'wall (s)', 'calls', 'logins', 'xe', 'MB', 'MB/s', 'errors'))
+	sys.stdout.flush()
+	for vm_count in [int(count) for count in args.vms.split(',')]:
+		for result in run_pool(vm_count, args):
+			results.append(result)
+			print('{scenario:<17} {vms:>6} {seconds:>9.3f} {calls:>8} {logins:>7} {xe:>6} {0:>9.1f} {mb_per_second:>8.1f} {errors:>7}'.format(
+				result['bytes'] / 1048576.0, **result))
+			sys.stdout.flush()
+	if args.json:
+		with open(args.json, 'w') as f:
+			json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,444 @@
+#!/usr/bin/env python
+
+# part of OnyxBackupVM
+# Copyright (c) 2017-2020 OnyxFire, Inc.
+	
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Simulated pool for benchmarking OnyxBackupVM without a real pool. Serves the
+# XenAPI calls OnyxBackupVM makes over XML-RPC and synthetic exports from the
+# xapi HTTP handlers (/export, /export_raw_vdi, /pool/xmldbdump) on one port,
+# so a XenRemote data API pointed at http://127.0.0.1:<port> talks to it like
+# a pool master. See benchmarks/xe for the matching fake xe command
+#
+# usage: python benchmarks/simulator.py [--vms 100] [--disks 1] [--latency 0.001]
+
+import argparse
+import os
+import re
+import socket
+import tarfile
+import threading
+import xmlrpclib
+from base64 import b64encode
+from hashlib import sha1
+from BaseHTTPServer import HTTPServer
+from SimpleXMLRPCServer import SimpleXMLRPCDispatcher, SimpleXMLRPCRequestHandler
+from SocketServer import ThreadingMixIn
+from time import sleep
+from urlparse import parse_qs, urlparse
+
+class SimulatedPool(object):
+	"""
+		In-memory pool of VMs with disks answering XenAPI calls. Each disk
+		has disk_size bytes of which data_fraction hold data, and every
+		call waits latency seconds like a round trip to a pool master. VM
+		exports are XVA archives of the data of their disks. With
+		fail_exports set, exports end after that fraction of their data
+		and their task fails like a failed export on xapi
+	"""
+
+	block_size = 1048576
+
+	def __init__(self, vms=10, disks=1, hosts=1, disk_size=4194304, data_fraction=0.5, latency=0.0):
+		self.disk_size = disk_size
+		self.data_fraction = data_fraction
+		self.latency = latency
+		self.fail_exports = None
+		self.stats = {'logins': 0, 'calls': 0, 'exports': 0, 'export_bytes': 0}
+		self._lock = threading.Lock()
+		self._next_ref = 0
+		self._sessions = set()
+		self._records = dict((cls, {}) for cls in ['pool', 'host', 'SR', 'network', 'VM', 'VBD', 'VDI', 'VIF', 'VM_guest_metrics', 'task'])
+		self._data_block = os.urandom(self.block_size)
+		self._zero_block = '\0' * self.block_size
+		self._create_pool(vms, disks, hosts)
+
+	def dispatch(self, method, params):
+		"""
+			Run XenAPI method with the given parameters
+
+			@return XenAPI result struct
+		"""
+		if self.latency:
+			sleep(self.latency)
+		with self._lock:
+			self.stats['calls'] += 1
+			if method == 'session.login_with_password':
+				self.stats['logins'] += 1
+				session = self._new_ref('session')
+				self._sessions.add(session)
+				return self._success(session)
+			if not params or params[0] not in self._sessions:
+				return self._failure('SESSION_INVALID', params[0] if params else '')
+			if method == 'session.logout':
+				self._sessions.discard(params[0])
+				return self._success('')
+			try:
+				return self._success(self._call(method, list(params[1:])))
+			except KeyError as e:
+				return self._failure('HANDLE_INVALID', method, str(e))
+			except (ValueError, IndexError) as e:
+				return self._failure('MESSAGE_PARAMETER_COUNT_MISMATCH', method, str(e))
+
+	def export(self, path, params):
+		"""
+			Get size and generator of the data of an HTTP export
+
+			@return Tuple of size and generator of blocks or None
+		"""
+		if self.latency:
+			sleep(self.latency)
+		with self._lock:
+			if params.get('session_id') not in self._sessions:
+				return None
+			if path == '/export':
+				vm = self._get_by_uuid('VM', params.get('uuid'))
+				vbds = [self._records['VBD'][vbd] for vbd in self._records['VM'][vm]['VBDs']]
+				members = self._get_xva_members(vm, vbds)
+				size = sum(len(member[0]) + member[2] for member in members) + tarfile.BLOCKSIZE * 2
+				self.stats['exports'] += 1
+				self.stats['export_bytes'] += size
+				return (size, self._generate_xva(members, size, params.get('task_id')))
+			elif path == '/export_raw_vdi':
+				vdi = self._records['VDI'][self._get_by_uuid('VDI', params.get('vdi'))]
+				if params.get('format') == 'vhd':
+					size = int(vdi['physical_utilisation'])
+					data_fraction = 1.0
+				else:
+					size = int(vdi['virtual_size'])
+					data_fraction = self.data_fraction
+			elif path == '/pool/xmldbdump':
+				size = 1024 * len(self._records['VM'])
+				data_fraction = 1.0
+			else:
+				return None
+			self.stats['exports'] += 1
+			self.stats['export_bytes'] += size
+		return (size, self._generate(size, data_fraction, params.get('task_id')))
+
+	def get_stats(self):
+		with self._lock:
+			return dict(self.stats)
+
+	def reset_stats(self):
+		with self._lock:
+			for key in self.stats:
+				self.stats[key] = 0
+
+	# Private Functions
+
+	def _add(self, cls, record, name=None):
+		ref = self._new_ref(name or cls)
+		record.setdefault('uuid', '{}-{}'.format(cls.lower(), ref.split(':')[1]))
+		self._records[cls][ref] = record
+		return ref
+
+	def _add_disk(self, vm, device, virtual_size, physical_utilisation, sr, snapshot_of='OpaqueRef:NULL'):
+		vdi = self._add('VDI', {'name_label': '{} {}'.format(self._records['VM'][vm]['name_label'], device),
+			'name_description': '', 'virtual_size': str(virtual_size), 'physical_utilisation': str(physical_utilisation),
+			'type': 'user', 'sharable': False, 'read_only': False, 'SR': sr, 'VBDs': [],
+			'is_a_snapshot': snapshot_of != 'OpaqueRef:NULL', 'snapshot_of': snapshot_of, 'cbt_enabled': False})
+		vbd = self._add('VBD', {'VM': vm, 'VDI': vdi, 'device': device, 'userdevice': device[-1:],
+			'bootable': device == 'xvda', 'mode': 'RW', 'type': 'Disk', 'unpluggable': False, 'empty': False})
+		self._records['VDI'][vdi]['VBDs'].append(vbd)
+		self._records['VM'][vm]['VBDs'].append(vbd)
+		return vdi
+
+	def _call(self, method, args):
+		cls, name = method.split('.', 1)
+		records = self._records[cls]
+		if name == 'get_all':
+			return records.keys()
+		elif name == 'get_all_records':
+			return records
+		elif name == 'get_record':
+			return records[args[0]]
+		elif name == 'get_by_uuid':
+			return self._get_by_uuid(cls, args[0])
+		elif name == 'get_all_records_where':
+			# Only conditions of the form field "name" = "value" joined by and
+			conditions = re.findall(r'field "(\w+)" = "([^"]*)"', args[0])
+			return dict((ref, record) for ref, record in records.items() if all(
+				str(record.get(field.replace('__', '_'))).lower() == value.lower() for field, value in conditions))
+		elif name == 'get_by_name_label':
+			return [ref for ref, record in records.items() if record.get('name_label') == args[0]]
+		elif name == 'get_API_version_major':
+			return '2'
+		elif name == 'get_API_version_minor':
+			return '16'
+		elif name == 'get_master':
+			return records[args[0]]['master']
+		elif name in ['snapshot', 'snapshot_with_quiesce']:
+			return self._snapshot(cls, args[0], args[1] if cls == 'VM' else 'snapshot')
+		elif name == 'create' and cls == 'task':
+			return self._add('task', {'name_label': args[0], 'name_description': args[1], 'status': 'pending', 'progress': 0.0, 'error_info': []})
+		elif name == 'destroy':
+			return self._destroy(cls, args[0])
+		elif name == 'enable_cbt':
+			records[args[0]]['cbt_enabled'] = True
+			return ''
+		elif name == 'data_destroy':
+			records[args[0]]['type'] = 'cbt_metadata'
+			return ''
+		elif name == 'list_changed_blocks':
+			blocks = int(records[args[1]]['virtual_size']) / 65536
+			changed = ''.join(chr(0xff if i % 10 == 0 else 0) for i in range((blocks + 7) / 8))
+			return b64encode(changed)
+		elif name == 'get_nbd_info':
+			return []
+		elif name.startswith('get_'):
+			return records[args[0]][name[4:]]
+		elif name.startswith('set_'):
+			records[args[0]][name[4:]] = args[1]
+			return ''
+		raise KeyError(method)
+
+	def _create_pool(self, vms, disks, hosts):
+		host_refs = [self._add('host', {'hostname': 'host{:02d}'.format(i), 'name_label': 'host{:02d}'.format(i),
+			'address': '127.0.0.1'}) for i in range(hosts)]
+		self._add('pool', {'name_label': 'simulated', 'master': host_refs[0]})
+		sr = self._add('SR', {'name_label': 'Local storage', 'type': 'ext'})
+		network = self._add('network', {'name_label': 'Pool-wide network'})
+		size = self.disk_size
+		used = int(size * self.data_fraction)
+		for i in range(vms):
+			metrics = self._add('VM_guest_metrics', {'os_version': {'name': 'Debian GNU/Linux 10|/dev/xvda1'}})
+			vm = self._add('VM', {'name_label': 'vm{:05d}'.format(i), 'name_description': '', 'memory_dynamic_max': '1073741824',
+				'VCPUs_max': '2', 'VCPUs_at_startup': '2', 'other_config': {}, 'VBDs': [], 'VIFs': [],
+				'is_a_template': False, 'is_a_snapshot': False, 'is_control_domain': False, 'snapshot_of': 'OpaqueRef:NULL',
+				'guest_metrics': metrics, 'allowed_operations': ['snapshot', 'export'], 'ha_always_run': False})
+			for disk in range(disks):
+				self._add_disk(vm, 'xvd{}'.format(chr(ord('a') + disk)), size, used, sr)
+			vif = self._add('VIF', {'device': '0', 'network': network, 'MTU': '1500',
+				'MAC': '02:00:00:{:02x}:{:02x}:{:02x}'.format(i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff), 'other_config': {}})
+			self._records['VM'][vm]['VIFs'].append(vif)
+
+	def _destroy(self, cls, ref):
+		record = self._records[cls].pop(ref)
+		if cls == 'VM':
+			for vbd in record['VBDs']:
+				self._records['VBD'].pop(vbd, None)
+		return ''
+
+	def _export_failed(self, task, sent, size):
+		"""
+			Fail the task of an export that has sent fail_exports of its size
+
+			@return True if the export failed
+		"""
+		if self.fail_exports is None or sent < size * self.fail_exports:
+			return False
+		with self._lock:
+			if task in self._records['task']:
+				self._records['task'][task].update(status='failure', error_info=['INTERNAL_ERROR', 'export failed'])
+		return True
+
+	def _failure(self, *details):
+		return {'Status': 'Failure', 'ErrorDescription': [str(detail) for detail in details]}
+
+	def _generate(self, size, data_fraction, task=None):
+		"""
+			Generate size bytes in blocks where data_fraction of the blocks
+			hold data and the rest are zeroes updating the progress of the
+			given task like xapi does
+		"""
+		sent = 0
+		block = 0
+		while sent < size:
+			if self._export_failed(task, sent, size):
+				return
+			length = min(self.block_size, size - sent)
+			if int((block + 1) * data_fraction) > int(block * data_fraction):
+				yield self._data_block[:length]
+			else:
+				yield self._zero_block[:length]
+			sent += length
+			block += 1
+			self._set_task_progress(task, float(sent) / size)
+		self._set_task_progress(task, 1.0, 'success')
+
+	def _generate_xva(self, members, size, task=None):
+		"""
+			Generate an XVA from the given tar members where disk chunks hold
+			data blocks
+		"""
+		sent = 0
+		for header, data_size, padded_size, data in members:
+			if self._export_failed(task, sent, size):
+				return
+			if data is None:
+				data = self._data_block[:data_size]
+			yield header + data + '\0' * (padded_size - data_size)
+			sent += len(header) + padded_size
+			self._set_task_progress(task, float(sent) / size)
+		yield '\0' * tarfile.BLOCKSIZE * 2
+		self._set_task_progress(task, 1.0, 'success')
+
+	def _get_by_uuid(self, cls, uuid):
+		for ref, record in self._records[cls].items():
+			if record['uuid'] == uuid:
+				return ref
+		raise KeyError(uuid)
+
+	def _get_xva_members(self, vm, vbds):
+		"""
+			Get (header, data size, padded size, data) of the tar members of
+			an XVA of the VM with the given VBD records: ova.xml listing the
+			VM, its VBDs, and their disks, followed by the chunks of block_size of each
+			disk holding data named Ref:<VDI>/<chunk> with the SHA-1 of each
+			chunk in a <chunk>.checksum member after it as xapi writes them.
+			Like xapi the last chunk of a disk is always written so the size
+			of the disk is known. Data of disk chunks is None
+		"""
+		objects = [{'class': 'VM', 'id': 'Ref:{}'.format(vm.split(':', 1)[1]),
+			'snapshot': {'name_label': self._records['VM'][vm]['name_label']}}]
+		vdis = [self._records['VDI'][vbd['VDI']] for vbd in vbds]
+		for vbd, vdi in zip(vbds, vdis):
+			objects.append({'class': 'VBD', 'id': 'Ref:{}'.format(vbd['uuid']),
+				'snapshot': {'VDI': 'Ref:{}'.format(vdi['uuid']), 'device': vbd['device'], 'userdevice': vbd['userdevice']}})
+			objects.append({'class': 'VDI', 'id': 'Ref:{}'.format(vdi['uuid']),
+				'snapshot': {'name_label': vdi['name_label'], 'virtual_size': vdi['virtual_size']}})
+		ova_xml = xmlrpclib.dumps(({'version': {'xapi_major': '1', 'xapi_minor': '1'}, 'objects': objects},))
+		ova_xml = ova_xml[ova_xml.index('<value>'):ova_xml.rindex('</value>') + len('</value>')]
+		members = [('ova.xml', len(ova_xml), ova_xml)]
+		for vdi in vdis:
+			size = int(vdi['virtual_size'])
+			last = (size - 1) // self.block_size
+			chunks = range(min((int(vdi['physical_utilisation']) + self.block_size - 1) // self.block_size, last))
+			for chunk in chunks + [last]:
+				name = 'Ref:{}/{:08d}'.format(vdi['uuid'], chunk)
+				length = min(self.block_size, size - chunk * self.block_size)
+				data = self._data_block[:length] if chunk < last else self._zero_block[:length]
+				members.append((name, length, None if chunk < last else data))
+				members.append(('{}.checksum'.format(name), 40, sha1(data).hexdigest()))
+		result = []
+		for name, data_size, data in members:
+			info = tarfile.TarInfo(name)
+			info.size = data_size
+			result.append((info.tobuf(tarfile.USTAR_FORMAT), data_size,
+				(data_size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE, data))
+		return result
+
+	def _new_ref(self, name):
+		self._next_ref += 1
+		return 'OpaqueRef:{}-{}'.format(name.lower(), self._next_ref)
+
+	def _set_task_progress(self, task, progress, status='pending'):
+		with self._lock:
+			if task in self._records['task']:
+				self._records['task'][task].update(progress=progress, status=status)
+
+	def _snapshot(self, cls, ref, name):
+		record = self._records[cls][ref]
+		snap_record = dict(record, VBDs=[], is_a_snapshot=True, snapshot_of=ref)
+		del snap_record['uuid']
+		if cls == 'VDI':
+			return self._add('VDI', snap_record)
+		snap = self._add('VM', dict(snap_record, name_label=name, VIFs=[]))
+		for vbd in record['VBDs']:
+			vbd_record = self._records['VBD'][vbd]
+			vdi = self._records['VDI'][vbd_record['VDI']]
+			self._add_disk(snap, vbd_record['device'], vdi['virtual_size'], vdi['physical_utilisation'], vdi['SR'], vbd_record['VDI'])
+		return snap
+
+	def _success(self, value):
+		return {'Status': 'Success', 'Value': value}
+
+class SimulatorServer(ThreadingMixIn, HTTPServer, SimpleXMLRPCDispatcher):
+	"""
+		Threaded HTTP server answering XML-RPC requests and export GET
+		requests for the given SimulatedPool
+	"""
+
+	daemon_threads = True
+	allow_reuse_address = True
+	logRequests = False
+
+	def __init__(self, pool, address=('127.0.0.1', 0)):
+		self.pool = pool
+		SimpleXMLRPCDispatcher.__init__(self, allow_none=True, encoding=None)
+		HTTPServer.__init__(self, address, SimulatorRequestHandler)
+		self._thread = None
+
+	@property
+	def url(self):
+		return 'http://{}:{}'.format(*self.server_address)
+
+	def start(self):
+		self._thread = threading.Thread(target=self.serve_forever, name='simulator')
+		self._thread.daemon = True
+		self._thread.start()
+		return self
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+	def _dispatch(self, method, params):
+		return self.pool.dispatch(method, params)
+
+class SimulatorRequestHandler(SimpleXMLRPCRequestHandler):
+
+	rpc_paths = ()
+
+	def do_GET(self):
+		url = urlparse(self.path)
+		params = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+		try:
+			export = self.server.pool.export(url.path, params)
+		except KeyError:
+			export = None
+		if export is None:
+			self.send_error(404)
+			return
+		blocks = export[1]
+		# Like xapi no Content-Length is sent and the connection is closed
+		# at the end of the export, whether it succeeded or not
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/octet-stream')
+		self.end_headers()
+		try:
+			for block in blocks:
+				self.wfile.write(block)
+		except socket.error:
+			pass
+
+	def log_message(self, format, *args):
+		pass
+
+def main():
+	parser = argparse.ArgumentParser(description='Run a simulated pool serving XenAPI and exports')
+	parser.add_argument('--vms', type=int, default=100, help='Number of VMs')
+	parser.add_argument('--disks', type=int, default=1, help='Disks per VM')
+	parser.add_argument('--hosts', type=int, default=1, help='Number of hosts')
+	parser.add_argument('--disk-size', type=int, default=4, help='Size of each disk in MB')
+	parser.add_argument('--data-fraction', type=float, default=0.5, help='Fraction of each disk holding data')
+	parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to each call')
+	parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+	args = parser.parse_args()
+
+	pool = SimulatedPool(args.vms, args.disks, args.hosts, args.disk_size * 1048576, args.data_fraction, args.latency)
+	server = SimulatorServer(pool, ('127.0.0.1', args.port))
+	print('Simulated pool of {} VMs listening on {}'.format(args.vms, server.url))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		server.server_close()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+# part of OnyxBackupVM
+# Copyright (c) 2017-2020 OnyxFire, Inc.
+	
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark matching vm_exports/vdi_exports/excludes patterns against the VMs
+# of a pool with NameMatcher compared to checking every pattern against every
+# VM as _validate_vm_lists used to
+#
+# usage: python benchmarks/vm_lists.py [--vms 100,1000,8000] [--patterns 10,100,1000]
+
+import argparse
+import random
+import re
+import sys
+from os.path import abspath, dirname
+from time import time
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from onyxbackup.util import NameMatcher
+
+def make_vms(count):
+	tenants = ['tenant{:03d}'.format(i) for i in range(max(1, count / 50))]
+	return ['{}-{}-{:05d}'.format(random.choice(tenants), random.choice(['web', 'db', 'app']), i) for i in range(count)]
+
+def make_patterns(count, vms):
+	patterns = []
+	for i in range(count):
+		vm = random.choice(vms)
+		if i % 2:
+			patterns.append('{}-{}.*'.format(vm.split('-')[0], random.choice(['web', 'db', 'app'])))
+		else:
+			patterns.append(vm.replace('-', '_'))
+	return patterns
+
+def match_loop(patterns, vms):
+	"""
+		Previous matching of each pattern against each VM
+	"""
+	matched = []
+	vm_matched = []
+	for pattern in patterns:
+		for vm in vms:
+			if ((re.match('^[\w\s]+$', pattern) is not None and pattern == vm) or
+					(re.match('^[\w\s]+$', pattern) is None and re.match(pattern, vm))):
+				if not vm in vm_matched:
+					matched.append(vm)
+				vm_matched.append(vm)
+	return sorted(matched)
+
+def match_compiled(patterns, vms):
+	matcher = NameMatcher(patterns)
+	return sorted(vm for vm in vms if matcher.match(vm) is not None)
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark VM list matching')
+	parser.add_argument('--vms', default='100,1000,8000', help='Comma separated VM counts')
+	parser.add_argument('--patterns', default='10,100,1000', help='Comma separated pattern counts')
+	parser.add_argument('--skip-loop', action='store_true', help='Only time NameMatcher')
+	args = parser.parse_args()
+
+	random.seed(0)
+	print('{:>8} {:>9} {:>10} {:>10} {:>8}'.format('vms', 'patterns', 'loop (s)', 'matcher (s)', 'matched'))
+	for vm_count in [int(count) for count in args.vms.split(',')]:
+		vms = make_vms(vm_count)
+		for pattern_count in [int(count) for count in args.patterns.split(',')]:
+			patterns = make_patterns(pattern_count, vms)
+			start = time()
+			matched = match_compiled(patterns, vms)
+			compiled = time() - start
+			loop = '-'
+			if not args.skip_loop:
+				start = time()
+				if match_loop(patterns, vms) != matched:
+					raise RuntimeError('Matches differ for {} VMs and {} patterns'.format(vm_count, pattern_count))
+				loop = '{:.3f}'.format(time() - start)
+			print('{:>8} {:>9} {:>10} {:>10.3f} {:>8}'.format(vm_count, pattern_count, loop, compiled, len(matched)))
+
+if __name__ == '__main__':
+	main()
@@ -40,6 +40,7 @@ class Cli(object):
 	# API Functions
 
 	def run(self):
+		xenService = None
 		try:
 			xenService = service.XenApiService(self.config)
 			server_name = self._get_server_name()
@@ -47,11 +48,50 @@ class Cli(object):
 			self.logger.info('{} running on {}'.format(self.program_name, server_name))
 			self.logger.info('Started: {}'.format(self._h.get_date_string_print()))
 			self.logger.info('-----------------------------------------------------')
+			if self.config['restore']:
+				xenService.restore_backup(self.config['restore'], self.config['output'])
+				xenService.close()
+				self._end_run()
+				exit(0)
+
+			if self.config['extract']:
+				extracted = xenService.extract_backup(self.config['extract'], self.config['disk'], self.config['output'])
+				xenService.close()
+				self._end_run()
+				exit(0 if extracted else 1)
+
+			if self.config['rebuild_store']:
+				xenService.rebuild_store()
+				xenService.close()
+				self._end_run()
+				exit(0)
+
+			if self.config['rebuild_catalog']:
+				xenService.rebuild_catalog()
+				xenService.close()
+				self._end_run()
+				exit(0)
+
+			if self.config['list_backups']:
+				xenService.list_backups()
+				xenService.close()
+				self._end_run()
+				exit(0)
+
+			if self.config['verify']:
+				verified = xenService.verify_backups()
+				xenService.close()
+				self._end_run()
+				if self.config['smtp_enabled']:
+					xenService.send_email()
+				exit(0 if verified else 1)
+
 			self.logger.debug('(i) Processing VM lists')
 			xenService.process_vm_lists()
 
 			if self.config['preview']:
 				self._print_config()
+				xenService.close()
 				self._end_run()
 				exit(0)
 
@@ -67,6 +107,7 @@ class Cli(object):
 			if self.config['vm_exports']:
 				xenService.backup_vm()
 
+			xenService.close()
 			self._end_run()
 
 			if self.config['smtp_enabled']:
@@ -74,6 +115,12 @@ class Cli(object):
 			exit(0)
 		except Exception as e:
 			self.logger.exception(e)
+			if xenService is not None:
+				# Wait for snapshots queued for removal and report any failed
+				try:
+					xenService.close()
+				except Exception as e:
+					self.logger.exception(e)
 			self._end_run()
 			exit(1)
 
@@ -93,11 +140,49 @@ class Cli(object):
 		self.logger.info('  backup_dir        = {}'.format(self.config['backup_dir']))
 		self.logger.info('  space_threshold   = {}'.format(self.config['space_threshold']))
 		self.logger.info('  share_type        = {}'.format(self.config['share_type']))
+		self.logger.info('  backend           = {}'.format(self.config['backend']))
+		self.logger.info('  store_type        = {}'.format(self.config['store_type']))
+		if self.config['backend'] == 'xenapi':
+			self.logger.info('  export_buffer_size = {}MB'.format(self.config['export_buffer_size']))
+			self.logger.info('  export_buffers    = {}'.format(self.config['export_buffers']))
 		self.logger.info('  compress          = {}'.format(self.config['compress']))
+		if self.config['compress'] and self.config['backend'] == 'xenapi':
+			self.logger.info('  compress_type     = {}'.format(self.config['compress_type']))
+			self.logger.info('  compress_level    = {}'.format(self.config['compress_level']))
+			self.logger.info('  compress_workers  = {}'.format(self.config['compress_workers']))
 		self.logger.info('  max_backups       = {}'.format(self.config['max_backups']))
+		self.logger.info('  keep_daily        = {}'.format(self.config['keep_daily']))
+		self.logger.info('  keep_weekly       = {}'.format(self.config['keep_weekly']))
+		self.logger.info('  keep_monthly      = {}'.format(self.config['keep_monthly']))
+		self.logger.info('  delete_interval   = {}'.format(self.config['delete_interval']))
 		self.logger.info('  vdi_export_format = {}'.format(self.config['vdi_export_format']))
+		if self.config['backend'] == 'xenapi':
+			self.logger.info('  vdi_sparse        = {}'.format(self.config['vdi_sparse']))
+			self.logger.info('  vdi_resume        = {}'.format(self.config['vdi_resume']))
+			if self.config['vdi_resume']:
+				self.logger.info('  vdi_resume_retries = {}'.format(self.config['vdi_resume_retries']))
+				self.logger.info('  vdi_resume_segment = {}MB'.format(self.config['vdi_resume_segment']))
+		if self.config['backend'] == 'xenapi':
+			self.logger.info('  checksum          = {}'.format(self.config['checksum']))
+			if self.config['checksum']:
+				self.logger.info('  checksum_type     = {}'.format(self.config['checksum_type']))
+				self.logger.info('  checksum_block_size = {}MB'.format(self.config['checksum_block_size']))
+				self.logger.info('  checksum_sha256   = {}'.format(self.config['checksum_sha256']))
+			self.logger.info('  xva_index         = {}'.format(self.config['xva_index']))
+		self.logger.info('  cbt_enabled       = {}'.format(self.config['cbt_enabled']))
+		if self.config['cbt_enabled']:
+			self.logger.info('  cbt_full_interval = {}'.format(self.config['cbt_full_interval']))
 		self.logger.info('  pool_backup       = {}'.format(self.config['pool_backup']))
 		self.logger.info('  host_backup       = {}'.format(self.config['host_backup']))
+		self.logger.info('  max_parallel_exports = {}'.format(self.config['max_parallel_exports']))
+		self.logger.info('  max_parallel_disks = {}'.format(self.config['max_parallel_disks']))
+		self.logger.info('  teardown_workers  = {}'.format(self.config['teardown_workers']))
+		self.logger.info('  verify_workers    = {}'.format(self.config['verify_workers']))
+		self.logger.info('  verify_io_limit   = {}'.format(self.config['verify_io_limit']))
+		self.logger.info('  verify_threads    = {}'.format(self.config['verify_threads']))
+		self.logger.info('  metrics_dir       = {}'.format(self.config['metrics_dir']))
+		self.logger.info('  progress_interval = {}'.format(self.config['progress_interval']))
+		self.logger.info('  status_file       = {}'.format(self.config['status_file']))
 		self._print_vm_list('excludes', self.config['excludes'])
 		self._print_vm_list('vdi-exports', self.config['vdi_exports'])
 		self._print_vm_list('vm-exports', self.config['vm_exports'])
@@ -157,10 +242,28 @@ class Cli(object):
 		child_parser.add_argument('-p', '--pool-backup', action='store_true', help='Backup Pool DB')
 		child_parser.add_argument('-H', '--host-backup', action='store_true', help='Backup Hosts in Pool (dom0)')
 		child_parser.add_argument('-C', '--compress', action='store_true',
-			help='Compress on export (vm-exports only)')
+			help='Compress on export (vm-exports only unless using xenapi backend)')
 		child_parser.add_argument('-F', '--format', choices=[ 'raw', 'vhd' ], metavar='FORMAT',
 			help='VDI export format (vdi-exports only, Default: raw)')
+		child_parser.add_argument('-P', '--parallel-exports', type=int, dest='max_parallel_exports', metavar='NUM',
+			help='Maximum number of VMs to export concurrently (Default: 1)')
 		child_parser.add_argument('--preview', action='store_true', help='Preview resulting config and exit')
+		child_parser.add_argument('--restore', metavar='FILE',
+			help='Rebuild export file of a deduplicated backup from its manifest, or the full raw disk image of an incremental (.delta) backup, and exit')
+		child_parser.add_argument('--extract', metavar='FILE',
+			help='Extract ova.xml or a single disk from an .xva backup reading only that part of it, and exit')
+		child_parser.add_argument('--disk', metavar='DISK',
+			help='Disk to extract with --extract as device (i.e. xvda), userdevice, or Ref id in the XVA (Default: ova.xml)')
+		child_parser.add_argument('--output', metavar='FILE',
+			help='File to write with --restore or --extract (Default: backup path without .manifest or .delta, or without .xva and with _<disk>.img or .ova.xml appended)')
+		child_parser.add_argument('--rebuild-store', action='store_true',
+			help='Recount chunk references of the deduplicated store, remove unreferenced chunks, and exit')
+		child_parser.add_argument('--rebuild-catalog', action='store_true',
+			help='Rebuild the backup catalog from the files in backup directory and exit')
+		child_parser.add_argument('--list-backups', action='store_true',
+			help='List backups in the catalog with the space they use and exit')
+		child_parser.add_argument('--verify', action='store_true',
+			help='Verify backups in backup directory against their digests, check their structure and metadata files, and exit')
 		child_parser.add_argument('-e', '--vm-export', action='append', dest='vm_exports', metavar='STRING',
 			help='Appends VM name or Regex for vm-export to existing list (unless specified after -o option) (Default: ".*") NOTE: Specify multiple times for multiple values')
 		child_parser.add_argument('-E', '--vdi-export', action='append', dest='vdi_exports', metavar='STRING',
@@ -170,6 +273,16 @@ class Cli(object):
 
 		final_args = vars(child_parser.parse_args(remaining_argv))
 		options.update(final_args)
+		if options['restore'] and not options['output']:
+			if options['restore'].endswith('.manifest'):
+				options['output'] = options['restore'][:-len('.manifest')]
+			elif options['restore'].endswith('.delta'):
+				options['output'] = options['restore'][:-len('.delta')]
+			else:
+				child_parser.error('--output is required to restore a file not ending in .manifest or .delta')
+		if options['extract'] and not options['output']:
+			base = options['extract'].split('.xva', 1)[0]
+			options['output'] = '{}_{}.img'.format(base, options['disk'].replace('/', '_')) if options['disk'] else '{}.ova.xml'.format(base)
 		c.validate_config(options)
 		return options
 
@@ -41,13 +41,44 @@ class Configurator(object):
 		conf_parser = ConfigParser.SafeConfigParser()
 		conf_parser.add_section('xenserver')
 		conf_parser.set('xenserver', 'share_type', 'nfs')
+		conf_parser.set('xenserver', 'backend', 'xe')
+		conf_parser.set('xenserver', 'store_type', 'file')
 		conf_parser.set('xenserver', 'backup_dir', join(self._base_dir, 'exports'))
 		conf_parser.set('xenserver', 'space_threshold', '20')
 		conf_parser.set('xenserver', 'max_backups', '4')
+		conf_parser.set('xenserver', 'keep_daily', '0')
+		conf_parser.set('xenserver', 'keep_weekly', '0')
+		conf_parser.set('xenserver', 'keep_monthly', '0')
+		conf_parser.set('xenserver', 'delete_interval', '0.5')
 		conf_parser.set('xenserver', 'compress', 'False')
+		conf_parser.set('xenserver', 'compress_type', 'gzip')
+		conf_parser.set('xenserver', 'compress_level', '6')
+		conf_parser.set('xenserver', 'compress_workers', '2')
 		conf_parser.set('xenserver', 'vdi_export_format', 'raw')
+		conf_parser.set('xenserver', 'vdi_sparse', 'True')
+		conf_parser.set('xenserver', 'vdi_resume', 'False')
+		conf_parser.set('xenserver', 'vdi_resume_retries', '3')
+		conf_parser.set('xenserver', 'vdi_resume_segment', '256')
+		conf_parser.set('xenserver', 'checksum', 'False')
+		conf_parser.set('xenserver', 'checksum_type', 'auto')
+		conf_parser.set('xenserver', 'checksum_block_size', '64')
+		conf_parser.set('xenserver', 'checksum_sha256', 'False')
+		conf_parser.set('xenserver', 'xva_index', 'True')
+		conf_parser.set('xenserver', 'cbt_enabled', 'False')
+		conf_parser.set('xenserver', 'cbt_full_interval', '6')
 		conf_parser.set('xenserver', 'pool_backup', 'False')
 		conf_parser.set('xenserver', 'host_backup', 'False')
+		conf_parser.set('xenserver', 'max_parallel_exports', '1')
+		conf_parser.set('xenserver', 'max_parallel_disks', '2')
+		conf_parser.set('xenserver', 'teardown_workers', '2')
+		conf_parser.set('xenserver', 'export_buffer_size', '4')
+		conf_parser.set('xenserver', 'export_buffers', '2')
+		conf_parser.set('xenserver', 'verify_workers', '4')
+		conf_parser.set('xenserver', 'verify_io_limit', '2')
+		conf_parser.set('xenserver', 'verify_threads', '2')
+		conf_parser.set('xenserver', 'metrics_dir', join(self._base_dir, 'logs'))
+		conf_parser.set('xenserver', 'progress_interval', '60')
+		conf_parser.set('xenserver', 'status_file', join(self._base_dir, 'logs', 'status.json'))
 		conf_parser.add_section('smtp')
 		conf_parser.set('smtp', 'smtp_enabled', 'false')
 		conf_parser.set('smtp', 'smtp_auth', 'false')
@@ -80,10 +111,112 @@ class Configurator(object):
 		if options['max_backups'] < 1:
 			raise ValueError('(!) max_backups out of range -> {}'.format(options['max_backups']))
 
+		self.logger.debug('(i) -> Checking if keep_daily, keep_weekly and keep_monthly within range')
+		for key in ['keep_daily', 'keep_weekly', 'keep_monthly']:
+			if options[key] < 0:
+				raise ValueError('(!) {} out of range -> {}'.format(key, options[key]))
+
+		self.logger.debug('(i) -> Checking if delete_interval within range')
+		if options['delete_interval'] < 0:
+			raise ValueError('(!) delete_interval out of range -> {}'.format(options['delete_interval']))
+
+		self.logger.debug('(i) -> Checking if max_parallel_exports within range')
+		if options['max_parallel_exports'] < 1:
+			raise ValueError('(!) max_parallel_exports out of range -> {}'.format(options['max_parallel_exports']))
+
+		self.logger.debug('(i) -> Checking if max_parallel_disks within range')
+		if options['max_parallel_disks'] < 1:
+			raise ValueError('(!) max_parallel_disks out of range -> {}'.format(options['max_parallel_disks']))
+
+		self.logger.debug('(i) -> Checking if teardown_workers within range')
+		if options['teardown_workers'] < 0:
+			raise ValueError('(!) teardown_workers out of range -> {}'.format(options['teardown_workers']))
+
+		self.logger.debug('(i) -> Checking if export_buffer_size and export_buffers within range')
+		if options['export_buffer_size'] < 1:
+			raise ValueError('(!) export_buffer_size out of range -> {}'.format(options['export_buffer_size']))
+		if options['export_buffers'] < 1:
+			raise ValueError('(!) export_buffers out of range -> {}'.format(options['export_buffers']))
+
+		self.logger.debug('(i) -> Checking if verify_workers, verify_io_limit, and verify_threads within range')
+		if options['verify_workers'] < 1:
+			raise ValueError('(!) verify_workers out of range -> {}'.format(options['verify_workers']))
+		if options['verify_io_limit'] < 1:
+			raise ValueError('(!) verify_io_limit out of range -> {}'.format(options['verify_io_limit']))
+		if options['verify_threads'] < 1:
+			raise ValueError('(!) verify_threads out of range -> {}'.format(options['verify_threads']))
+
+		self.logger.debug('(i) -> Checking if backend is valid value')
+		if options['backend'] != 'xe' and options['backend'] != 'xenapi':
+			raise ValueError('(!) backend invalid -> {}'.format(options['backend']))
+
+		self.logger.debug('(i) -> Checking if compression options are valid')
+		if options['compress_type'] not in util.ParallelCompressor.levels:
+			raise ValueError('(!) compress_type invalid -> {}'.format(options['compress_type']))
+		if options['compress']:
+			if options['compress_type'] != 'gzip' and options['backend'] != 'xenapi':
+				raise ValueError('(!) compress_type {} requires backend xenapi'.format(options['compress_type']))
+			if not util.ParallelCompressor.is_available(options['compress_type']):
+				raise ValueError('(!) compress_type {} requires the zstandard python module'.format(options['compress_type']))
+		min_level, max_level = util.ParallelCompressor.levels[options['compress_type']]
+		if not min_level <= options['compress_level'] <= max_level:
+			raise ValueError('(!) compress_level out of range -> {}'.format(options['compress_level']))
+		if options['compress_workers'] < 1:
+			raise ValueError('(!) compress_workers out of range -> {}'.format(options['compress_workers']))
+
+		self.logger.debug('(i) -> Checking if store_type is valid value')
+		if options['store_type'] != 'file' and options['store_type'] != 'dedup':
+			raise ValueError('(!) store_type invalid -> {}'.format(options['store_type']))
+		if options['store_type'] == 'dedup':
+			if options['backend'] != 'xenapi':
+				raise ValueError('(!) store_type dedup requires backend xenapi')
+			if options['compress']:
+				raise ValueError('(!) compress is not supported with store_type dedup')
+
 		self.logger.debug('(i) -> Checking if vdi_export_format is valid value')
 		if options['vdi_export_format'] != 'raw' and options['vdi_export_format'] != 'vhd':
 			raise ValueError('(!) vdi_export_format invalid -> {}'.format(options['vdi_export_format']))
 
+		self.logger.debug('(i) -> Checking if resumable export options are valid')
+		if options['vdi_resume_retries'] < 0:
+			raise ValueError('(!) vdi_resume_retries out of range -> {}'.format(options['vdi_resume_retries']))
+		if options['vdi_resume_segment'] < 1:
+			raise ValueError('(!) vdi_resume_segment out of range -> {}'.format(options['vdi_resume_segment']))
+		if options['vdi_resume']:
+			if options['backend'] != 'xenapi':
+				raise ValueError('(!) vdi_resume requires backend xenapi')
+			if options['vdi_export_format'] != 'raw':
+				raise ValueError('(!) vdi_resume requires vdi_export_format raw')
+			if options['compress']:
+				raise ValueError('(!) compress is not supported with vdi_resume')
+			if options['store_type'] == 'dedup':
+				raise ValueError('(!) vdi_resume is not supported with store_type dedup')
+
+		self.logger.debug('(i) -> Checking if checksum options are valid')
+		if options['checksum_type'] == 'auto':
+			options['checksum_type'] = util.BlockHasher.get_default()
+		if options['checksum_type'] not in util.BlockHasher.algorithms:
+			raise ValueError('(!) checksum_type invalid -> {}'.format(options['checksum_type']))
+		if options['checksum_block_size'] < 1:
+			raise ValueError('(!) checksum_block_size out of range -> {}'.format(options['checksum_block_size']))
+		if options['checksum']:
+			if options['backend'] != 'xenapi':
+				raise ValueError('(!) checksum requires backend xenapi')
+			if not util.BlockHasher.is_available(options['checksum_type']):
+				raise ValueError('(!) checksum_type {} requires the {} python module'.format(options['checksum_type'],
+					'xxhash' if options['checksum_type'] == 'xxh3' else options['checksum_type']))
+
+		self.logger.debug('(i) -> Checking if incremental backup options are valid')
+		if options['cbt_full_interval'] < 0:
+			raise ValueError('(!) cbt_full_interval out of range -> {}'.format(options['cbt_full_interval']))
+		if options['cbt_enabled']:
+			if options['backend'] != 'xenapi':
+				raise ValueError('(!) cbt_enabled requires backend xenapi')
+			if options['vdi_export_format'] != 'raw':
+				raise ValueError('(!) cbt_enabled requires vdi_export_format raw')
+			if options['compress']:
+				raise ValueError('(!) compress is not supported with cbt_enabled')
+
 		self.logger.debug('(i) -> Checking if backup_dir exists')
 		if not self._h.verify_path(options['backup_dir']):
 			raise ValueError('(!) backup_dir does not exist and could not be created -> {}'.format(options['backup_dir']))
@@ -92,6 +225,18 @@ class Configurator(object):
 		if not self._h.verify_path_writeable(options['backup_dir']):
 			raise ValueError('(!) backup_dir not writeable -> {}'.format(options['backup_dir']))
 
+		self.logger.debug('(i) -> Checking if metrics_dir exists')
+		if options['metrics_dir'] and not self._h.verify_path(options['metrics_dir']):
+			raise ValueError('(!) metrics_dir does not exist and could not be created -> {}'.format(options['metrics_dir']))
+
+		self.logger.debug('(i) -> Checking if progress_interval within range')
+		if options['progress_interval'] < 1:
+			raise ValueError('(!) progress_interval out of range -> {}'.format(options['progress_interval']))
+
+		self.logger.debug('(i) -> Checking if status_file directory exists')
+		if options['status_file'] and not self._h.verify_path(dirname(options['status_file'])):
+			raise ValueError('(!) status_file directory does not exist and could not be created -> {}'.format(options['status_file']))
+
 		self.logger.debug('(i) -> Checking if both vm_exports and vdi_exports are empty')
 		if ( not options['vm_exports'] ) and ( not options['vdi_exports'] ):
 			self.logger.debug('(i) ---> Setting vm_export to default -> .* (all VMs)')
@@ -108,12 +253,43 @@ class Configurator(object):
 			options['backup_dir'] = parser.get('xenserver', 'backup_dir').replace("/", "\\")
 		else:
 			options['backup_dir'] =  parser.get('xenserver', 'backup_dir')
+		options['backend'] = parser.get('xenserver', 'backend')
+		options['store_type'] = parser.get('xenserver', 'store_type')
 		options['space_threshold'] = parser.getint('xenserver', 'space_threshold')
 		options['max_backups'] = parser.getint('xenserver', 'max_backups')
+		options['keep_daily'] = parser.getint('xenserver', 'keep_daily')
+		options['keep_weekly'] = parser.getint('xenserver', 'keep_weekly')
+		options['keep_monthly'] = parser.getint('xenserver', 'keep_monthly')
+		options['delete_interval'] = parser.getfloat('xenserver', 'delete_interval')
 		options['compress'] = parser.getboolean('xenserver', 'compress')
+		options['compress_type'] = parser.get('xenserver', 'compress_type')
+		options['compress_level'] = parser.getint('xenserver', 'compress_level')
+		options['compress_workers'] = parser.getint('xenserver', 'compress_workers')
 		options['vdi_export_format'] = parser.get('xenserver', 'vdi_export_format')
+		options['vdi_sparse'] = parser.getboolean('xenserver', 'vdi_sparse')
+		options['vdi_resume'] = parser.getboolean('xenserver', 'vdi_resume')
+		options['vdi_resume_retries'] = parser.getint('xenserver', 'vdi_resume_retries')
+		options['vdi_resume_segment'] = parser.getint('xenserver', 'vdi_resume_segment')
+		options['checksum'] = parser.getboolean('xenserver', 'checksum')
+		options['checksum_type'] = parser.get('xenserver', 'checksum_type')
+		options['checksum_block_size'] = parser.getint('xenserver', 'checksum_block_size')
+		options['checksum_sha256'] = parser.getboolean('xenserver', 'checksum_sha256')
+		options['xva_index'] = parser.getboolean('xenserver', 'xva_index')
+		options['cbt_enabled'] = parser.getboolean('xenserver', 'cbt_enabled')
+		options['cbt_full_interval'] = parser.getint('xenserver', 'cbt_full_interval')
 		options['pool_backup'] = parser.getboolean('xenserver', 'pool_backup')
 		options['host_backup'] = parser.getboolean('xenserver', 'host_backup')
+		options['max_parallel_exports'] = parser.getint('xenserver', 'max_parallel_exports')
+		options['max_parallel_disks'] = parser.getint('xenserver', 'max_parallel_disks')
+		options['teardown_workers'] = parser.getint('xenserver', 'teardown_workers')
+		options['export_buffer_size'] = parser.getint('xenserver', 'export_buffer_size')
+		options['export_buffers'] = parser.getint('xenserver', 'export_buffers')
+		options['verify_workers'] = parser.getint('xenserver', 'verify_workers')
+		options['verify_io_limit'] = parser.getint('xenserver', 'verify_io_limit')
+		options['verify_threads'] = parser.getint('xenserver', 'verify_threads')
+		options['metrics_dir'] = parser.get('xenserver', 'metrics_dir')
+		options['progress_interval'] = parser.getint('xenserver', 'progress_interval')
+		options['status_file'] = parser.get('xenserver', 'status_file')
 		options['vm_exports'] = parser.get('xenserver', 'vm_exports').split(',') if parser.has_option('xenserver', 'vm_exports') else []
 		options['vdi_exports'] = parser.get('xenserver', 'vdi_exports').split(',') if parser.has_option('xenserver', 'vdi_exports') else []
 		options['excludes'] = parser.get('xenserver', 'excludes').split(',') if parser.has_option('xenserver', 'excludes') else []
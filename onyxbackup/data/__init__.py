@@ -1,3 +1,5 @@
 #!/usr/bin/env python
 
-from data import *
\ No newline at end of file
+from data import *
+from inventory import *
+from nbd import *
\ No newline at end of file
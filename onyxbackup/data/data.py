@@ -19,123 +19,218 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import httplib
+import socket
+import ssl
+import threading
 from logging import getLogger
+from urllib import urlencode
+from urlparse import urlparse
 import XenAPI
 
+class UnixHTTPConnection(httplib.HTTPConnection):
+	"""
+		HTTP connection to xapi over its local unix domain socket
+	"""
+
+	def __init__(self, path):
+		httplib.HTTPConnection.__init__(self, 'localhost')
+		self._path = path
+
+	def connect(self):
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.sock.connect(self._path)
+
 class DataAPI(object):
 
 	def __init__(self):
 		self.logger = getLogger(__name__)
 		self._api = '2.7'
 		self._program = 'OnyxBackupVM'
+		self._local = threading.local()
+		self._lock = threading.Lock()
+		self._sessions = []
+		self._stats = {'logins': 0, 'calls': 0}
+		self._max_redirects = 5
 
-	def get_api_version(self):
-		self.login()
+	def call(self, method, *args):
+		"""
+			Call XenAPI method (i.e. 'VM.get_record') with the given arguments
+			using the session of the current thread, logging in again once if
+			the session is no longer valid
+		"""
 		try:
-			pool = self._session.xenapi.pool.get_all()[0]
-			host = self._session.xenapi.pool.get_master(pool)
-			major_version = self._session.xenapi.host.get_API_version_major(host)
-			minor_version = self._session.xenapi.host.get_API_version_minor(host)
-			api_version = '{}.{}'.format(major_version, minor_version)
-			self.logger.debug('(i) -> API version: {}'.format(api_version))
-		finally:
-			self.logout()
+			return self._invoke(method, args)
+		except XenAPI.Failure as e:
+			if e.details[0] != 'SESSION_INVALID':
+				raise
+			self.logger.debug('(i) -> Session no longer valid, logging in again')
+			self._local.session = None
+			return self._invoke(method, args)
+
+	def get_all_records(self, cls):
+		self.logger.debug('(i) -> Getting all records for {}'.format(cls))
+		return self.call('{}.get_all_records'.format(cls))
+
+	def get_api_version(self):
+		pool = self.call('pool.get_all')[0]
+		host = self.call('pool.get_master', pool)
+		major_version = self.call('host.get_API_version_major', host)
+		minor_version = self.call('host.get_API_version_minor', host)
+		api_version = '{}.{}'.format(major_version, minor_version)
+		self.logger.debug('(i) -> API version: {}'.format(api_version))
 		return api_version
 
 	def get_master(self):
-		self.login()
-		try:
-			pool = self._session.xenapi.pool.get_all()[0]
-			host = self._session.xenapi.pool.get_master(pool)
-			host_record = self._session.xenapi.host.get_record(host)
-			master = host_record['address']
-			self.logger.debug('(i) -> Master address: {}'.format(master))
-		finally:
-			self.logout()
+		pool = self.call('pool.get_all')[0]
+		host = self.call('pool.get_master', pool)
+		host_record = self.call('host.get_record', host)
+		master = host_record['address']
+		self.logger.debug('(i) -> Master address: {}'.format(master))
 		return master
 
 	def get_network_record(self, network):
-		self.login()
-		try:
-			self.logger.debug('(i) -> Getting record for Network: {}'.format(network))
-			network_record = self._session.xenapi.network.get_record(network)
-		finally:
-			self.logout()
-		return network_record
+		self.logger.debug('(i) -> Getting record for Network: {}'.format(network))
+		return self.call('network.get_record', network)
 
 	def get_sr_record(self, sr):
-		self.login()
-		try:
-			self.logger.debug('(i) -> Getting record for SR: {}'.format(sr))
-			sr_record = self._session.xenapi.SR.get_record(sr)
-		finally:
-			self.logout()
-		return sr_record
+		self.logger.debug('(i) -> Getting record for SR: {}'.format(sr))
+		return self.call('SR.get_record', sr)
+
+	def get_stats(self):
+		"""
+			Get counts of logins and API calls made by all sessions
+		"""
+		with self._lock:
+			return dict(self._stats)
 
 	def get_vbd_record(self, vbd):
-		self.login()
-		try:
-			self.logger.debug('(i) -> Getting record for VBD: {}'.format(vbd))
-			vbd_record = self._session.xenapi.VBD.get_record(vbd)
-		finally:
-			self.logout()
-		return vbd_record
+		self.logger.debug('(i) -> Getting record for VBD: {}'.format(vbd))
+		return self.call('VBD.get_record', vbd)
 
 	def get_vdi_record(self, vdi):
-		self.login()
-		try:
-			self.logger.debug('(i) -> Getting record for VDI: {}'.format(vdi))
-			vdi_record = self._session.xenapi.VDI.get_record(vdi)
-		finally:
-			self.logout()
-		return vdi_record
+		self.logger.debug('(i) -> Getting record for VDI: {}'.format(vdi))
+		return self.call('VDI.get_record', vdi)
 
 	def get_vif_record(self, vif):
-		self.login()
-		try:
-			self.logger.debug('(i) -> Getting record for VIF: {}'.format(vif))
-			vif_record = self._session.xenapi.VIF.get_record(vif)
-		finally:
-			self.logout()
-		return vif_record
+		self.logger.debug('(i) -> Getting record for VIF: {}'.format(vif))
+		return self.call('VIF.get_record', vif)
 
 	def get_vm_by_name(self, vm_name):
-		self.login()
-		try:
-			self.logger.debug('(i) -> Getting VM object: {}'.format(vm_name))
-			vm = self._session.xenapi.VM.get_by_name_label(vm_name)
-			return vm
-		finally:
-			self.logout()
-		return vm
+		self.logger.debug('(i) -> Getting VM object: {}'.format(vm_name))
+		return self.call('VM.get_by_name_label', vm_name)
 
 	def get_vm_record(self, vm):
-		self.login()
-		try:
-			self.logger.debug('(i) -> Getting record for VM: {}'.format(vm))
-			vm_record = self._session.xenapi.VM.get_record(vm)
-		finally:
-			self.logout()
-		return vm_record
+		self.logger.debug('(i) -> Getting record for VM: {}'.format(vm))
+		return self.call('VM.get_record', vm)
+
+	def open_http(self, path, **params):
+		"""
+			Send a GET request to the given xapi HTTP handler (i.e. '/export')
+			authenticated with the session of the current thread, following
+			redirects to other hosts in the pool
+
+			@return Response to read the body from as a stream
+		"""
+		params['session_id'] = self._get_session()._session
+		url = '{}?{}'.format(path, urlencode(params))
+		connection = self._new_connection()
+		for redirect in range(self._max_redirects + 1):
+			self.logger.debug('(i) -> HTTP GET {}'.format(path))
+			connection.request('GET', url)
+			response = connection.getresponse()
+			if response.status in [301, 302, 303, 307]:
+				location = urlparse(response.getheader('location'))
+				self.logger.debug('(i) -> Redirected to host: {}'.format(location.netloc))
+				response.close()
+				connection.close()
+				connection = self._connect(location.scheme, location.netloc)
+				url = '{}?{}'.format(location.path, location.query)
+				continue
+			if response.status != 200:
+				response.close()
+				connection.close()
+				raise IOError('(!) {} returned HTTP {} {}'.format(path, response.status, response.reason))
+			return response
+		connection.close()
+		raise IOError('(!) Too many redirects for {}'.format(path))
 
 	def login(self):
-		raise NotImplementedError('(!) Must be implemented in subclass')
+		"""
+			Log in a new session for the current thread
+		"""
+		session = self._new_session()
+		self.logger.debug('(i) -> Logging in to get session')
+		session.xenapi.login_with_password(self._username, self._password, self._api, self._program)
+		self._add_session(session)
 
 	def logout(self):
-		self.logger.debug('(i) -> Logging out of session')
-		self._session.xenapi.session.logout()
+		"""
+			Log out every session opened by this instance
+		"""
+		with self._lock:
+			sessions = self._sessions
+			self._sessions = []
+		for session in sessions:
+			self.logger.debug('(i) -> Logging out of session')
+			try:
+				session.xenapi.session.logout()
+			except Exception as e:
+				self.logger.debug('(i) -> Unable to log out of session: {}'.format(e))
+		self._local = threading.local()
 
 	def vm_exists(self, vm_name):
-		self.login()
-		try:
-			self.logger.debug('(i) -> Checking if vm exists: {}'.format(vm_name))
-			vm = self._session.xenapi.VM.get_by_name_label(vm_name)
-			if ( len(vm) == 0 ):
-				return False
-			else:
-				return True
-		finally:
-			self.logout()
+		self.logger.debug('(i) -> Checking if vm exists: {}'.format(vm_name))
+		vm = self.call('VM.get_by_name_label', vm_name)
+		if ( len(vm) == 0 ):
+			return False
+		else:
+			return True
+
+	# Private Functions
+
+	def _add_session(self, session):
+		"""
+			Store logged in session for reuse by the current thread
+		"""
+		self._local.session = session
+		with self._lock:
+			self._sessions.append(session)
+			self._stats['logins'] += 1
+
+	def _connect(self, scheme, netloc):
+		"""
+			Open HTTP(S) connection to the given host. Certificates are not
+			verified as pool hosts use self-signed certificates by default
+		"""
+		if scheme == 'http':
+			return httplib.HTTPConnection(netloc)
+		create_context = getattr(ssl, '_create_unverified_context', None)
+		if create_context:
+			return httplib.HTTPSConnection(netloc, context=create_context())
+		return httplib.HTTPSConnection(netloc)
+
+	def _get_session(self):
+		"""
+			Get the session of the current thread logging in if there is none
+		"""
+		if getattr(self._local, 'session', None) is None:
+			self.login()
+		return self._local.session
+
+	def _invoke(self, method, args):
+		func = self._get_session().xenapi
+		for name in method.split('.'):
+			func = getattr(func, name)
+		with self._lock:
+			self._stats['calls'] += 1
+		return func(*args)
+
+	def _new_connection(self):
+		raise NotImplementedError('(!) Must be implemented in subclass')
+
+	def _new_session(self):
+		raise NotImplementedError('(!) Must be implemented in subclass')
 
 class XenLocal(DataAPI):
 
@@ -143,11 +238,14 @@ class XenLocal(DataAPI):
 		super(self.__class__, self).__init__()
 		self._username = 'root'
 		self._password = ''
-		self._session = XenAPI.xapi_local()
+		self._socket = '/var/xapi/xapi'
 
-	def login(self):
-		self.logger.debug('(i) -> Logging in to get local session')
-		self._session.xenapi.login_with_password(self._username, self._password, self._api, self._program)
+	def _new_connection(self):
+		return UnixHTTPConnection(self._socket)
+
+	def _new_session(self):
+		self.logger.debug('(i) -> Creating local session')
+		return XenAPI.xapi_local()
 
 class XenRemote(DataAPI):
 
@@ -155,19 +253,25 @@ class XenRemote(DataAPI):
 		super(self.__class__, self).__init__()
 		self._username = username
 		self._password = password
-		self._url = url
-		self._session = XenAPI.Session('https://' + self._url)
+		self._url = url if '://' in url else 'https://' + url
 
 	def login(self):
-		self.logger.debug('(i) -> Logging in to get remote session')
 		try:
-			self._session.xenapi.login_with_password(self._username, self._password, self._api, self._program)
+			super(self.__class__, self).login()
 		except XenAPI.Failure as e:
 			if e.details[0] == 'HOST_IS_SLAVE':
 				self.logger.warning('(!) Host is slave: {}'.format(self._url))
+				# Keep master address so later sessions go straight to it
 				self._url = 'https://' + e.details[1]
 				self.logger.info('-> Trying master from response: {}'.format(e.details[1]))
-				self._session = XenAPI.Session(self._url)
-				self._session.xenapi.login_with_password(self._username, self._password, self._api, self._program)
+				super(self.__class__, self).login()
 			else:
 				raise
+
+	def _new_connection(self):
+		url = urlparse(self._url)
+		return self._connect(url.scheme, url.netloc)
+
+	def _new_session(self):
+		self.logger.debug('(i) -> Creating remote session: {}'.format(self._url))
+		return XenAPI.Session(self._url)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+# part of OnyxBackupVM
+# Copyright (c) 2017-2020 OnyxFire, Inc.
+	
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from logging import getLogger
+
+class Inventory(object):
+	"""
+		Run-scoped snapshot of pool objects loaded with one get_all_records
+		call per class and indexed for lookups without further API calls
+	"""
+
+	classes = ['VM', 'VBD', 'VDI', 'VIF', 'network', 'SR', 'VM_guest_metrics']
+
+	def __init__(self, data_api):
+		self.logger = getLogger(__name__)
+		self._d = data_api
+		self._records = {}
+		self._uuids = {}
+		self._vm_names = {}
+		self._vdi_srs = {}
+
+	def load(self):
+		"""
+			Load all records for each class and rebuild the indexes
+		"""
+		for cls in self.classes:
+			self.logger.debug('(i) -> Loading all records for {}'.format(cls))
+			self._records[cls] = self._d.get_all_records(cls)
+			self._uuids[cls] = dict((record['uuid'], ref) for ref, record in self._records[cls].items())
+
+		self._vm_names = {}
+		for ref, record in self._records['VM'].items():
+			self._vm_names.setdefault(record['name_label'], []).append(ref)
+
+		srs = self._records['SR']
+		self._vdi_srs = {}
+		for ref, record in self._records['VDI'].items():
+			if record['SR'] in srs:
+				self._vdi_srs[ref] = srs[record['SR']]['uuid']
+		self.logger.debug('(i) -> Inventory loaded: {}'.format(
+			', '.join('{}={}'.format(cls, len(self._records[cls])) for cls in self.classes)))
+
+	def get_os_version(self, vm):
+		"""
+			Get the name portion of the OS version reported by the guest
+			agent of the given VM or None if not reported
+		"""
+		metrics = self.get_record('VM_guest_metrics', self.get_record('VM', vm)['guest_metrics'])
+		if not metrics:
+			return None
+		name = metrics['os_version'].get('name', '')
+		return name.split('|')[0] or None
+
+	def get_record(self, cls, ref):
+		"""
+			Get record of the given class by reference, fetching and caching
+			it if the object was not in the pool when the inventory loaded
+
+			@return record or None for a null reference
+		"""
+		if ref == 'OpaqueRef:NULL':
+			return None
+		records = self._records.setdefault(cls, {})
+		if ref not in records:
+			self.logger.debug('(i) -> {} not in inventory, fetching: {}'.format(cls, ref))
+			records[ref] = self._d.call('{}.get_record'.format(cls), ref)
+		return records[ref]
+
+	def get_ref(self, cls, uuid):
+		"""
+			Get reference of object of the given class by uuid
+		"""
+		uuids = self._uuids.setdefault(cls, {})
+		if uuid not in uuids:
+			uuids[uuid] = self._d.call('{}.get_by_uuid'.format(cls), uuid)
+		return uuids[uuid]
+
+	def get_sr_uuid(self, vdi):
+		"""
+			Get uuid of the SR holding the given VDI
+		"""
+		if vdi not in self._vdi_srs:
+			self._vdi_srs[vdi] = self.get_record('SR', self.get_record('VDI', vdi)['SR'])['uuid']
+		return self._vdi_srs[vdi]
+
+	def get_vm_names(self):
+		"""
+			Get name-labels of all VMs that are not templates, snapshots,
+			or control domains
+		"""
+		return [record['name_label'] for record in self._records['VM'].values()
+			if not (record['is_a_template'] or record['is_a_snapshot'] or record['is_control_domain'])]
+
+	def get_vms_by_name(self, name):
+		"""
+			Get references of all VM objects with the given name-label
+		"""
+		return list(self._vm_names.get(name, []))
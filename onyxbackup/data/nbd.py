@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+# part of OnyxBackupVM
+# Copyright (c) 2017-2020 OnyxFire, Inc.
+	
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import socket
+import ssl
+import struct
+from logging import getLogger
+
+class NBDClient(object):
+	"""
+		Minimal NBD client reading from a VDI exported by the NBD server of
+		xapi (see VDI.get_nbd_info) using the fixed newstyle handshake and
+		upgrading the connection to TLS when the host provides a certificate.
+		When connected with allocation=True it also asks for structured
+		replies and the base:allocation metadata context so the allocated
+		extents of the VDI can be queried where the server supports it
+	"""
+
+	_option = struct.Struct('>8sII')
+	_option_reply = struct.Struct('>QIII')
+	_request = struct.Struct('>IHHQQI')
+	_reply = struct.Struct('>IQ')
+	_structured_reply = struct.Struct('>HHQI')
+
+	def __init__(self, address, port, export_name, cert='', subject='', timeout=60):
+		self.logger = getLogger(__name__)
+		self._address = address
+		self._port = int(port)
+		self._export_name = export_name
+		self._cert = cert
+		self._subject = subject
+		self._timeout = timeout
+		self._sock = None
+		self._handle = 0
+		self._structured = False
+		self._context = None
+		self.size = None
+
+	def close(self):
+		if self._sock is None:
+			return
+		try:
+			self._sock.sendall(self._request.pack(0x25609513, 0, 2, 0, 0, 0))
+		except (IOError, socket.error):
+			pass
+		self._sock.close()
+		self._sock = None
+
+	def connect(self, allocation=False):
+		"""
+			Connect to the export negotiating TLS if required
+
+			@return Size of the export in bytes
+		"""
+		self.logger.debug('(i) -> Connecting to NBD server: {}:{}'.format(self._address, self._port))
+		self._sock = socket.create_connection((self._address, self._port), self._timeout)
+		magic, option_magic, flags = struct.unpack('>8s8sH', self._recv(18))
+		if magic != 'NBDMAGIC' or option_magic != 'IHAVEOPT':
+			raise IOError('(!) Not an NBD newstyle server: {}'.format(self._address))
+		# Fixed newstyle and no zeroes after export info if server allows it
+		client_flags = flags & 0x3
+		self._sock.sendall(struct.pack('>I', client_flags))
+
+		if self._cert:
+			self.logger.debug('(i) -> Starting TLS for NBD connection')
+			reply_type, data = self._send_option(5)
+			if reply_type != 1:
+				raise IOError('(!) NBD server refused TLS: {}'.format(self._address))
+			self._sock = self._wrap_socket(self._sock)
+
+		if allocation and client_flags & 0x1 and self._send_option(8)[0] == 1:
+			self._structured = True
+			self._context = self._set_meta_context('base:allocation')
+			self._go()
+		else:
+			self._sock.sendall(self._option.pack('IHAVEOPT', 1, len(self._export_name)) + self._export_name)
+			self.size, transmission_flags = struct.unpack('>QH', self._recv(10))
+			if not client_flags & 0x2:
+				self._recv(124)
+		return self.size
+
+	def get_allocated_extents(self):
+		"""
+			Query which parts of the export may hold data
+
+			@return List of (offset, length) extents not reported as reading
+			zeroes or None if the server does not report allocation
+		"""
+		if self._context is None:
+			return None
+		extents = []
+		offset = 0
+		while offset < self.size:
+			handle = self._send_request(7, offset, min(self.size - offset, 1073741824))
+			reported = 0
+			for reply_type, payload in self._read_reply(handle):
+				if reply_type != 5 or struct.unpack('>I', payload[:4])[0] != self._context:
+					continue
+				for index in range(4, len(payload), 8):
+					length, flags = struct.unpack('>II', payload[index:index + 8])
+					length = min(length, self.size - offset - reported)
+					start = offset + reported
+					reported += length
+					# Bit 1 is set for extents which read as zeroes
+					if flags & 0x2 or length == 0:
+						continue
+					if extents and sum(extents[-1]) == start:
+						extents[-1] = (extents[-1][0], extents[-1][1] + length)
+					else:
+						extents.append((start, length))
+			if reported == 0:
+				raise IOError('(!) NBD server reported no extents at offset {}'.format(offset))
+			offset += reported
+		return extents
+
+	def read(self, offset, length):
+		"""
+			@return length bytes of the export starting at offset
+		"""
+		handle = self._send_request(0, offset, length)
+		data = None
+		for reply_type, payload in self._read_reply(handle, length):
+			if reply_type is None:
+				return payload
+			if data is None:
+				data = bytearray(length)
+			# Offset data chunks, holes are left as zeroes
+			if reply_type == 1:
+				chunk_offset = struct.unpack('>Q', payload[:8])[0] - offset
+				data[chunk_offset:chunk_offset + len(payload) - 8] = payload[8:]
+		return str(data) if data is not None else '\0' * length
+
+	# Private Functions
+
+	def _go(self):
+		"""
+			Select the export with NBD_OPT_GO keeping negotiated options
+		"""
+		payload = struct.pack('>I', len(self._export_name)) + self._export_name + struct.pack('>H', 0)
+		self._sock.sendall(self._option.pack('IHAVEOPT', 7, len(payload)) + payload)
+		while True:
+			reply_type, data = self._read_option_reply()
+			if reply_type == 3 and struct.unpack('>H', data[:2])[0] == 0:
+				self.size = struct.unpack('>Q', data[2:10])[0]
+			elif reply_type == 1:
+				return
+			elif reply_type & 0x80000000:
+				raise IOError('(!) NBD server refused export {}: {}'.format(self._export_name, data))
+
+	def _read_option_reply(self):
+		magic, option, reply_type, length = self._option_reply.unpack(self._recv(self._option_reply.size))
+		if magic != 0x3e889045565a9:
+			raise IOError('(!) Invalid NBD option reply from {}'.format(self._address))
+		return (reply_type, self._recv(length))
+
+	def _read_reply(self, handle, length=0):
+		"""
+			Read the simple or structured reply to the request with the given
+			handle yielding (type, payload) for each chunk, type None being the
+			data of a simple reply
+		"""
+		while True:
+			magic = struct.unpack('>I', self._recv(4))[0]
+			if magic == 0x67446698:
+				error, reply_handle = self._reply.unpack(self._recv(self._reply.size))
+				if reply_handle != handle:
+					raise IOError('(!) Invalid NBD reply from {}'.format(self._address))
+				if error:
+					raise IOError('(!) NBD request failed with error {}'.format(error))
+				yield (None, self._recv(length))
+				return
+			if magic != 0x668e33ef:
+				raise IOError('(!) Invalid NBD reply from {}'.format(self._address))
+			flags, reply_type, reply_handle, payload_length = self._structured_reply.unpack(self._recv(self._structured_reply.size))
+			payload = self._recv(payload_length)
+			if reply_handle != handle:
+				raise IOError('(!) Invalid NBD reply from {}'.format(self._address))
+			if reply_type & 0x8000:
+				raise IOError('(!) NBD request failed with error {}'.format(struct.unpack('>I', payload[:4])[0]))
+			if reply_type != 0:
+				yield (reply_type, payload)
+			# Bit 0 is set on the last chunk of the reply
+			if flags & 0x1:
+				return
+
+	def _recv(self, length):
+		"""
+			Receive exactly length bytes from the server
+		"""
+		chunks = []
+		while length > 0:
+			chunk = self._sock.recv(min(length, 4194304))
+			if not chunk:
+				raise IOError('(!) NBD connection closed by {}'.format(self._address))
+			chunks.append(chunk)
+			length -= len(chunk)
+		return ''.join(chunks)
+
+	def _send_option(self, option, payload=''):
+		"""
+			Send option which is answered with a single reply
+		"""
+		self._sock.sendall(self._option.pack('IHAVEOPT', option, len(payload)) + payload)
+		return self._read_option_reply()
+
+	def _send_request(self, command, offset, length):
+		self._handle += 1
+		self._sock.sendall(self._request.pack(0x25609513, 0, command, self._handle, offset, length))
+		return self._handle
+
+	def _set_meta_context(self, query):
+		"""
+			Ask for the given metadata context of the export
+
+			@return Id of the context or None if not supported
+		"""
+		payload = (struct.pack('>I', len(self._export_name)) + self._export_name +
+			struct.pack('>II', 1, len(query)) + query)
+		self._sock.sendall(self._option.pack('IHAVEOPT', 10, len(payload)) + payload)
+		context = None
+		while True:
+			reply_type, data = self._read_option_reply()
+			if reply_type == 4 and data[4:] == query:
+				context = struct.unpack('>I', data[:4])[0]
+			elif reply_type == 1 or reply_type & 0x80000000:
+				return context
+
+	def _wrap_socket(self, sock):
+		"""
+			Wrap socket with TLS verifying the host against the certificate
+			provided by xapi where supported
+		"""
+		create_context = getattr(ssl, 'create_default_context', None)
+		if create_context:
+			context = create_context(cadata=self._cert)
+			context.check_hostname = bool(self._subject)
+			return context.wrap_socket(sock, server_hostname=self._subject or None)
+		return ssl.wrap_socket(sock)
@@ -1,3 +1,5 @@
 #!/usr/bin/env python
 
+from backend import *
+from progress import *
 from service import *
\ No newline at end of file
@@ -0,0 +1,825 @@
+#!/usr/bin/env python
+
+# part of OnyxBackupVM
+# Copyright (c) 2017-2020 OnyxFire, Inc.
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import httplib
+import re
+import socket
+import threading
+from base64 import b64decode
+from functools import wraps
+from logging import getLogger
+from time import sleep, time
+import XenAPI
+import onyxbackup.data as data
+import onyxbackup.store as store
+import onyxbackup.util as util
+
+def timed(func):
+    """
+        Record call count and total run time of a backend operation
+    """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        start = time()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self._record(func.__name__, time() - start)
+    return wrapper
+
+class Backend(object):
+    """
+        Operations run against the pool while taking backups. Subclasses
+        implement them with the xe CLI or directly with XenAPI so either can
+        be selected with the backend option and compared using get_stats()
+    """
+
+    def __init__(self):
+        self.logger = getLogger(__name__)
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def destroy_snapshot(self, uuid, snapshot_type='vm'):
+        """
+            Destroy the VM or VDI snapshot with the given uuid
+
+            @return True if successful
+        """
+        raise NotImplementedError('(!) Must be implemented in subclass')
+
+    def destroy_snapshot_data(self, uuid, snap_name='ONYXBACKUP-CBT'):
+        """
+            Destroy the data of the VDI snapshot with the given uuid keeping
+            it under the given name as a metadata-only snapshot which later
+            snapshots can be compared against for changed blocks
+
+            @return True if successful
+        """
+        raise NotImplementedError('(!) Must be implemented in subclass')
+
+    def enable_cbt(self, uuid):
+        """
+            Enable changed block tracking on the VDI with the given uuid
+
+            @return True if successful
+        """
+        raise NotImplementedError('(!) Must be implemented in subclass')
+
+    def export(self, id, file, export_type='vm', compress=False, vdi_format='raw', progress=None):
+        """
+            Export VM, VDI, Host, or Pool DB with the given id to file calling
+            progress(bytes, seconds[, total]) while the export runs where
+            supported
+
+            @return True if successful
+        """
+        raise NotImplementedError('(!) Must be implemented in subclass')
+
+    def export_changed_blocks(self, uuid, base_uuid, file, parent, progress=None):
+        """
+            Export blocks of the VDI snapshot with the given uuid which
+            changed since the metadata-only snapshot with base_uuid to a delta
+            file applied over the backup named parent
+
+            @return True if successful
+        """
+        raise NotImplementedError('(!) Must be implemented in subclass')
+
+    def find_all_snapshots(self, snapshot_type='vm', snap_name='ONYXBACKUP'):
+        """
+            Find all VM or VDI snapshots with the given name in the pool
+            with a single query
+
+            @return Dictionary of lists of snapshot uuids by uuid of the VM
+            or VDI they were taken of or None if failed
+        """
+        raise NotImplementedError('(!) Must be implemented in subclass')
+
+    def find_snapshots(self, uuid, snapshot_type='vm', snap_name='ONYXBACKUP'):
+        """
+            Find snapshots with the given name of the VM or VDI with the
+            given uuid
+
+            @return List of snapshot uuids
+        """
+        raise NotImplementedError('(!) Must be implemented in subclass')
+
+    def get_all_hosts(self):
+        """
+            Get hostnames of all hosts in the pool
+
+            @return List of hostnames
+        """
+        raise NotImplementedError('(!) Must be implemented in subclass')
+
+    def get_stats(self):
+        """
+            Get call count and total seconds spent for each operation
+        """
+        with self._lock:
+            return dict((op, list(stats)) for op, stats in self._stats.items())
+
+    def prepare_snapshot(self, uuid, snapshot_type='vm', snap_name='ONYXBACKUP'):
+        """
+            Prepare snapshot with the given uuid for export
+
+            @return True if successful
+        """
+        raise NotImplementedError('(!) Must be implemented in subclass')
+
+    def snapshot(self, uuid, snapshot_type='vm', snap_name='ONYXBACKUP'):
+        """
+            Take snapshot of VM (vm or vm-vss) or VDI with the given uuid
+
+            @return snapshot uuid or empty string if failed
+        """
+        raise NotImplementedError('(!) Must be implemented in subclass')
+
+    def uninstall_vm(self, uuid):
+        """
+            Destroy the VM with the given uuid along with its disks
+
+            @return True if successful
+        """
+        raise NotImplementedError('(!) Must be implemented in subclass')
+
+    # Private Functions
+
+    def _record(self, operation, elapsed):
+        with self._lock:
+            stats = self._stats.setdefault(operation, [0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+
+class XeBackend(Backend):
+    """
+        Backend running each operation as an xe command
+    """
+
+    # Parameter lines of xe list commands, i.e. "uuid ( RO)    : <uuid>"
+    _param_line = re.compile(r'^\s*([\w-]+) \(\s*R[OW]+\)\s*:\s*(.*?)\s*$')
+
+    def __init__(self, xe_path='/opt/xensource/bin'):
+        super(XeBackend, self).__init__()
+        self._h = util.Helper()
+        self._xe_path = xe_path
+
+    @timed
+    def destroy_snapshot(self, uuid, snapshot_type='vm'):
+        if snapshot_type == 'vm':
+            cmd = 'snapshot-destroy uuid={}'.format(uuid)
+        else:
+            cmd = 'vdi-destroy uuid={}'.format(uuid)
+        return self._run_xe_cmd(cmd)
+
+    @timed
+    def destroy_snapshot_data(self, uuid, snap_name='ONYXBACKUP-CBT'):
+        if not self._run_xe_cmd('vdi-data-destroy uuid={}'.format(uuid)):
+            return False
+        return self._run_xe_cmd('vdi-param-set uuid={} name-label="{}"'.format(uuid, snap_name))
+
+    @timed
+    def enable_cbt(self, uuid):
+        return self._run_xe_cmd('vdi-enable-cbt uuid={}'.format(uuid))
+
+    @timed
+    def export(self, id, file, export_type='vm', compress=False, vdi_format='raw', progress=None):
+        if export_type == 'vm':
+            cmd = 'vm-export uuid={} filename="{}" compress={}'.format(id, file, compress)
+        elif export_type == 'vdi':
+            cmd = 'vdi-export uuid={} filename="{}" format={}'.format(id, file, vdi_format)
+        elif export_type == 'pool':
+            cmd = 'pool-dump-database file-name="{}"'.format(file)
+        else:
+            cmd = 'host-backup host="{}" file-name="{}" enabled=true'.format(id, file)
+        return self._run_xe_cmd(cmd)
+
+    @timed
+    def export_changed_blocks(self, uuid, base_uuid, file, parent, progress=None):
+        self.logger.error('(!) Exporting changed blocks requires the xenapi backend')
+        return False
+
+    @timed
+    def find_all_snapshots(self, snapshot_type='vm', snap_name='ONYXBACKUP'):
+        if snapshot_type == 'vm':
+            cmd = 'snapshot-list name-label="{}" params=uuid,snapshot-of'.format(snap_name)
+        else:
+            cmd = 'vdi-list name-label="{}" is-a-snapshot=true params=uuid,snapshot-of'.format(snap_name)
+        output = self._get_xe_cmd_result(cmd, None)
+        if output is None:
+            return None
+        snaps = {}
+        snap_uuid = None
+        for line in output.splitlines():
+            match = self._param_line.match(line)
+            if not match:
+                continue
+            if match.group(1) == 'uuid':
+                snap_uuid = match.group(2)
+            elif snap_uuid and match.group(2) not in ['', '<not in database>']:
+                snaps.setdefault(match.group(2), []).append(snap_uuid)
+        return snaps
+
+    @timed
+    def find_snapshots(self, uuid, snapshot_type='vm', snap_name='ONYXBACKUP'):
+        if snapshot_type == 'vm':
+            cmd = 'snapshot-list name-label="{}" snapshot-of={} params=uuid --minimal'.format(snap_name, uuid)
+        else:
+            cmd = 'vdi-list name-label="{}" snapshot-of={} params=uuid --minimal'.format(snap_name, uuid)
+        return [snap for snap in self._get_xe_cmd_result(cmd).split(',') if snap]
+
+    @timed
+    def get_all_hosts(self):
+        cmd = 'host-list params=hostname --minimal'
+        return [host for host in self._get_xe_cmd_result(cmd).split(',') if host]
+
+    @timed
+    def prepare_snapshot(self, uuid, snapshot_type='vm', snap_name='ONYXBACKUP'):
+        if snapshot_type == 'vm':
+            cmd = 'template-param-set is-a-template=false ha-always-run=false uuid={}'.format(uuid)
+        else:
+            cmd = 'vdi-param-set uuid={} name-label="{}"'.format(uuid, snap_name)
+        return self._run_xe_cmd(cmd)
+
+    @timed
+    def snapshot(self, uuid, snapshot_type='vm', snap_name='ONYXBACKUP'):
+        if snapshot_type == 'vm':
+            cmd = 'vm-snapshot vm={} new-name-label="{}"'.format(uuid, snap_name)
+        elif snapshot_type == 'vm-vss':
+            cmd = 'vm-snapshot-with-quiesce vm={} new-name-label="{}"'.format(uuid, snap_name)
+        else:
+            cmd = 'vdi-snapshot uuid={}'.format(uuid)
+        return self._get_xe_cmd_result(cmd)
+
+    @timed
+    def uninstall_vm(self, uuid):
+        cmd = 'vm-uninstall uuid={} force=true'.format(uuid)
+        return self._run_xe_cmd(cmd)
+
+    # Private Functions
+
+    def _get_xe_cmd_result(self, cmd, default=''):
+        """
+            Run a given command with xe and return the resulting stdout/stderr
+            or default if the command failed
+        """
+        cmd = '{}/xe {}'.format(self._xe_path, cmd)
+        output = default
+        try:
+            output = self._h.get_cmd_result(cmd, default=default)
+            if output is None:
+                self.logger.debug('(i) ---> Command failed')
+            elif output == '':
+                self.logger.debug('(i) ---> Command returned no output')
+            else:
+                self.logger.debug('(i) ---> Command output: {}'.format(output))
+        except OSError as e:
+            self.logger.error('(!) Unable to run command: {}'.format(e))
+        return output
+
+    def _run_xe_cmd(self, cmd):
+        """
+            Run the given command with xe and report only success or failure
+        """
+        cmd = '{}/xe {}'.format(self._xe_path, cmd)
+        try:
+            result = self._h.run_cmd(cmd)
+            if result <> 0:
+                self.logger.debug('(i) ---> Command returned non-zero exit status')
+            else:
+                self.logger.debug('(i) ---> Command successful')
+                return True
+        except OSError as e:
+            self.logger.error('(!) Unable to run command: {}'.format(e))
+        return False
+
+class XenApiBackend(Backend):
+    """
+        Backend running each operation as XenAPI calls on the sessions of
+        the given data API and streaming exports from the xapi HTTP handlers.
+        Compressed VM and VDI exports are compressed by OnyxBackupVM on
+        compress_workers threads. Uncompressed raw VDI exports are written as
+        sparse files, reading only allocated extents over NBD where the host
+        reports them. Host backups are handed to the given fallback backend.
+        Exports over HTTP run in a XenAPI task naming the exported uuid
+        which xapi updates the progress of. As xapi ends the stream of a
+        failed export without an error, an export only succeeds if its task
+        did and raw VDI exports hold the whole disk. With resume, uncompressed raw VDI
+        exports are written in checkpointed segments and continued from the
+        last checkpoint after a failure. With a checksum type, exports
+        written to files are hashed on a separate thread while they stream
+        and their digests are written next to them. With xva_index, VM
+        exports are indexed as written so single disks can be extracted.
+        Records are looked up in the given inventory of the pool
+    """
+
+    cbt_block_size = 65536
+    progress_interval = 1
+    resume_delay = 10
+    task_poll_interval = 0.5
+    task_timeout = 30
+
+    def __init__(self, data_api, fallback, buffer_size=4194304, buffers=2,
+            compress_type='gzip', compress_level=6, compress_workers=2, store=None, sparse=True,
+            resume=False, resume_retries=3, resume_segment_size=268435456,
+            checksum_type=None, checksum_block_size=67108864, checksum_sha256=False, xva_index=True, inventory=None):
+        super(XenApiBackend, self).__init__()
+        self._h = util.Helper()
+        self._d = data_api
+        self._inventory = inventory or data.Inventory(data_api)
+        self._fallback = fallback
+        self._buffer_size = buffer_size
+        self._buffers = buffers
+        self._compress_type = compress_type
+        self._compress_level = compress_level
+        self._compress_workers = compress_workers
+        self._store = store
+        self._sparse = sparse
+        self._resume = resume
+        self._resume_retries = resume_retries
+        self._resume_segment_size = resume_segment_size
+        self._checksum_type = checksum_type
+        self._checksum_block_size = checksum_block_size
+        self._checksum_sha256 = checksum_sha256
+        self._xva_index = xva_index
+
+    @timed
+    def destroy_snapshot(self, uuid, snapshot_type='vm'):
+        cls = 'VM' if snapshot_type == 'vm' else 'VDI'
+        try:
+            ref = self._d.call('{}.get_by_uuid'.format(cls), uuid)
+            self._d.call('{}.destroy'.format(cls), ref)
+        except XenAPI.Failure as e:
+            self.logger.debug('(i) ---> XenAPI call failed: {}'.format(e.details))
+            return False
+        return True
+
+    @timed
+    def destroy_snapshot_data(self, uuid, snap_name='ONYXBACKUP-CBT'):
+        try:
+            ref = self._d.call('VDI.get_by_uuid', uuid)
+            self._d.call('VDI.data_destroy', ref)
+            self._d.call('VDI.set_name_label', ref, snap_name)
+        except XenAPI.Failure as e:
+            self.logger.debug('(i) ---> XenAPI call failed: {}'.format(e.details))
+            return False
+        return True
+
+    @timed
+    def enable_cbt(self, uuid):
+        try:
+            ref = self._d.call('VDI.get_by_uuid', uuid)
+            if not self._d.call('VDI.get_cbt_enabled', ref):
+                self._d.call('VDI.enable_cbt', ref)
+        except XenAPI.Failure as e:
+            self.logger.debug('(i) ---> XenAPI call failed: {}'.format(e.details))
+            return False
+        return True
+
+    @timed
+    def export(self, id, file, export_type='vm', compress=False, vdi_format='raw', progress=None):
+        if export_type == 'vm':
+            path = '/export'
+            params = {'uuid': id, 'use_compression': 'false'}
+        elif export_type == 'vdi':
+            path = '/export_raw_vdi'
+            params = {'vdi': id, 'format': vdi_format}
+        elif export_type == 'pool':
+            path = '/pool/xmldbdump'
+            params = {}
+            compress = False
+        else:
+            return self._fallback.export(id, file, export_type, compress, vdi_format, progress)
+
+        if self._resume and export_type == 'vdi' and vdi_format == 'raw' and not compress and self._store is None:
+            return self._export_resumable(id, file, progress)
+
+        sink = None
+        try:
+            sink = self._open_sink(file, export_type, compress, vdi_format)
+            if isinstance(sink, util.SparseFileSink) and self._export_allocated(id, sink, progress):
+                sink.finish()
+                self.logger.debug('(i) ---> Sparse file: {} bytes of data, {} bytes in holes'.format(sink.data_bytes, sink.hole_bytes))
+                return True
+            task = self._create_task(id or export_type)
+            if task:
+                params['task_id'] = task
+            try:
+                response = self._d.open_http(path, **params)
+                try:
+                    copier = util.StreamCopier(self._buffer_size, self._buffers, self.progress_interval)
+                    copied = copier.copy(response, sink, progress)
+                finally:
+                    response.close()
+                self._check_task(task)
+                if export_type == 'vdi' and vdi_format == 'raw':
+                    size = int(self._d.call('VDI.get_virtual_size', self._d.call('VDI.get_by_uuid', id)))
+                    if copied < size:
+                        raise IOError('(!) Export ended before end of disk')
+            finally:
+                self._destroy_task(task)
+            sink.finish()
+            if isinstance(sink, util.SparseFileSink):
+                self.logger.debug('(i) ---> Sparse file: {} bytes of data, {} bytes in holes'.format(sink.data_bytes, sink.hole_bytes))
+        except (XenAPI.Failure, IOError, OSError, httplib.HTTPException) as e:
+            self.logger.debug('(i) ---> Export stream failed: {}'.format(e))
+            if sink is not None:
+                sink.abort()
+            return False
+        return True
+
+    @timed
+    def export_changed_blocks(self, uuid, base_uuid, file, parent, progress=None):
+        writer = None
+        try:
+            ref = self._d.call('VDI.get_by_uuid', uuid)
+            base_ref = self._d.call('VDI.get_by_uuid', base_uuid)
+            size = int(self._d.call('VDI.get_virtual_size', ref))
+            bitmap = b64decode(self._d.call('VDI.list_changed_blocks', base_ref, ref))
+            extents = self._get_changed_extents(bitmap, size)
+            self.logger.debug('(i) ---> Changed extents: {} ({} bytes)'.format(len(extents), sum(length for offset, length in extents)))
+            writer = util.DeltaWriter(file, size, parent, self._open_digest(file))
+            nbd_info = self._d.call('VDI.get_nbd_info', ref)
+            if nbd_info:
+                client = self._open_nbd(nbd_info[0])
+                try:
+                    client.connect()
+                    self._copy_nbd_extents(client, extents, writer, progress)
+                finally:
+                    client.close()
+            else:
+                # Without an NBD network only the changed blocks are kept
+                # but the whole disk is read
+                self.logger.debug('(i) ---> VDI not exported over NBD, filtering raw export')
+                task = self._create_task(uuid)
+                params = {'vdi': uuid, 'format': 'raw'}
+                if task:
+                    params['task_id'] = task
+                try:
+                    response = self._d.open_http('/export_raw_vdi', **params)
+                    try:
+                        copier = util.StreamCopier(self._buffer_size, self._buffers, self.progress_interval)
+                        copier.copy(response, util.ChangedBlockFilter(writer, extents), progress)
+                    finally:
+                        response.close()
+                finally:
+                    self._destroy_task(task)
+            writer.finish()
+        except (XenAPI.Failure, IOError, OSError, httplib.HTTPException) as e:
+            self.logger.debug('(i) ---> Changed block export failed: {}'.format(e))
+            if writer is not None:
+                writer.abort()
+            return False
+        return True
+
+    @timed
+    def find_all_snapshots(self, snapshot_type='vm', snap_name='ONYXBACKUP'):
+        cls = 'VM' if snapshot_type == 'vm' else 'VDI'
+        try:
+            records = self._d.call('{}.get_all_records_where'.format(cls), 'field "name__label" = "{}"'.format(snap_name))
+        except XenAPI.Failure as e:
+            self.logger.debug('(i) ---> XenAPI call failed: {}'.format(e.details))
+            return None
+        snaps = {}
+        for record in records.values():
+            if not record['is_a_snapshot'] or record['snapshot_of'] == 'OpaqueRef:NULL':
+                continue
+            try:
+                parent = self._inventory.get_record(cls, record['snapshot_of'])
+            except XenAPI.Failure:
+                self.logger.debug('(i) ---> Snapshot of removed {}: {}'.format(cls, record['uuid']))
+                continue
+            snaps.setdefault(parent['uuid'], []).append(record['uuid'])
+        return snaps
+
+    @timed
+    def find_snapshots(self, uuid, snapshot_type='vm', snap_name='ONYXBACKUP'):
+        cls = 'VM' if snapshot_type == 'vm' else 'VDI'
+        try:
+            ref = self._d.call('{}.get_by_uuid'.format(cls), uuid)
+            snaps = []
+            for snap in self._d.call('{}.get_by_name_label'.format(cls), snap_name):
+                record = self._d.call('{}.get_record'.format(cls), snap)
+                if record['is_a_snapshot'] and record['snapshot_of'] == ref:
+                    snaps.append(record['uuid'])
+        except XenAPI.Failure as e:
+            self.logger.debug('(i) ---> XenAPI call failed: {}'.format(e.details))
+            return []
+        return snaps
+
+    @timed
+    def get_all_hosts(self):
+        try:
+            return [host['hostname'] for host in self._d.get_all_records('host').values()]
+        except XenAPI.Failure as e:
+            self.logger.debug('(i) ---> XenAPI call failed: {}'.format(e.details))
+        return []
+
+    @timed
+    def prepare_snapshot(self, uuid, snapshot_type='vm', snap_name='ONYXBACKUP'):
+        try:
+            if snapshot_type == 'vm':
+                ref = self._d.call('VM.get_by_uuid', uuid)
+                self._d.call('VM.set_is_a_template', ref, False)
+                if self._d.call('VM.get_ha_always_run', ref):
+                    self._d.call('VM.set_ha_always_run', ref, False)
+            else:
+                ref = self._d.call('VDI.get_by_uuid', uuid)
+                self._d.call('VDI.set_name_label', ref, snap_name)
+        except XenAPI.Failure as e:
+            self.logger.debug('(i) ---> XenAPI call failed: {}'.format(e.details))
+            return False
+        return True
+
+    @timed
+    def snapshot(self, uuid, snapshot_type='vm', snap_name='ONYXBACKUP'):
+        try:
+            if snapshot_type == 'vm':
+                snap = self._d.call('VM.snapshot', self._d.call('VM.get_by_uuid', uuid), snap_name)
+                return self._d.call('VM.get_uuid', snap)
+            elif snapshot_type == 'vm-vss':
+                snap = self._d.call('VM.snapshot_with_quiesce', self._d.call('VM.get_by_uuid', uuid), snap_name)
+                return self._d.call('VM.get_uuid', snap)
+            else:
+                snap = self._d.call('VDI.snapshot', self._d.call('VDI.get_by_uuid', uuid), {})
+                return self._d.call('VDI.get_uuid', snap)
+        except XenAPI.Failure as e:
+            self.logger.debug('(i) ---> XenAPI call failed: {}'.format(e.details))
+        return ''
+
+    @timed
+    def uninstall_vm(self, uuid):
+        try:
+            ref = self._d.call('VM.get_by_uuid', uuid)
+            vdis = []
+            for vbd in self._d.call('VM.get_VBDs', ref):
+                vbd_record = self._d.call('VBD.get_record', vbd)
+                if vbd_record['type'].lower() == 'disk' and vbd_record['VDI'] != 'OpaqueRef:NULL':
+                    vdis.append(vbd_record['VDI'])
+            self._d.call('VM.destroy', ref)
+            for vdi in vdis:
+                self._d.call('VDI.destroy', vdi)
+        except XenAPI.Failure as e:
+            self.logger.debug('(i) ---> XenAPI call failed: {}'.format(e.details))
+            return False
+        return True
+
+    # Private Functions
+
+    def _check_task(self, task):
+        """
+            Wait up to task_timeout for xapi to complete the task of an
+            export whose stream has ended
+
+            @raise IOError unless the task succeeded
+        """
+        if not task:
+            return
+        deadline = time() + self.task_timeout
+        status = self._d.call('task.get_status', task)
+        while status == 'pending' and time() < deadline:
+            sleep(self.task_poll_interval)
+            status = self._d.call('task.get_status', task)
+        if status != 'success':
+            self.logger.debug('(i) ---> Export task {}: {}'.format(status, self._d.call('task.get_error_info', task)))
+            raise IOError('(!) Export task did not succeed: {}'.format(status))
+
+    def _copy_from_offset(self, ref, uuid, sink, offset, size, progress):
+        """
+            Copy the raw VDI from offset to the end into sink reading only
+            allocated extents over NBD where available. The HTTP export can
+            not start at an offset so data before it is read and dropped
+        """
+        nbd_info = self._d.call('VDI.get_nbd_info', ref)
+        if nbd_info:
+            client = self._open_nbd(nbd_info[0])
+            try:
+                client.connect(allocation=self._sparse)
+                extents = client.get_allocated_extents() if self._sparse else None
+                if extents is None:
+                    extents = [(0, size)]
+                extents = [(max(start, offset), start + length - max(start, offset))
+                    for start, length in extents if start + length > offset]
+                self._copy_nbd_extents(client, extents, sink, progress)
+            finally:
+                client.close()
+            return
+
+        task = self._create_task(uuid)
+        params = {'vdi': uuid, 'format': 'raw'}
+        if task:
+            params['task_id'] = task
+        try:
+            response = self._d.open_http('/export_raw_vdi', **params)
+            try:
+                skipped = 0
+                while skipped < offset:
+                    data = response.read(min(self._buffer_size, offset - skipped))
+                    if not data:
+                        raise IOError('(!) Export ended before offset {}'.format(offset))
+                    skipped += len(data)
+                copier = util.StreamCopier(self._buffer_size, self._buffers, self.progress_interval)
+                copied = copier.copy(response, sink, progress)
+            finally:
+                response.close()
+            self._check_task(task)
+            if offset + copied < size:
+                raise IOError('(!) Export ended before end of disk')
+        finally:
+            self._destroy_task(task)
+
+    def _copy_nbd_extents(self, client, extents, sink, progress):
+        """
+            Read the given extents over NBD into sink.write_block() in pieces
+            of the buffer size calling progress(bytes, seconds, total) every
+            progress_interval and when finished
+        """
+        start = time()
+        last_report = start
+        copied = 0
+        total = sum(length for offset, length in extents)
+        for offset, length in extents:
+            end = offset + length
+            while offset < end:
+                data = client.read(offset, min(self._buffer_size, end - offset))
+                sink.write_block(offset, data)
+                offset += len(data)
+                copied += len(data)
+                if progress and time() - last_report >= self.progress_interval:
+                    last_report = time()
+                    progress(copied, last_report - start, total)
+        if progress:
+            progress(copied, time() - start, total)
+
+    def _create_task(self, name):
+        """
+            Create a XenAPI task for an export of the given uuid for xapi to
+            report progress on
+
+            @return Task reference or empty string if it could not be created
+        """
+        try:
+            return self._d.call('task.create', 'OnyxBackupVM export {}'.format(name), name)
+        except XenAPI.Failure as e:
+            self.logger.debug('(i) ---> Unable to create task: {}'.format(e.details))
+        return ''
+
+    def _destroy_task(self, task):
+        if not task:
+            return
+        try:
+            self._d.call('task.destroy', task)
+        except XenAPI.Failure as e:
+            self.logger.debug('(i) ---> Unable to destroy task: {}'.format(e.details))
+
+    def _export_allocated(self, uuid, sink, progress):
+        """
+            Read only the allocated extents of the VDI with the given uuid
+            over NBD into the sparse sink
+
+            @return False without writing anything if the VDI is not exported
+            over NBD or its allocation is not reported
+        """
+        nbd_info = self._d.call('VDI.get_nbd_info', self._d.call('VDI.get_by_uuid', uuid))
+        if not nbd_info:
+            return False
+        client = self._open_nbd(nbd_info[0])
+        try:
+            try:
+                size = client.connect(allocation=True)
+                extents = client.get_allocated_extents()
+            except IOError as e:
+                self.logger.debug('(i) ---> Unable to get allocation over NBD: {}'.format(e))
+                return False
+            if extents is None:
+                self.logger.debug('(i) ---> NBD server does not report allocation')
+                return False
+            self.logger.debug('(i) ---> Allocated extents: {} ({} bytes)'.format(len(extents), sum(length for offset, length in extents)))
+            self._copy_nbd_extents(client, extents, sink, progress)
+            sink.set_size(size)
+        finally:
+            client.close()
+        return True
+
+    def _export_resumable(self, uuid, file, progress):
+        """
+            Export the raw VDI with the given uuid to file recording
+            checkpoints in its journal. After a failure the export reconnects
+            and continues from the last verified checkpoint up to
+            resume_retries times. A journal left for the same snapshot by an
+            earlier run is continued from as well
+
+            @return True if successful, the image and journal are kept to
+            resume from unless the snapshot no longer exists
+        """
+        journal = util.ExportJournal.load(file)
+        if journal is None or journal.snapshot != uuid:
+            journal = util.ExportJournal(file, uuid)
+        for attempt in range(self._resume_retries + 1):
+            if attempt:
+                sleep(self.resume_delay * attempt)
+            offset = journal.verify()
+            if offset:
+                self.logger.info('-> Resuming export at {}'.format(self._h.get_size_string(offset)))
+            sink = None
+            try:
+                digest = self._open_digest(file)
+                sink = util.ResumableFileSink(journal, self._resume_segment_size, self._sparse, digest)
+                if offset and digest is not None:
+                    # Data written before the checkpoint is read back to be
+                    # hashed since the digest can not be continued
+                    digest.update_from_file(offset)
+                ref = self._d.call('VDI.get_by_uuid', uuid)
+                journal.size = int(self._d.call('VDI.get_virtual_size', ref))
+                self._copy_from_offset(ref, uuid, sink, offset, journal.size, progress)
+                sink.set_size(journal.size)
+                sink.finish()
+                return True
+            except XenAPI.Failure as e:
+                self.logger.debug('(i) ---> XenAPI call failed: {}'.format(e.details))
+                if e.details and e.details[0] in ['UUID_INVALID', 'HANDLE_INVALID']:
+                    if sink is not None:
+                        sink.abort()
+                    journal.discard()
+                    return False
+                error = e
+            except (IOError, OSError, socket.error, httplib.HTTPException) as e:
+                self.logger.debug('(i) ---> Export stream failed: {}'.format(e))
+                error = e
+            if sink is not None:
+                sink.abort()
+            if attempt < self._resume_retries:
+                self.logger.warning('(!) Export interrupted at {}, retrying: {}'.format(
+                    self._h.get_size_string(journal.offset), error))
+        return False
+
+    def _get_changed_extents(self, bitmap, size):
+        """
+            Convert a CBT bitmap with one bit per block, most significant bit
+            first, to (offset, length) extents of changed data merging
+            adjacent blocks up to the buffer size
+        """
+        extents = []
+        for match in re.finditer(r'[^\x00]+', bitmap):
+            for index in range(match.start(), match.end()):
+                value = ord(bitmap[index])
+                for bit in range(8):
+                    if not value & (0x80 >> bit):
+                        continue
+                    offset = (index * 8 + bit) * self.cbt_block_size
+                    if offset >= size:
+                        break
+                    length = min(self.cbt_block_size, size - offset)
+                    if extents and sum(extents[-1]) == offset and extents[-1][1] + length <= self._buffer_size:
+                        extents[-1] = (extents[-1][0], extents[-1][1] + length)
+                    else:
+                        extents.append((offset, length))
+        return extents
+
+    def _open_digest(self, file):
+        """
+            Open digest hashing an export to file if checksums are enabled
+        """
+        if not self._checksum_type:
+            return None
+        return util.ExportDigest(file, self._checksum_type, self._checksum_block_size, self._checksum_sha256)
+
+    def _open_nbd(self, nbd_info):
+        return data.NBDClient(nbd_info['address'], nbd_info['port'], nbd_info['exportname'],
+            nbd_info.get('cert', ''), nbd_info.get('subject', ''))
+
+    def _open_sink(self, file, export_type, compress, vdi_format='raw'):
+        """
+            Open sink for the export to file which is a manifest in the chunk
+            store for VM and VDI exports when deduplicating and a sparse file
+            for uncompressed raw VDI exports. Files are hashed as written,
+            after compression, and VM exports are indexed before compression
+        """
+        if self._store is not None and export_type in ['vm', 'vdi']:
+            return self._store.open_manifest(file)
+        if self._sparse and not compress and export_type == 'vdi' and vdi_format == 'raw':
+            return util.SparseFileSink(file, digest=self._open_digest(file))
+        sink = util.FileSink(file, self._open_digest(file))
+        if compress:
+            sink = util.ParallelCompressor(sink, self._compress_type, self._compress_level, self._compress_workers)
+        if self._xva_index and export_type == 'vm':
+            sink = store.XvaIndexSink(sink, file)
+        return sink
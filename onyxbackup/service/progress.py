@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+# part of OnyxBackupVM
+# Copyright (c) 2017-2020 OnyxFire, Inc.
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import socket
+import threading
+from datetime import timedelta
+from logging import getLogger
+from os import rename
+from os.path import getsize
+from time import time
+import XenAPI
+import onyxbackup.util as util
+
+class ExportProgress(object):
+    """
+        Progress of one running export updated from the bytes the backend
+        reports, the size of the backup file, and the progress of the XenAPI
+        task exporting the given uuid. Progress of an export logged to a
+        buffered job logger is logged unbuffered and labelled with its job
+    """
+
+    def __init__(self, job_type, job, target, file, uuid=None, logger=None):
+        self.job_type = job_type
+        self.job = job
+        self.target = target
+        self.file = file
+        self.uuid = uuid
+        self.logger = logger or getLogger(__name__)
+        self.live_logger = self.logger
+        self.label = ''
+        if isinstance(self.logger, util.BufferedLogger):
+            self.live_logger = self.logger.unbuffered
+            self.label = '{} {}: '.format(job, target) if target else '{}: '.format(job)
+        self.start = time()
+        self.reported = 0
+        self.total = 0
+        self.task_progress = 0.0
+        self.written = 0
+        self.rate = 0.0
+        self.last_change = self.start
+        self._last_sample = (self.start, 0)
+
+    def update(self, written, elapsed=None, total=0):
+        """
+            Progress callback of the backend with bytes exported so far and
+            total bytes to export where known
+        """
+        self.reported = written
+        if total:
+            self.total = total
+
+    def get_eta(self):
+        """
+            Get seconds until the export finishes at the average rate so far
+
+            @return Seconds or None if progress is unknown
+        """
+        percent = self.get_percent()
+        if not percent:
+            return None
+        return (time() - self.start) * (100 - percent) / percent
+
+    def get_percent(self):
+        if self.task_progress > 0:
+            return min(self.task_progress * 100, 100.0)
+        if self.total:
+            return min(self.written * 100.0 / self.total, 100.0)
+        return None
+
+    def get_status(self):
+        now = time()
+        eta = self.get_eta()
+        percent = self.get_percent()
+        return {'type': self.job_type, 'job': self.job, 'target': self.target, 'file': self.file,
+            'started': self.start, 'seconds': round(now - self.start, 1), 'bytes': self.written,
+            'total_bytes': self.total or None, 'percent': round(percent, 1) if percent is not None else None,
+            'mb_per_second': round(self.rate / 1048576, 2),
+            'average_mb_per_second': round(self.written / (now - self.start) / 1048576, 2) if now > self.start else 0.0,
+            'eta_seconds': int(eta) if eta is not None else None, 'stalled_seconds': int(now - self.last_change)}
+
+    def sample(self):
+        """
+            Take bytes written from what the backend reported or the size of
+            the backup file and update the current rate
+        """
+        try:
+            size = getsize(self.file)
+        except OSError:
+            size = 0
+        now = time()
+        written = max(self.reported, size)
+        last_time, last_written = self._last_sample
+        if now > last_time:
+            self.rate = (written - last_written) / (now - last_time)
+        if written != self.written:
+            self.last_change = now
+        self.written = written
+        self._last_sample = (now, written)
+
+class ProgressMonitor(object):
+    """
+        Thread logging progress, current rate, and ETA of running exports
+        every interval and writing them to a JSON status file so stalled
+        exports and slow SRs can be seen while a run is in progress. Progress
+        of the XenAPI tasks running exports is read with one call per
+        interval for all exports
+    """
+
+    def __init__(self, data_api, interval=60, status_file=''):
+        self.logger = getLogger(__name__)
+        self._h = util.Helper()
+        self._d = data_api
+        self._interval = interval
+        self._status_file = status_file
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._exports = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def close(self):
+        """
+            Stop reporting and write the status file without running exports
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self._write_status(True)
+
+    def finish(self, export):
+        """
+            Stop tracking the given export and log its final size and rate
+        """
+        with self._lock:
+            self._exports.remove(export)
+        export.sample()
+        elapsed = time() - export.start
+        rate = export.written / elapsed if elapsed else 0
+        export.logger.info('-> Exported {} ({}/s)'.format(self._h.get_size_string(export.written), self._h.get_size_string(rate)))
+        self._write_status()
+
+    def start(self, job_type, job, target, file, uuid=None, logger=None):
+        """
+            Start tracking an export to file of the VM or VDI with the given
+            uuid whose XenAPI task is polled for progress
+
+            @return ExportProgress to pass update() to the backend as progress
+        """
+        export = ExportProgress(job_type, job, target, file, uuid, logger)
+        with self._lock:
+            self._exports.append(export)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='export-progress')
+                self._thread.daemon = True
+                self._thread.start()
+        self._write_status()
+        return export
+
+    # Private Functions
+
+    def _get_task_progress(self, exports):
+        """
+            Get progress of the pending XenAPI task naming the uuid of each
+            export, which xe and the xenapi backend create for exports
+        """
+        uuids = dict((export.uuid, export) for export in exports if export.uuid)
+        if not uuids:
+            return {}
+        progress = {}
+        try:
+            for task in self._d.call('task.get_all_records').values():
+                if task.get('status') != 'pending':
+                    continue
+                label = '{} {}'.format(task.get('name_label', ''), task.get('name_description', ''))
+                for uuid in uuids:
+                    if uuid in label:
+                        progress[uuid] = float(task.get('progress', 0))
+        except (XenAPI.Failure, socket.error, IOError) as e:
+            self.logger.debug('(i) ---> Unable to get task progress: {}'.format(e))
+        return progress
+
+    def _log_progress(self, export):
+        message = '-> {}Exported {}'.format(export.label, self._h.get_size_string(export.written))
+        percent = export.get_percent()
+        details = []
+        if percent is not None:
+            details.append('{:.1f}%'.format(percent))
+        details.append('{}/s'.format(self._h.get_size_string(max(export.rate, 0))))
+        eta = export.get_eta()
+        if eta is not None:
+            details.append('ETA {}'.format(timedelta(seconds=int(eta))))
+        export.live_logger.info('{} ({})'.format(message, ', '.join(details)))
+        stalled = time() - export.last_change
+        if stalled >= self._interval:
+            export.live_logger.warning('(!) {}No data exported for {}'.format(export.label, timedelta(seconds=int(stalled))))
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            with self._lock:
+                exports = list(self._exports)
+            progress = self._get_task_progress(exports)
+            for export in exports:
+                export.task_progress = progress.get(export.uuid, export.task_progress)
+                export.sample()
+                self._log_progress(export)
+            self._write_status()
+
+    def _write_status(self, finished=False):
+        """
+            Write running exports to the status file through a temporary
+            file renamed over it. Writers from the monitor thread and from
+            finishing exports take turns so the temporary file is only
+            written by one of them at a time
+        """
+        if not self._status_file:
+            return
+        with self._write_lock:
+            with self._lock:
+                exports = [export.get_status() for export in self._exports]
+            status = {'updated': time(), 'finished': finished, 'interval': self._interval, 'exports': exports}
+            tmp_file = '{}.tmp'.format(self._status_file)
+            try:
+                with open(tmp_file, 'w') as f:
+                    json.dump(status, f, indent=2)
+                rename(tmp_file, self._status_file)
+            except (IOError, OSError) as e:
+                self.logger.debug('(i) ---> Unable to write status file: {}'.format(e))
@@ -20,22 +20,79 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import re
+import threading
 from datetime import datetime
+from functools import wraps
+from glob import glob
 from logging import getLogger
-from os import listdir
-from os.path import getmtime, join
+from multiprocessing.pool import ThreadPool
+from os.path import abspath, basename, dirname, exists, getsize, join, relpath
+from shutil import copyfileobj
 from collections import OrderedDict
 import onyxbackup.data as data
+import onyxbackup.store as store
 import onyxbackup.util as util
+from onyxbackup.service.backend import XeBackend, XenApiBackend
+from onyxbackup.service.progress import ProgressMonitor
+from time import time
+
+def phase(name):
+    """
+        Record time, bytes written, and result of a phase of the running job
+        in the run metrics. A phase returning False or raising has failed
+        and phases run from within another phase count towards the outer one
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if getattr(self._local, 'phase', None):
+                return func(self, *args, **kwargs)
+            self._local.phase = name
+            self._local.phase_bytes = 0
+            start = time()
+            result = False
+            try:
+                result = func(self, *args, **kwargs)
+                return result
+            finally:
+                self._local.phase = None
+                self._record_phase(name, time() - start, result is not False)
+        return wrapper
+    return decorator
 
 class XenApiService(object):
 
-    def __init__(self, config):
-        self.logger = getLogger(__name__)
+    def __init__(self, config, data_api=None, xe_path='/opt/xensource/bin'):
+        self._logger = getLogger(__name__)
+        self._local = threading.local()
+        self._status_lock = threading.Lock()
         self.config = config
         self._h = util.Helper()
-        self._d = data.XenLocal()
-        self._xe_path = '/opt/xensource/bin'
+        self._d = data_api or data.XenLocal()
+        self._inventory = data.Inventory(self._d)
+        self._xe_path = xe_path
+        self._store = None
+        if self.config['store_type'] == 'dedup':
+            self._store = store.ChunkStore(join(self.config['backup_dir'], '.chunks'))
+        self._catalog = store.Catalog(self.config['backup_dir'])
+        self._deleter = util.BackgroundDeleter(self.config['delete_interval'])
+        self._closed = False
+        self._teardown = None
+        if self.config['teardown_workers'] > 0:
+            self._teardown = util.SnapshotTeardown(self.config['teardown_workers'])
+        self._space = util.SpaceAdmission(self.config['backup_dir'], self.config['space_threshold'])
+        self._metrics = util.RunMetrics()
+        self._progress = ProgressMonitor(self._d, self.config['progress_interval'], self.config['status_file'])
+        self._backend = self._create_backend()
+        self._snapshots = {}
+
+    @property
+    def logger(self):
+        """
+            Logger for the current thread which is buffered per job when
+            running exports in parallel
+        """
+        return getattr(self._local, 'logger', None) or self._logger
 
     # API Functions
 
@@ -59,7 +116,7 @@ class XenApiService(object):
             backup_file = '{}/host_{}.xbk'.format(host_backup_dir, self._h.get_date_string())
             self.logger.debug('(i) Backup file: {}'.format(backup_file))
 
-            if not self._check_backup_space():
+            if not self._reserve_backup_space(self._get_history_size(host_backup_dir), [backup_file]):
                 self.logger.info(skip_message)
                 self._stop_task()
                 continue
@@ -74,7 +131,8 @@ class XenApiService(object):
                 self._stop_task()
                 continue
 
-            self._rotate_backups(self.config['max_backups'], host_backup_dir, False)
+            self._add_to_catalog(backup_file, None, 'host')
+            self._rotate_backups(self._get_retention(), host_backup_dir)
             self._add_status('success')
             self._stop_task()
         self._stop_function()
@@ -89,7 +147,7 @@ class XenApiService(object):
         backup_file = '{}/metadata_{}.db'.format(db_backup_dir, self._h.get_date_string())
         self.logger.debug('(i) Backup file: {}'.format(backup_file))
 
-        if not self._check_backup_space():
+        if not self._reserve_backup_space(self._get_history_size(db_backup_dir)):
             self.logger.info(skip_message)
             self._stop_function()
             return
@@ -104,7 +162,8 @@ class XenApiService(object):
             self._stop_function()
             return
 
-        self._rotate_backups(self.config['max_backups'], db_backup_dir, False)
+        self._add_to_catalog(backup_file, None, 'pool')
+        self._rotate_backups(self._get_retention(), db_backup_dir)
         self._add_status('success')
         self._stop_function()
 
@@ -113,8 +172,6 @@ class XenApiService(object):
             Run backups of just configured VM disks utilizing vdi-export
         """
         self._start_function('VDI-EXPORT')
-        skip_message = '-> Skipping VM due to error'
-        skip_message_disk = '-> Skipping disk due to error'
         vms = self.config['vdi_exports']
         self.logger.debug('(i) VMs: {}'.format(vms))
 
@@ -123,111 +180,9 @@ class XenApiService(object):
             self._stop_function()
             return
 
-        for value in vms:
-            values = value.split(':')
-            vm_name = values[0]
-            vm_backups = self.config['max_backups']
-            vdi_disks = ['xvda']
-            if (len(values) > 1) and not (values[1] == '-1'):
-                vm_backups = int(values[1])
-            if len(values) == 3:
-                vdi_disks[:] = []
-                vdi_disks += values[2].split(';')
-
-            self._start_task(vm_name)
-            self.logger.debug('(i) Name:{} Max-Backups:{} Disks:{}'.format(vm_name, vm_backups, vdi_disks))
-
-            if not vdi_disks:
-                self._add_status('error', '(!) No disks selected for backup')
-                self.logger.info(skip_message)
-                continue
-
-            if not self._check_backup_space():
-                self.logger.info(skip_message)
-                self._stop_task()
-                continue
-
-            vm_object = self._get_vm_by_name(vm_name)
-            if not vm_object:
-                self.logger.info(skip_message)
-                self._stop_task()
-                continue
-
-            vm_backup_dir = join(self.config['backup_dir'], vm_name)
-
-            if not self._verify_backup_dir(vm_backup_dir):
-                self.logger.info(skip_message)
-                self._stop_task()
-                continue
-
-            vm_meta = self._get_vm_record(vm_object)
-            if not vm_meta:
-                self.logger.info(skip_message)
-                self._stop_task()
-                continue
-
-            for disk in vdi_disks:
-                self._start_subtask(disk)
-
-                base = '{}/backup_{}_{}'.format(vm_backup_dir, disk, self._h.get_date_string())
-                meta_backup_file = '{}.meta'.format(base)
-                self.logger.debug('(i) meta_backup_file: {}'.format(meta_backup_file))
-                backup_file = '{}.{}'.format(base, self.config['vdi_export_format'])
-                self.logger.debug('(i) backup_file: {}'.format(backup_file))
-
-                if not self._check_backup_space():
-                    self.logger.info(skip_message_disk)
-                    self._stop_subtask()
-                    continue
-
-                vdi_data = self._backup_meta(vm_meta, meta_backup_file)
-                if not vdi_data:
-                    self.logger.info(skip_message_disk)
-                    self._stop_subtask()
-                    continue
-
-                self.logger.info('> Verifying disk is valid')
-                if disk in vdi_data:
-                    vdi_uuid = vdi_data[disk]
-                else:
-                    self._add_status('error', '(!) Invalid device specified')
-                    self._h.delete_file(meta_backup_file)
-                    self.logger.info(skip_message_disk)
-                    self._stop_subtask()
-                    continue
-
-                if not self._cleanup_snapshot(vdi_uuid, 'vdi'):
-                    self._h.delete_file(meta_backup_file)
-                    self.logger.info(skip_message_disk)
-                    self._stop_subtask()
-                    continue
-
-                snap_uuid = self._snapshot(vdi_uuid, 'vdi')
-                if not snap_uuid:
-                    self._h.delete_file(meta_backup_file)
-                    self.logger.info(skip_message_disk)
-                    self._stop_subtask()
-                    continue
-
-                if not self._prepare_snapshot(snap_uuid, 'vdi'):
-                    self._destroy_snapshot(snap_uuid, 'vdi')
-                    self._h.delete_file(meta_backup_file)
-                    self.logger.info(skip_message_disk)
-                    self._stop_subtask()
-                    continue
-
-                if not self._export_to_file(snap_uuid, backup_file, 'vdi'):
-                    self._destroy_snapshot(snap_uuid, 'vdi')
-                    self._h.delete_file(meta_backup_file)
-                    self.logger.info(skip_message_disk)
-                    self._stop_subtask()
-                    continue
-
-                self._destroy_snapshot(snap_uuid, 'vdi')
-                self._rotate_backups(vm_backups, vm_backup_dir)
-                self._add_status('success')
-                self._stop_subtask()
-            self._stop_task()
+        self._remove_stale_snapshots('vdi', vms)
+        self._run_jobs(self._backup_vdi_job, vms)
+        self._snapshots.pop('vdi', None)
         self._stop_function()
 
     def backup_vm(self):
@@ -235,7 +190,6 @@ class XenApiService(object):
             Run full backups of VMs utilizing vm-export
         """
         self._start_function('VM-EXPORT')
-        skip_message = '-> Skipping VM due to error'
         vms = self.config['vm_exports']
         self.logger.debug('(i) VMs: {}'.format(vms))
 
@@ -244,100 +198,178 @@ class XenApiService(object):
             self._stop_function()
             return
 
-        for value in vms:
-            values = value.split(':')
-            vm_name = values[0]
-            vm_backups = self.config['max_backups']
-            if (len(values) > 1) and not (values[1] == '-1'):
-                vm_backups = int(values[1])
-            snapshot_type = 'vm'
-
-            self._start_task(vm_name)
-            self.logger.debug('(i) Name:{} Max-Backups:{}'.format(vm_name, vm_backups))
+        self._remove_stale_snapshots('vm', vms)
+        self._run_jobs(self._backup_vm_job, vms, self._prepare_vm_backup)
+        self._snapshots.pop('vm', None)
+        self._stop_function()
 
-            vm_backup_dir = join(self.config['backup_dir'], vm_name)
-            base = '{}/backup_{}'.format(vm_backup_dir, self._h.get_date_string())
-            meta_backup_file = '{}.meta'.format(base)
-            self.logger.debug('(i) meta_backup_file:{}'.format(meta_backup_file))
-            if self.config['compress']:
-                backup_file = '{}.xva.gz'.format(base)
+    def close(self):
+        """
+            Log out of all XenAPI sessions used during the run and report
+            how many logins were needed for the API calls made. Only the
+            first call closes the service
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._teardown is not None:
+            self._teardown.finish()
+        stats = self._d.get_stats()
+        print('')
+        if self._teardown is not None:
+            if self._teardown.removed:
+                self.logger.info('Background teardown: {} snapshots removed'.format(self._teardown.removed))
+            for uuid, (job_type, job, target) in self._teardown.failed:
+                name = '{} {}'.format(job, target) if target else job
+                self._add_status('error', '(!) Failed to remove snapshot of {} ({}): {}'.format(name, job_type, uuid))
+        self.logger.info('XenAPI sessions: {} logins for {} API calls'.format(stats['logins'], stats['calls']))
+        for operation, (count, seconds) in sorted(self._backend.get_stats().items()):
+            self.logger.debug('(i) -> {} backend {}: {} calls in {:.2f}s'.format(self.config['backend'], operation, count, seconds))
+        if self._deleter.finish():
+            self.logger.info('Background deletion: {} old backup files deleted'.format(self._deleter.deleted))
+        for file in self._deleter.failed:
+            self._add_status('warning', '(!) Old backup file could not be deleted: {}'.format(file))
+        self._write_metrics()
+        self._progress.close()
+        self._d.logout()
+        self._catalog.close()
+        if self._store is not None:
+            self._store.close()
+
+    def extract_backup(self, backup_file, disk, file):
+        """
+            Extract ova.xml or the raw image of a single disk from a VM
+            backup reading only the part of the XVA holding it, using the
+            index of the backup. Backups without an index are indexed first
+            and the index is kept for later extractions
+
+            @return True if extracted
+        """
+        print('')
+        self.logger.info('> Extracting {} from {} to {}'.format(disk or 'ova.xml', backup_file, file))
+        backup_file = abspath(backup_file)
+        index = store.XvaIndex.load(backup_file)
+        if index is None:
+            self.logger.info('-> Indexing backup')
+            try:
+                index = store.XvaIndex.build(backup_file)
+            except (IOError, ValueError) as e:
+                self.logger.error('(!) Unable to index backup: {}'.format(e))
+                return False
+            if index.save(backup_file):
+                self._catalog.add_file('{}.index'.format(backup_file), backup_file, 'index')
+        if not index.complete:
+            self.logger.warning('(!) Backup is truncated, only data before its end can be extracted')
+        vdi = index.find_disk(disk) if disk else None
+        if disk and vdi is None:
+            disks = ['{} ({})'.format(name, values.get('device', '')) for name, values in sorted(index.disks.items())]
+            self.logger.error('(!) Disk {} not found in backup, disks are: {}'.format(disk, ', '.join(disks)))
+            return False
+        reader = store.XvaReader(backup_file, index)
+        try:
+            if vdi is None:
+                with open(file, 'wb') as ova_out:
+                    ova_out.write(reader.read_member('ova.xml'))
             else:
-                backup_file = '{}.xva'.format(base)
-            self.logger.debug('(i) backup_file:{}'.format(backup_file))
-
-            if not self._check_backup_space():
-                self.logger.info(skip_message)
-                self._stop_task()
-                continue
-
-            vm_object = self._get_vm_by_name(vm_name)
-            if not vm_object:
-                self.logger.info(skip_message)
-                self._stop_task()
-                continue
-
-            if not self._verify_backup_dir(vm_backup_dir):
-                self.logger.info(skip_message)
-                self._stop_task()
-                continue
-
-            vm_meta = self._get_vm_record(vm_object)
-            if not vm_meta:
-                self.logger.info(skip_message)
-                self._stop_task()
-                continue
-
-            if self._is_windows_vm(vm_meta['uuid']):
-                if self._is_quiesce_enabled(vm_meta):
-                    snapshot_type = 'vm-vss'
-
-            if not self._backup_meta(vm_meta, meta_backup_file):
-                self.logger.info(skip_message)
-                self._stop_task()
-                continue
-
-            if not self._cleanup_snapshot(vm_meta['uuid']):
-                self.logger.info(skip_message)
-                self._stop_task()
-                continue
-
-            snap_uuid = self._snapshot(vm_meta['uuid'], snapshot_type)
-            if not snap_uuid:
-                self._h.delete_file(meta_backup_file)
-                self.logger.info(skip_message)
-                self._stop_task()
-                continue
-
-            if not self._prepare_snapshot(snap_uuid):
-                self._destroy_snapshot(snap_uuid)
-                self._h.delete_file(meta_backup_file)
-                self.logger.info(skip_message)
-                self._stop_task()
-                continue
-
-            if not self._export_to_file(snap_uuid, backup_file):
-                self._uninstall_vm(snap_uuid)
-                self._h.delete_file(meta_backup_file)
-                self.logger.info(skip_message)
-                self._stop_task()
-                continue
+                extract_out = util.SparseFileSink(file)
+                try:
+                    reader.read_disk(vdi, extract_out)
+                    extract_out.finish()
+                except Exception:
+                    extract_out.abort()
+                    raise
+        finally:
+            reader.close()
+        self.logger.info('-> Extracted size: {}'.format(self._h.get_size_string(getsize(file))))
+        return True
 
-            self._uninstall_vm(snap_uuid)
-            self._rotate_backups(vm_backups, vm_backup_dir)
-            self._add_status('success')
-            self._stop_task()
-        self._stop_function()
+    def list_backups(self):
+        """
+            List backups recorded in the catalog with the space they use
+        """
+        print('')
+        self.logger.info('> Listing backups in {}'.format(self.config['backup_dir']))
+        total_backups = 0
+        total_size = 0
+        for path, count, size in self._catalog.get_directories():
+            self.logger.info('-> {}: {} backups ({})'.format(path, count, self._h.get_size_string(size)))
+            for backup in self._catalog.get_backups(path):
+                self.logger.info('--> {} {} ({})'.format(datetime.fromtimestamp(backup['created']).strftime('%Y-%m-%d %H:%M:%S'),
+                    basename(backup['file']), self._h.get_size_string(backup['size'])))
+            total_backups += count
+            total_size += size
+        self.logger.info('-> Total: {} backups ({})'.format(total_backups, self._h.get_size_string(total_size)))
 
     def process_vm_lists(self):
         """
             Aggregate lists of VMs configured and run specified actions on them
         """
+        self.logger.debug('(i) Loading pool inventory')
+        self._inventory.load()
         vm_lists = OrderedDict()
         vm_lists['excludes'] = list(self.config['excludes'])
         vm_lists['vdi_exports'] = list(self.config['vdi_exports'])
         vm_lists['vm_exports'] = list(self.config['vm_exports'])
         self._validate_vm_lists(vm_lists)
 
+    def rebuild_catalog(self):
+        """
+            Rebuild the backup catalog from the files in backup_dir
+        """
+        print('')
+        self.logger.info('> Rebuilding backup catalog')
+        backups = self._catalog.rebuild()
+        self.logger.info('-> Found {} backups'.format(backups))
+
+    def rebuild_store(self):
+        """
+            Recount chunk references of the deduplicated store from the
+            manifests in backup_dir and remove unreferenced chunks
+        """
+        print('')
+        self.logger.info('> Rebuilding chunk store index')
+        chunk_store = store.ChunkStore(join(self.config['backup_dir'], '.chunks'))
+        try:
+            removed, freed = chunk_store.rebuild_index(self.config['backup_dir'])
+        finally:
+            chunk_store.close()
+        self.logger.info('-> Removed {} unreferenced chunks ({})'.format(removed, self._h.get_size_string(freed)))
+
+    def restore_backup(self, backup_file, file):
+        """
+            Rebuild the exported file of a deduplicated backup from its
+            manifest, or the full raw disk image of an incremental backup by
+            applying the delta files of its chain in order, for use with
+            xe vm-import or vdi-import
+        """
+        print('')
+        self.logger.info('> Restoring {} to {}'.format(backup_file, file))
+        chain = self._get_delta_chain(backup_file)
+        chunk_store = store.ChunkStore(join(self.config['backup_dir'], '.chunks'))
+        # Raw disk images are restored as sparse files
+        if '.raw' in chain[0]:
+            restore_out = util.SparseFileSink(file)
+        else:
+            restore_out = util.FileSink(file)
+        try:
+            if chain[0].endswith('.manifest'):
+                chunk_store.restore(chain[0], restore_out)
+            else:
+                with open(chain[0], 'rb') as backup_in:
+                    copyfileobj(backup_in, restore_out, 4194304)
+            restore_out.finish()
+        except Exception:
+            restore_out.abort()
+            raise
+        finally:
+            chunk_store.close()
+        if chain[1:]:
+            with open(file, 'r+b') as restore_out:
+                for delta_file in chain[1:]:
+                    self.logger.info('-> Applying incremental backup: {}'.format(delta_file))
+                    util.DeltaReader(delta_file).apply(restore_out)
+        self.logger.info('-> Restored size: {}'.format(self._h.get_size_string(getsize(file))))
+
     def send_email(self):
         """
             Send email to configured recipient containing the report from
@@ -383,6 +415,41 @@ class XenApiService(object):
         except smtplib.SMTPException as e:
             self.logger.error('(!) Email report failed to send: {}'.format(str(e)))
 
+    def verify_backups(self):
+        """
+            Verify the backups found in backup_dir against their digest files
+            and check the structure of each backup and its metadata file on
+            a pool of verify_workers processes
+
+            @return True if no backup failed verification
+        """
+        self._start_function('VERIFY')
+        directories = self._catalog.find_backups()
+        verifier = store.BackupVerifier(join(self.config['backup_dir'], '.chunks'), self.config['verify_workers'],
+            self.config['verify_io_limit'], self.config['verify_threads'])
+        results = verifier.verify([backup for path, backups, orphans in directories for backup in backups])
+        for path, backups, orphans in directories:
+            self._start_task(relpath(path, self.config['backup_dir']))
+            for orphan in orphans:
+                self._add_status('warning', '(!) No backup for {}'.format(basename(orphan)))
+            for backup in backups:
+                result = next(results)
+                name = basename(result['file'])
+                for warning in result['warnings']:
+                    self._add_status('warning', '(!) {}: {}'.format(name, warning))
+                if result['errors']:
+                    self._add_status('error', '(!) Verification failed: {}'.format(name))
+                    for error in result['errors']:
+                        self.logger.error('(!) -> {}'.format(error))
+                    continue
+                rate = result['bytes'] / result['seconds'] if result['seconds'] else 0
+                self.logger.info('-> Verified {} ({} read, {}/s)'.format(name, self._h.get_size_string(result['bytes']),
+                    self._h.get_size_string(rate)))
+                self._add_status('success')
+            self._stop_task()
+        self._stop_function()
+        return self.status['error'] == 0
+
     # Private Functions
 
     def _add_status(self, status_type, message=''):
@@ -402,8 +469,25 @@ class XenApiService(object):
             self.logger.error('{} is not a valid status, defaulting to error'.format(status_type))
             self._add_status('error', message)
             return
-        self.status[status_type] += 1
 
+        job = getattr(self._local, 'job', None)
+        if job is not None:
+            job[status_type] += 1
+        else:
+            with self._status_lock:
+                self.status[status_type] += 1
+
+    def _add_to_catalog(self, file, meta_file=None, export_type='vm', vm_uuid=None, parent=None):
+        """
+            Record backup file and its metadata file in the catalog used
+            for rotation
+        """
+        if not self._catalog.add_backup(file, meta_file, export_type, vm_uuid, parent):
+            self._add_status('warning', '(!) Backup not added to catalog. Run --rebuild-catalog to add it: {}'.format(file))
+            return False
+        return True
+
+    @phase('metadata')
     def _backup_meta(self, vm, file):
         """
             Backup VM metadata of the given VM to given file
@@ -430,12 +514,12 @@ class XenApiService(object):
                 meta_out.write('\n')
 
                 for vbd in vm['VBDs']:
-                    vbd_record = self._d.get_vbd_record(vbd)
+                    vbd_record = self._inventory.get_record('VBD', vbd)
                     if vbd_record['type'].lower() != 'disk':
                         self.logger.debug('(i) -> Not a data disk... skipping: {}'.format(vbd_record['type']))
                         continue
 
-                    vdi_record = self._d.get_vdi_record(vbd_record['VDI'])
+                    vdi_record = self._inventory.get_record('VDI', vbd_record['VDI'])
                     self.logger.debug('(i) Storing VDI metadata: {}:{}'.format(vbd_record['device'], vdi_record['uuid']))
                     vdi_data[vbd_record['device']] = vdi_record['uuid']
 
@@ -456,15 +540,15 @@ class XenApiService(object):
                     meta_out.write('sharable={}\n'.format(vdi_record['sharable']))
                     meta_out.write('read_only={}\n'.format(vdi_record['read_only']))
                     meta_out.write('orig_uuid={}\n'.format(vdi_record['uuid']))
-                    sr_uuid = self._d.get_sr_record(vdi_record['SR'])['uuid']
+                    sr_uuid = self._inventory.get_sr_uuid(vbd_record['VDI'])
                     meta_out.write('orig_sr_uuid={}\n'.format(sr_uuid))
                     meta_out.write('\n')
 
                 for vif in vm['VIFs']:
-                    vif_record = self._d.get_vif_record(vif)
+                    vif_record = self._inventory.get_record('VIF', vif)
                     meta_out.write('******* VIF *******\n')
                     meta_out.write('device={}\n'.format(vif_record['device']))
-                    network_name = self._d.get_network_record(vif_record['network'])['name_label']
+                    network_name = self._inventory.get_record('network', vif_record['network'])['name_label']
                     meta_out.write('network_name_label={}\n'.format(network_name))
                     meta_out.write('MTU={}\n'.format(vif_record['MTU']))
                     meta_out.write('MAC={}\n'.format(vif_record['MAC']))
@@ -475,51 +559,158 @@ class XenApiService(object):
             self._add_status('error', '(!) Unable to open metadata backup file: {}'.format(file))
             return False
 
+        self._local.phase_bytes = getsize(file)
         self.logger.debug('(i) Retrieved VDI data: {}'.format(vdi_data))
         return vdi_data
 
-    def _check_backup_space(self):
+    def _backup_vdi_job(self, value):
         """
-            Check remaining disk space percentage for configured backup directory
-            against configured threshold
+            Run vdi-export of the configured disks for the VM in the given
+            vdi_exports entry
         """
-        self.logger.info('> Checking backup space')
-        percent_remaining = self._h.get_remaining_space(self.config['backup_dir'])
-        self.logger.debug('(i) -> Backup space remaining: {}%'.format(percent_remaining))
-        if percent_remaining < self.config['space_threshold']:
-            self._add_status('error', '(!) Space remaining is below threshold: {}%'.format(percent_remaining))
-            return False
-        return True
+        skip_message = '-> Skipping VM due to error'
+        values = value.split(':')
+        vm_name = values[0]
+        vm_retention = self._get_retention(values[1] if len(values) > 1 else '')
+        vdi_disks = ['xvda']
+        if len(values) == 3:
+            vdi_disks[:] = []
+            vdi_disks += values[2].split(';')
+
+        self._start_task(vm_name)
+        self.logger.debug('(i) Name:{} Retention:{} Disks:{}'.format(vm_name, self._get_retention_string(vm_retention), vdi_disks))
+
+        if not vdi_disks:
+            self._add_status('error', '(!) No disks selected for backup')
+            self.logger.info(skip_message)
+            self._stop_task()
+            return
+
+        vm_object = self._get_vm_by_name(vm_name)
+        if not vm_object:
+            self.logger.info(skip_message)
+            self._stop_task()
+            return
+
+        vm_backup_dir = join(self.config['backup_dir'], vm_name)
+
+        if not self._verify_backup_dir(vm_backup_dir):
+            self.logger.info(skip_message)
+            self._stop_task()
+            return
+
+        vm_meta = self._get_vm_record(vm_object)
+        if not vm_meta:
+            self.logger.info(skip_message)
+            self._stop_task()
+            return
+
+        if not self._reserve_backup_space(self._get_backup_estimate(vm_meta, vm_backup_dir, vdi_disks)):
+            self.logger.info(skip_message)
+            self._stop_task()
+            return
+
+        plans = [plan for plan in [self._prepare_vdi_backup(vm_meta, vm_backup_dir, disk) for disk in vdi_disks] if plan]
+        self._snapshot_vdis(plans)
+        plans = [plan for plan in plans if plan['snapshot']]
+        results = self._run_subtasks(self._export_vdi_backup, [(plan, vm_meta['uuid'], vm_backup_dir) for plan in plans])
+        if True in results:
+            self._rotate_backups(vm_retention, vm_backup_dir)
+        self._stop_task()
+
+    def _backup_vm_job(self, value, prefetched=None):
+        """
+            Run vm-export for the VM in the given vm_exports entry, using the
+            preparation of the VM prefetched by _run_pipelined_jobs() if given
+        """
+        skip_message = '-> Skipping VM due to error'
+        values = value.split(':')
+        vm_name = values[0]
+        vm_retention = self._get_retention(values[1] if len(values) > 1 else '')
+
+        self._start_task(vm_name)
+        self.logger.debug('(i) Name:{} Retention:{}'.format(vm_name, self._get_retention_string(vm_retention)))
 
+        if prefetched is None:
+            plan = self._prepare_vm_backup(vm_name)
+        else:
+            plan = self._take_prefetched(prefetched)
+        if not plan:
+            self.logger.info(skip_message)
+            self._stop_task()
+            return
+        vm_meta = plan['vm_meta']
+        vm_backup_dir = plan['backup_dir']
+        meta_backup_file = plan['meta_file']
+        backup_file = plan['backup_file']
+
+        if not self._reserve_backup_space(self._get_backup_estimate(vm_meta, vm_backup_dir), [backup_file]):
+            self._h.delete_file(meta_backup_file)
+            self.logger.info(skip_message)
+            self._stop_task()
+            return
+
+        snap_uuid = self._snapshot(vm_meta['uuid'], plan['snapshot_type'])
+        if not snap_uuid:
+            self._h.delete_file(meta_backup_file)
+            self.logger.info(skip_message)
+            self._stop_task()
+            return
+
+        if not self._prepare_snapshot(snap_uuid):
+            self._destroy_snapshot(snap_uuid)
+            self._h.delete_file(meta_backup_file)
+            self.logger.info(skip_message)
+            self._stop_task()
+            return
+
+        if not self._export_to_file(snap_uuid, backup_file):
+            self._teardown_snapshot(snap_uuid)
+            self._h.delete_file(meta_backup_file)
+            self.logger.info(skip_message)
+            self._stop_task()
+            return
+
+        self._teardown_snapshot(snap_uuid)
+        self._add_to_catalog(backup_file, meta_backup_file, 'vm', vm_meta['uuid'])
+        self._rotate_backups(vm_retention, vm_backup_dir)
+        self._add_status('success')
+        self._stop_task()
+
+    @phase('cleanup')
     def _cleanup_snapshot(self, uuid, snapshot_type='vm', snap_name='ONYXBACKUP'):
         self.logger.info('> Checking for snapshot from previous backup')
-        if snapshot_type == 'vm':
-            cmd = 'snapshot-list name-label="{}" snapshot-of={} params=uuid --minimal'.format(snap_name, uuid)
-        elif snapshot_type == 'vdi':
-            cmd = 'vdi-list name-label="{}" snapshot-of={} params=uuid --minimal'.format(snap_name, uuid)
-        else:
+        if snapshot_type not in ['vm', 'vdi']:
             self._add_status('error', '(!) Invalid snapshot type: {}'.format(snapshot_type))
             return False
 
-        snap_uuid = self._get_xe_cmd_result(cmd)
-        if snap_uuid:
-            self.logger.debug('(i) Snapshot found: {}'.format(uuid))
+        snaps = self._find_snapshots(uuid, snapshot_type, snap_name)
+        for snap_uuid in list(snaps):
+            self.logger.debug('(i) Snapshot found: {}'.format(snap_uuid))
             self.logger.info('-> Destroying snapshot')
-
-            if snapshot_type == 'vm':
-                cmd = 'snapshot-destroy uuid={}'.format(snap_uuid)
-            elif snapshot_type == 'vdi':
-                cmd = 'vdi-destroy uuid={}'.format(snap_uuid)
-            else:
-                self._add_status('error', '(!) Invalid snapshot type: {}'.format(snapshot_type))
-                return False
-
-            if not self._run_xe_cmd(cmd):
+            if not self._backend.destroy_snapshot(snap_uuid, snapshot_type):
                 self._add_status('error', '(!) Failed to destroy snapshot: {}'.format(snap_uuid))
                 return False
+            snaps.remove(snap_uuid)
             self.logger.info('-> Snapshot destroyed successfully')
         return True
 
+    def _create_backend(self):
+        """
+            Create backend for pool operations selected by backend option
+        """
+        xe_backend = XeBackend(self._xe_path)
+        if self.config['backend'] == 'xenapi':
+            self.logger.debug('(i) Using XenAPI backend')
+            buffer_size = self.config['export_buffer_size'] * 1024 * 1024
+            return XenApiBackend(self._d, xe_backend, buffer_size, self.config['export_buffers'],
+                self.config['compress_type'], self.config['compress_level'], self.config['compress_workers'],
+                self._store, self.config['vdi_sparse'], self.config['vdi_resume'], self.config['vdi_resume_retries'],
+                self.config['vdi_resume_segment'] * 1024 * 1024, self.config['checksum_type'] if self.config['checksum'] else None,
+                self.config['checksum_block_size'] * 1024 * 1024, self.config['checksum_sha256'], self.config['xva_index'], self._inventory)
+        self.logger.debug('(i) Using xe backend')
+        return xe_backend
+
     def _create_status(self):
         """
             Create status object to hold currently running functions and tasks
@@ -530,25 +721,55 @@ class XenApiService(object):
         self.status['warning'] = 0
         self.status['success'] = 0
 
+    @phase('uninstall')
     def _destroy_snapshot(self, uuid, snapshot_type='vm'):
         """
             Destroy the snapshot with the given uuid
         """
         self.logger.info('> Destroying snapshot')
 
-        if snapshot_type == 'vm':
-            cmd = 'snapshot-destroy uuid={}'.format(uuid)
-        elif snapshot_type == 'vdi':
-            cmd = 'vdi-destroy uuid={}'.format(uuid)
-        else:
+        if snapshot_type not in ['vm', 'vdi']:
             self._add_status('error', '(!) Invalid snapshot type: {}'.format(snapshot_type))
             return False
 
-        if not self._run_xe_cmd(cmd):
+        if not self._backend.destroy_snapshot(uuid, snapshot_type):
             self._add_status('error', '(!) Failed to destroy snapshot: {}'.format(uuid))
             return False
         return True
 
+    def _enable_cbt(self, uuid):
+        """
+            Enable changed block tracking on the VDI with the given uuid
+        """
+        self.logger.info('> Enabling changed block tracking')
+        if not self._backend.enable_cbt(uuid):
+            self._add_status('error', '(!) Failed to enable changed block tracking: {}'.format(uuid))
+            return False
+        return True
+
+    @phase('export')
+    def _export_changed_blocks(self, uuid, file, cbt_base):
+        """
+            Perform incremental backup of the VDI snapshot with the given uuid
+            to the specified delta file holding blocks changed since the
+            backup of the given CBT base
+        """
+        self.logger.info('> Exporting changed blocks of VDI')
+        export = self._progress.start(*self._get_job_labels(), file=file, uuid=uuid, logger=self.logger)
+        try:
+            exported = self._backend.export_changed_blocks(uuid, cbt_base['snapshot'], file,
+                cbt_base['backup_file'], export.update)
+        finally:
+            self._progress.finish(export)
+        if not exported:
+            self._add_status('error', '(!) Failed to export changed blocks of VDI')
+            return False
+        self._local.phase_bytes = getsize(file)
+        backup_file_size = self._h.get_file_size(file)
+        self.logger.info('-> Backup size: {}'.format(backup_file_size))
+        return True
+
+    @phase('export')
     def _export_to_file(self, id, file, export_type='vm'):
         """
             Perform backup of VM, VDI, Host, or POOL DB with given id to
@@ -556,25 +777,98 @@ class XenApiService(object):
         """
         self.logger.info('> Exporting {}'.format(export_type.upper()))
 
-        if export_type == 'vm':
-            cmd = 'vm-export uuid={} filename="{}" compress={}'.format(id, file, self.config['compress'])
-        elif export_type == 'vdi':
-            cmd = 'vdi-export uuid={} filename="{}" format={}'.format(id, file, self.config['vdi_export_format'])
-        elif export_type == 'pool':
-            cmd = 'pool-dump-database file-name="{}"'.format(file)
-        elif export_type == 'host':
-            cmd = 'host-backup host="{}" file-name="{}" enabled=true'.format(id, file)
-        else:
+        if export_type not in ['vm', 'vdi', 'pool', 'host']:
             self._add_status('error', '(!) Invalid export type: {}'.format(export_type))
             return False
 
-        if not self._run_xe_cmd(cmd):
+        compress = self.config['compress'] and export_type in ['vm', 'vdi']
+        uuid = id if export_type in ['vm', 'vdi'] else None
+        export = self._progress.start(*self._get_job_labels(), file=file, uuid=uuid, logger=self.logger)
+        try:
+            exported = self._backend.export(id, file, export_type, compress,
+                self.config['vdi_export_format'], export.update)
+        finally:
+            self._progress.finish(export)
+        if not exported:
             self._add_status('error', '(!) Failed to export {}'.format(export_type.upper()))
             return False
-        backup_file_size = self._h.get_file_size(file)
-        self.logger.info('-> Backup size: {}'.format(backup_file_size))
+        stored = self._store.get_stats(file) if self._store is not None else None
+        self._local.phase_bytes = stored[0] if stored else getsize(file)
+        if stored:
+            self.logger.info('-> Backup size: {} ({} new after deduplication)'.format(
+                self._h.get_size_string(stored[0]), self._h.get_size_string(stored[1])))
+        elif self.config['vdi_sparse'] and file.endswith('.raw'):
+            backup_file_size = self._h.get_file_size(file)
+            allocated = self._h.get_size_string(self._h.get_allocated_size(file))
+            self.logger.info('-> Backup size: {} ({} allocated)'.format(backup_file_size, allocated))
+        else:
+            backup_file_size = self._h.get_file_size(file)
+            self.logger.info('-> Backup size: {}'.format(backup_file_size))
         return True
 
+    def _export_vdi_backup(self, plan, vm_uuid, vm_backup_dir):
+        """
+            Export the snapshot of a disk prepared by _prepare_vdi_backup()
+            and _snapshot_vdis() as a subtask of the running vdi-export and
+            destroy the snapshot, or keep it for the next incremental backup
+
+            @return True if exported
+        """
+        skip_message_disk = '-> Skipping disk due to error'
+        self._start_subtask(plan['disk'])
+        snap_uuid = plan['snapshot']
+        meta_backup_file = plan['meta_file']
+        backup_file = plan['backup_file']
+        cbt_base = plan['cbt_base']
+        if not plan['resumed']:
+            if not self._prepare_snapshot(snap_uuid, 'vdi') or (self.config['cbt_enabled']
+                    and not self._write_cbt_meta(meta_backup_file, snap_uuid, backup_file, cbt_base)):
+                self._destroy_snapshot(snap_uuid, 'vdi')
+                self._h.delete_file(meta_backup_file)
+                self.logger.info(skip_message_disk)
+                self._stop_subtask()
+                return False
+
+        if cbt_base:
+            exported = self._export_changed_blocks(snap_uuid, backup_file, cbt_base)
+        else:
+            exported = self._export_to_file(snap_uuid, backup_file, 'vdi')
+        if not exported and util.ExportJournal.load(backup_file) is not None:
+            self.logger.info('-> Keeping snapshot to resume export on next backup')
+            self.logger.info(skip_message_disk)
+            self._stop_subtask()
+            return False
+        if not exported:
+            self._teardown_snapshot(snap_uuid, 'vdi')
+            self._h.delete_file(meta_backup_file)
+            self.logger.info(skip_message_disk)
+            self._stop_subtask()
+            return False
+
+        if self.config['cbt_enabled']:
+            self._save_cbt_base(plan['vdi_uuid'], snap_uuid)
+        else:
+            self._teardown_snapshot(snap_uuid, 'vdi')
+        parent = join(vm_backup_dir, cbt_base['backup_file']) if cbt_base else None
+        self._add_to_catalog(backup_file, meta_backup_file, 'vdi', vm_uuid, parent)
+        self._add_status('success')
+        self._stop_subtask()
+        return True
+
+    def _find_snapshots(self, uuid, snapshot_type='vm', snap_name='ONYXBACKUP'):
+        """
+            Find snapshots with the given name of the VM or VDI with the
+            given uuid in the snapshots found by _remove_stale_snapshots() at
+            the start of the running function, only querying the pool where
+            they were not listed
+
+            @return List of snapshot uuids
+        """
+        found = self._snapshots.get(snapshot_type) if snap_name == 'ONYXBACKUP' else None
+        if found is None:
+            return self._backend.find_snapshots(uuid, snapshot_type, snap_name)
+        return found.setdefault(uuid, [])
+
     def _get_all_hosts(self, as_list=True):
         """
             Get all hosts' hostnames in pool and by default return as a list
@@ -582,10 +876,9 @@ class XenApiService(object):
             @return List of hosts in pool or False if none
         """
         self.logger.info('> Getting all hosts')
-        cmd = 'host-list params=hostname --minimal'
-        hosts = self._get_xe_cmd_result(cmd)
-        if as_list:
-            hosts = hosts.split(',')
+        hosts = self._backend.get_all_hosts()
+        if not as_list:
+            hosts = ','.join(hosts)
         self.logger.debug('(i) -> Hosts: {}'.format(hosts))
         if len(hosts) == 0:
             self._add_status('error', '(!) No hosts returned from pool')
@@ -596,36 +889,286 @@ class XenApiService(object):
         """
             Get a list of all VMs in the pool and by default return as list
         """
-        cmd = 'vm-list is-control-domain=false is-a-snapshot=false params=name-label --minimal'
-        vms = self._get_xe_cmd_result(cmd)
-        if as_list:
-            vms = vms.split(',')
+        vms = self._inventory.get_vm_names()
+        if not as_list:
+            vms = ','.join(vms)
         self.logger.debug('(i) -> VMs in pool: {}'.format(vms))
-        if vms == ['']:
+        if not vms:
             raise RuntimeError('(!) No VMs in pool to backup')
         else:
             return vms
 
+    def _get_backup_chains(self, backups):
+        """
+            Group catalog backups sorted oldest first into chains of a full
+            backup followed by the incremental backups depending on it
+
+            @return List of chains oldest first
+        """
+        chains = []
+        chain_of = {}
+        for backup in backups:
+            chain = chain_of.get(backup['parent'])
+            if chain is None:
+                chain = []
+                chains.append(chain)
+            chain.append(backup)
+            chain_of[backup['file']] = chain
+        return chains
+
+    def _get_backup_estimate(self, vm, path, disks=None):
+        """
+            Estimate size of a vm-export of the given VM or a vdi-export of the
+            given disks from the space used by their VDIs (or the full size
+            of raw disks not written as sparse files). Compressed backups are
+            estimated from the size of the previous backups in path plus 10%
+            when smaller
+
+            @return Estimated size in bytes
+        """
+        raw = (disks is not None and self.config['vdi_export_format'] == 'raw' and
+            not (self.config['backend'] == 'xenapi' and self.config['vdi_sparse']))
+        estimate = 0
+        series = []
+        for vbd in vm['VBDs']:
+            vbd_record = self._inventory.get_record('VBD', vbd)
+            if vbd_record['type'].lower() != 'disk':
+                continue
+            if disks is not None and vbd_record['device'] not in disks:
+                continue
+            vdi_record = self._inventory.get_record('VDI', vbd_record['VDI'])
+            size = vdi_record['virtual_size'] if raw else vdi_record['physical_utilisation']
+            self.logger.debug('(i) -> Estimated size of {}: {}'.format(vbd_record['device'], self._h.get_size_string(size)))
+            estimate += int(size)
+            series.append('backup_{}'.format(vbd_record['device']) if disks is not None else 'backup')
+
+        if self.config['compress']:
+            history = self._get_history_size(path, sorted(set(series)))
+            if history is not None and history * 11 / 10 < estimate:
+                self.logger.debug('(i) -> Estimated size from previous backups: {}'.format(self._h.get_size_string(history)))
+                estimate = history * 11 / 10
+        return estimate
+
+    def _get_backup_extension(self, export_type='vm'):
+        """
+            Get file extension for backups of the given export type from the
+            export format, store type, and compression settings. VDI exports
+            are only compressed by the xenapi backend
+        """
+        if export_type == 'vm':
+            extension = 'xva'
+        else:
+            extension = self.config['vdi_export_format']
+        if self.config['store_type'] == 'dedup':
+            extension += '.manifest'
+        elif self.config['compress'] and (export_type == 'vm' or self.config['backend'] == 'xenapi'):
+            if self.config['compress_type'] == 'zstd':
+                extension += '.zst'
+            else:
+                extension += '.gz'
+        return extension
+
+    def _get_backup_series(self, file):
+        """
+            Get name of the given backup file without its date and extensions
+            (i.e. backup_xvda for backup_xvda_[date]-[time].raw)
+        """
+        return re.sub(r'_\d{8}-\d{6}\..*$', '', basename(file))
+
+    def _get_cbt_base(self, uuid, path, disk):
+        """
+            Check the last backup of the given disk at the given path for a
+            CBT snapshot to take an incremental backup against
+
+            @return Dictionary of CBT metadata of the last backup or None if
+            a full backup is needed
+        """
+        self.logger.info('> Checking for incremental backup base')
+        prefix = 'backup_{}_'.format(disk)
+        backups = [b for b in self._catalog.get_backups(path) if basename(b['file']).startswith(prefix) and b['meta_file']]
+        if not backups:
+            self.logger.info('-> No previous backup of disk, taking full backup')
+            return None
+
+        cbt_base = self._read_cbt_meta(backups[-1]['meta_file'])
+        self.logger.debug('(i) -> Previous backup CBT metadata: {}'.format(cbt_base))
+        if not cbt_base or cbt_base['backup_file'] != basename(backups[-1]['file']):
+            self.logger.info('-> Previous backup has no CBT snapshot, taking full backup')
+            return None
+        if int(cbt_base['chain_length']) >= self.config['cbt_full_interval']:
+            self.logger.info('-> Reached cbt_full_interval, taking full backup')
+            return None
+        if cbt_base['snapshot'] not in self._backend.find_snapshots(uuid, 'vdi', 'ONYXBACKUP-CBT'):
+            self.logger.info('-> CBT snapshot of previous backup no longer exists, taking full backup')
+            return None
+        self.logger.info('-> Taking incremental backup based on {}'.format(cbt_base['backup_file']))
+        return cbt_base
+
+    def _get_delta_chain(self, file):
+        """
+            Follow parents of the given delta file back to its full backup
+
+            @return List of backup files starting with the full backup
+        """
+        chain = [file]
+        while chain[0].endswith('.delta'):
+            parent = join(dirname(chain[0]), util.DeltaReader(chain[0]).parent)
+            if not exists(parent):
+                raise IOError('(!) {} depends on missing backup: {}'.format(chain[0], parent))
+            chain.insert(0, parent)
+        return chain
+
+    def _get_gfs_backups(self, backups, retention):
+        """
+            Select the newest backup of each day, week, and month to keep for
+            each disk (or VM) in the given catalog backups sorted oldest first
+
+            @return Set of backup files to keep
+        """
+        periods = [(retention['keep_daily'], 'day'), (retention['keep_weekly'], 'week'),
+            (retention['keep_monthly'], 'month')]
+        series = OrderedDict()
+        for backup in backups:
+            series.setdefault(self._get_backup_series(backup['file']), []).append(backup)
+
+        keep = set()
+        for name, series_backups in series.items():
+            for count, period_type in periods:
+                periods_seen = []
+                for backup in reversed(series_backups):
+                    if len(periods_seen) >= count:
+                        break
+                    period = self._get_period(backup['created'], period_type)
+                    if period not in periods_seen:
+                        periods_seen.append(period)
+                        keep.add(backup['file'])
+                        self.logger.debug('(i) -> Keeping {} backup for {}: {}'.format(name, period, basename(backup['file'])))
+        return keep
+
+    def _get_history_size(self, path, series=None):
+        """
+            Get total size of the newest full backup of each of the given
+            series in the catalog for path, or of the newest backup in path
+
+            @return Size in bytes, 0 without any backup in path, or None
+                if a series has no full backup
+        """
+        backups = [b for b in self._catalog.get_backups(path) if not b['file'].endswith('.delta')]
+        if not series:
+            return backups[-1]['size'] if backups else 0
+        size = 0
+        for name in series:
+            sizes = [b['size'] for b in backups if self._get_backup_series(b['file']) == name]
+            if not sizes:
+                return None
+            size += sizes[-1]
+        return size
+
+    def _get_export_journal(self, path, disk, vdi_uuid):
+        """
+            Find the journal of an unfinished raw export of the given disk
+            left by a previous backup. It is resumed if vdi_resume is enabled
+            and its snapshot still exists, otherwise the partial export and
+            its metadata backup file are deleted
+
+            @return ExportJournal to resume or None
+        """
+        resumable = None
+        for journal_file in sorted(glob(join(path, 'backup_{}_*.journal'.format(disk)))):
+            journal = util.ExportJournal.load(journal_file[:-len('.journal')])
+            if journal is None:
+                continue
+            if self.config['vdi_resume'] and resumable is None:
+                self.logger.debug('(i) -> Found unfinished export of snapshot: {}'.format(journal.snapshot))
+                if journal.snapshot in self._find_snapshots(vdi_uuid, 'vdi'):
+                    resumable = journal
+                    continue
+            self.logger.info('-> Removing unfinished export: {}'.format(journal.image_file))
+            self._h.delete_file(self._get_meta_file(journal.image_file))
+            try:
+                journal.discard()
+            except OSError as e:
+                self._add_status('warning', '(!) Unable to remove unfinished export: {}'.format(e))
+        return resumable
+
+    def _get_job_labels(self):
+        """
+            Get type of the running function, name of the running job, and
+            the disk of vdi-exports used to label metrics and progress where
+            pool backups run without a job
+
+            @return Tuple of type, job, and target
+        """
+        job = getattr(self._local, 'job', None)
+        if job is None:
+            return (self.status['function'].lower(), 'pool', '')
+        return (self.status['function'].lower(), job['task'], job['subtask'] or '')
+
+    def _get_meta_file(self, file):
+        """
+            Get metadata backup file paired with the given backup file by the
+            name before the first extension
+        """
+        return join(dirname(file), '{}.meta'.format(basename(file).split('.', 1)[0]))
+
     def _get_os_version(self, uuid):
         """
             Get OS version of VM and trim to just show the 'name' portion
         """
-        cmd = 'vm-list uuid={} params=os-version --minimal'.format(uuid)
-        os_version = self._get_xe_cmd_result(cmd)
+        os_version = self._inventory.get_os_version(self._inventory.get_ref('VM', uuid))
         if os_version:
-            os_version = re.split('[;:|]', os_version)[1][1:]
             self.logger.debug('(i) -> OS version: {}'.format(os_version))
             return os_version
         else:
             self.logger.debug('(i) -> OS version empty')
             return 'EMPTY'
 
+    def _get_period(self, created, period_type='day'):
+        """
+            Get the day, ISO week, or month of the given creation time
+        """
+        created = datetime.fromtimestamp(created)
+        if period_type == 'week':
+            year, week, weekday = created.isocalendar()
+            return '{:04d}-W{:02d}'.format(year, week)
+        elif period_type == 'month':
+            return created.strftime('%Y-%m')
+        return created.strftime('%Y-%m-%d')
+
+    def _get_retention(self, value=''):
+        """
+            Get retention for a vm_exports or vdi_exports entry field of the
+            form max_backups[/keep_daily/keep_weekly/keep_monthly] where -1 or
+            a missing value leaves the configured setting
+
+            @return Dict of max_backups, keep_daily, keep_weekly, and keep_monthly
+        """
+        keys = ['max_backups', 'keep_daily', 'keep_weekly', 'keep_monthly']
+        retention = dict((key, self.config[key]) for key in keys)
+        values = value.split('/') if value else []
+        if len(values) > len(keys):
+            raise ValueError('(!) retention has too many values')
+        for key, text in zip(keys, values):
+            try:
+                number = int(text)
+            except ValueError:
+                raise ValueError('(!) {} non-integer'.format(key))
+            if number == -1:
+                continue
+            if number < 0 or (key == 'max_backups' and number == 0):
+                raise ValueError('(!) {} out of range'.format(key))
+            retention[key] = number
+        return retention
+
+    def _get_retention_string(self, retention):
+        return 'last {max_backups}, daily {keep_daily}, weekly {keep_weekly}, monthly {keep_monthly}'.format(**retention)
+
     def _get_vm_by_name(self, name):
         """
             Retrieve VM record by name-label
         """
         self.logger.info('> Querying VM by name')
-        vm = self._d.get_vm_by_name(name)
+        vm = self._inventory.get_vms_by_name(name)
         vm_object = None
         # Return nothing if more than one VM has same name since backups are done via name-label
         if len(vm) == 0:
@@ -641,28 +1184,12 @@ class XenApiService(object):
             Get VM record given a VM object
         """
         self.logger.info('> Getting VM metadata')
-        vm_meta = self._d.get_vm_record(vm)
+        vm_meta = self._inventory.get_record('VM', vm)
         if not vm_meta:
             self._add_status('error', '(!) No VM record returned')
             return False
         return vm_meta
 
-    def _get_xe_cmd_result(self, cmd):
-        """
-            Run a given command with xe and return the resulting stdout/stderr
-        """
-        cmd = '{}/xe {}'.format(self._xe_path, cmd)
-        output = ''
-        try:
-            output = self._h.get_cmd_result(cmd)
-            if output == '':
-                self.logger.debug('(i) ---> Command returned no output')
-            else:
-                self.logger.debug('(i) ---> Command output: {}'.format(output))
-        except OSError as e:
-            self.logger.error('(!) Unable to run command: {}'.format(e))
-        return output
-
     def _is_quiesce_enabled(self, vm):
         """
             Checks VM record allowed operations to determine if VSS
@@ -676,16 +1203,6 @@ class XenApiService(object):
         else:
             return False
 
-    def _is_vm_name(self, text):
-        """
-            Check if text is a valid simple VM name containing only letters,
-            numbers, spaces, underscores, and hyphens
-        """
-        if re.match('^[\w\s]+$', text) is not None:
-            return True
-        else:
-            return False
-
     def _is_valid_regex(self, text):
         """
             Check if text is a valid regular expression
@@ -710,26 +1227,150 @@ class XenApiService(object):
         else:
             return False
 
+    def _prefetch_job(self, prepare, value):
+        """
+            Run the given preparation of a job on the lookahead thread of
+            _run_pipelined_jobs() with its log output and status counts held
+            for the job
+
+            @return Tuple of the result of the preparation, its logger, and
+            its status counts
+        """
+        self._local.logger = util.BufferedLogger(self._logger)
+        self._local.job = {'task': value.split(':')[0], 'subtask': None, 'reservation': None,
+            'error': 0, 'warning': 0, 'success': 0}
+        try:
+            return (prepare(value.split(':')[0]), self._local.logger, self._local.job)
+        finally:
+            self._local.logger = None
+            self._local.job = None
 
+    @phase('prepare')
     def _prepare_snapshot(self, uuid, snapshot_type='vm', snap_name='ONYXBACKUP'):
         """
             Prepare snapshot with given uuid for backup
         """
         self.logger.info('> Preparing snapshot for backup')
 
-        if snapshot_type == 'vm':
-            cmd = 'template-param-set is-a-template=false ha-always-run=false uuid={}'.format(uuid)
-        elif snapshot_type == 'vdi':
-            cmd = 'vdi-param-set uuid={} name-label="{}"'.format(uuid, snap_name)
-        else:
+        if snapshot_type not in ['vm', 'vdi']:
             self._add_status('error', '(!) Invalid snapshot type: {}'.format(snapshot_type))
             return False
 
-        if not self._run_xe_cmd(cmd):
+        if not self._backend.prepare_snapshot(uuid, snapshot_type, snap_name):
             self._add_status('error', '(!) Failed to prepare snapshot: {}'.format(uuid))
             return False
         return True
 
+    def _prepare_vdi_backup(self, vm_meta, vm_backup_dir, disk):
+        """
+            Back up the VM metadata for a disk of a vdi-export and work out
+            the file it is exported to, continuing an unfinished export of
+            the disk from a previous backup on its snapshot where possible.
+            The snapshot kept by the previous backup is removed otherwise
+
+            @return Dictionary with disk, vdi_uuid, meta_file, backup_file,
+            cbt_base, snapshot (of a resumed export), and resumed of the disk
+            or None if failed
+        """
+        skip_message_disk = '-> Skipping disk due to error'
+        self.logger.info('> Preparing disk {}'.format(disk))
+        # Phases run for the disk are labeled with it in the metrics
+        self._local.job['subtask'] = disk
+        try:
+            base = '{}/backup_{}_{}'.format(vm_backup_dir, disk, self._h.get_date_string())
+            meta_backup_file = '{}.meta'.format(base)
+            self.logger.debug('(i) meta_backup_file: {}'.format(meta_backup_file))
+            backup_file = '{}.{}'.format(base, self._get_backup_extension('vdi'))
+            self.logger.debug('(i) backup_file: {}'.format(backup_file))
+
+            vdi_data = self._backup_meta(vm_meta, meta_backup_file)
+            if not vdi_data:
+                self.logger.info(skip_message_disk)
+                return None
+
+            self.logger.info('> Verifying disk is valid')
+            if disk not in vdi_data:
+                self._add_status('error', '(!) Invalid device specified: {}'.format(disk))
+                self._h.delete_file(meta_backup_file)
+                self.logger.info(skip_message_disk)
+                return None
+            vdi_uuid = vdi_data[disk]
+
+            cbt_base = None
+            if self.config['cbt_enabled']:
+                if not self._enable_cbt(vdi_uuid):
+                    self._h.delete_file(meta_backup_file)
+                    self.logger.info(skip_message_disk)
+                    return None
+                cbt_base = self._get_cbt_base(vdi_uuid, vm_backup_dir, disk)
+
+            snap_uuid = None
+            journal = self._get_export_journal(vm_backup_dir, disk, vdi_uuid)
+            if journal is not None:
+                self.logger.info('> Resuming export of snapshot from previous backup')
+                backup_file = journal.image_file
+                if self._get_meta_file(backup_file) != meta_backup_file:
+                    self._h.delete_file(meta_backup_file)
+                    meta_backup_file = self._get_meta_file(backup_file)
+                snap_uuid = journal.snapshot
+                cbt_base = None
+                self.logger.debug('(i) backup_file: {}'.format(backup_file))
+            else:
+                if cbt_base:
+                    backup_file = '{}.{}.delta'.format(base, self.config['vdi_export_format'])
+                    self.logger.debug('(i) backup_file: {}'.format(backup_file))
+                if not self._cleanup_snapshot(vdi_uuid, 'vdi'):
+                    self._h.delete_file(meta_backup_file)
+                    self.logger.info(skip_message_disk)
+                    return None
+            self._local.job['reservation'].add_file(backup_file)
+        finally:
+            self._local.job['subtask'] = None
+        return {'disk': disk, 'vdi_uuid': vdi_uuid, 'meta_file': meta_backup_file, 'backup_file': backup_file,
+            'cbt_base': cbt_base, 'snapshot': snap_uuid, 'resumed': journal is not None}
+
+    def _prepare_vm_backup(self, vm_name):
+        """
+            Look up the VM with the given name, back up its metadata, remove
+            the snapshot kept from a previous backup, and check whether it can
+            be snapshotted with VSS, leaving only the snapshot and export to
+            the vm-export itself
+
+            @return Dictionary with vm_meta, backup_dir, meta_file,
+            backup_file, and snapshot_type of the VM or None if failed
+        """
+        vm_backup_dir = join(self.config['backup_dir'], vm_name)
+        base = '{}/backup_{}'.format(vm_backup_dir, self._h.get_date_string())
+        meta_backup_file = '{}.meta'.format(base)
+        self.logger.debug('(i) meta_backup_file:{}'.format(meta_backup_file))
+        backup_file = '{}.{}'.format(base, self._get_backup_extension('vm'))
+        self.logger.debug('(i) backup_file:{}'.format(backup_file))
+
+        vm_object = self._get_vm_by_name(vm_name)
+        if not vm_object:
+            return None
+
+        if not self._verify_backup_dir(vm_backup_dir):
+            return None
+
+        vm_meta = self._get_vm_record(vm_object)
+        if not vm_meta:
+            return None
+
+        snapshot_type = 'vm'
+        if self._is_windows_vm(vm_meta['uuid']):
+            if self._is_quiesce_enabled(vm_meta):
+                snapshot_type = 'vm-vss'
+
+        if not self._backup_meta(vm_meta, meta_backup_file):
+            return None
+
+        if not self._cleanup_snapshot(vm_meta['uuid']):
+            self._h.delete_file(meta_backup_file)
+            return None
+        return {'vm_meta': vm_meta, 'backup_dir': vm_backup_dir, 'meta_file': meta_backup_file,
+            'backup_file': backup_file, 'snapshot_type': snapshot_type}
+
     def _print_function_footer(self, title):
         """
             Print the footer of a named function in the logs
@@ -766,54 +1407,295 @@ class XenApiService(object):
         """
             Print the header of a named task in the logs
         """
-        print('')
+        if not isinstance(self.logger, util.BufferedLogger):
+            print('')
         self.logger.info('--- {} started at {} ---'.format(title, self._h.get_time_string(start)))
 
-    def _rotate_backups(self, max, path, vm_type=True):
+    def _record_phase(self, name, seconds, success):
+        """
+            Add a phase of the running job to the run metrics where pool
+            backups run without a job. Phases run outside of a function are
+            not recorded
+        """
+        if not getattr(self, 'status', {}).get('function'):
+            return
+        job_type, job, target = self._get_job_labels()
+        self._metrics.add_phase(job_type, job, target, name, seconds, self._local.phase_bytes, success)
+
+    def _record_teardown(self, labels, seconds, success):
+        """
+            Add a snapshot removed in the background after the export of the
+            job with the given labels to the run metrics as its uninstall phase
+        """
+        job_type, job, target = labels
+        self._metrics.add_phase(job_type, job, target, 'uninstall', seconds, 0, success)
+
+    def _read_cbt_meta(self, file):
+        """
+            Read CBT section written to the given metadata backup file
+
+            @return Dictionary of CBT metadata or empty if there is none
+        """
+        cbt_meta = {}
+        in_section = False
+        try:
+            with open(file) as meta_in:
+                for line in meta_in:
+                    line = line.strip()
+                    if line.startswith('*******'):
+                        in_section = (line == '******* CBT *******')
+                    elif in_section and '=' in line:
+                        key, value = line.split('=', 1)
+                        cbt_meta[key] = value
+        except IOError as e:
+            self.logger.debug('(i) -> Unable to read metadata backup file: {}'.format(e))
+        return cbt_meta
+
+    def _remove_stale_snapshots(self, snapshot_type, entries):
+        """
+            List all snapshots in the pool left by previous backups with a
+            single query and destroy those of the VMs or disks in the given
+            vm_exports or vdi_exports entries concurrently, keeping snapshots
+            of unfinished vdi-exports to resume. Jobs then look up snapshots
+            with _find_snapshots() instead of querying the pool for each VM
         """
-            Rotate backups at the given path deleting backups over the given max.
-            Defaults to handling VM backups which are handled in pairs with
-            metadata backup files
+        self.logger.info('> Checking for snapshots from previous backups')
+        found = self._backend.find_all_snapshots(snapshot_type)
+        if found is None:
+            self.logger.info('-> Unable to list snapshots, checking each {} instead'.format(snapshot_type.upper()))
+            return
+        self._snapshots[snapshot_type] = found
+        self.logger.debug('(i) -> Found {} snapshots'.format(sum(len(snaps) for snaps in found.values())))
+
+        keep = set()
+        if snapshot_type == 'vdi' and self.config['vdi_resume']:
+            for entry in entries:
+                for journal_file in glob(join(self.config['backup_dir'], entry.split(':')[0], 'backup_*.journal')):
+                    journal = util.ExportJournal.load(journal_file[:-len('.journal')])
+                    if journal is not None:
+                        keep.add(journal.snapshot)
+
+        parents = []
+        for entry in entries:
+            values = entry.split(':')
+            vms = self._inventory.get_vms_by_name(values[0])
+            if len(vms) != 1:
+                continue
+            vm = self._inventory.get_record('VM', vms[0])
+            if snapshot_type == 'vm':
+                parents.append(vm['uuid'])
+                continue
+            disks = values[2].split(';') if len(values) == 3 else ['xvda']
+            for vbd in vm['VBDs']:
+                vbd_record = self._inventory.get_record('VBD', vbd)
+                if vbd_record['device'] in disks and vbd_record['VDI'] != 'OpaqueRef:NULL':
+                    parents.append(self._inventory.get_record('VDI', vbd_record['VDI'])['uuid'])
+        stale = [(parent, snap) for parent in parents for snap in found.get(parent, []) if snap not in keep]
+        if not stale:
+            return
+
+        # Destroying a snapshot is a single short call, so a few at a time
+        # is enough while keeping the load on xapi low
+        self.logger.info('-> Destroying {} snapshots'.format(len(stale)))
+        pool = ThreadPool(min(len(stale), 4))
+        try:
+            results = pool.map(lambda item: self._backend.destroy_snapshot(item[1], snapshot_type), stale)
+        finally:
+            pool.close()
+            pool.join()
+        for (parent, snap), destroyed in zip(stale, results):
+            if destroyed:
+                found[parent].remove(snap)
+            else:
+                self.logger.debug('(i) -> Failed to destroy snapshot, retrying with its backup: {}'.format(snap))
+        self.logger.info('-> {} snapshots destroyed successfully'.format(results.count(True)))
+
+    def _reserve_backup_space(self, size, files=None):
+        """
+            Reserve space for a backup of the given estimated size which must
+            fit in the free space of the backup directory along with the space
+            reserved by running exports while leaving space_threshold percent
+            free. The reservation is held until the running task stops and
+            counts the space used by the given files as written
+
+            @return True if space was reserved or False if the backup does
+                not fit
+        """
+        self.logger.info('> Checking backup space')
+        free, total = self._space.get_usage()
+        self.logger.debug('(i) -> Backup space remaining: {} of {}'.format(self._h.get_size_string(free), self._h.get_size_string(total)))
+        self.logger.debug('(i) -> Estimated backup size: {}'.format(self._h.get_size_string(size)))
+        reservation = self._space.reserve(size)
+        if reservation is None:
+            self._add_status('error', '(!) Not enough space for estimated backup size {} leaving {}% free: {} remaining, {} reserved'.format(
+                self._h.get_size_string(size), self.config['space_threshold'], self._h.get_size_string(free),
+                self._h.get_size_string(self._space.get_reserved())))
+            return False
+        for file in files or []:
+            reservation.add_file(file)
+
+        job = getattr(self._local, 'job', None)
+        if job is None:
+            self._space.release(reservation)
+        else:
+            job['reservation'] = reservation
+        return True
+
+    @phase('rotate')
+    def _rotate_backups(self, retention, path):
+        """
+            Rotate backups recorded in the catalog for the given path keeping
+            the newest max_backups backups along with the newest backup of
+            each of the last keep_daily days, keep_weekly weeks, and
+            keep_monthly months of each disk. Other backups and their metadata
+            backup and digest files are removed from the catalog and queued for deletion
+            in the background. A full backup is only deleted together with the
+            incremental backups depending on it once none of them are kept
         """
         self.logger.info('> Rotating backups')
         self.logger.debug('(i) -> Path to check for backups: {}'.format(path))
-        self.logger.debug('(i) -> Maximum backups to keep: {}'.format(max))
-        files = [join(path, f) for f in listdir(path)]
-        backups = len(files)
-        if vm_type:
-            if not len(files) % 2 == 0:
-                self._add_status('error', '(!) Orphaned backup/meta files detected. Please remove orphaned files from {}.'.format(path))
-                return False
-            backups = len(files) / 2
-        self.logger.debug('(i) -> Total backups found: {}'.format(backups))
-        files = sorted(files, key=getmtime)
-        while (backups > max and backups > 1):
-            if vm_type:
-                meta_file = files.pop(0)
-                self.logger.info('-> Removing old metadata backup: {}'.format(meta_file))
-                self._h.delete_file(meta_file)
-            backup_file = files.pop(0)
-            self.logger.info('-> Removing old backup: {}'.format(backup_file))
-            self._h.delete_file(backup_file)
-            backups -= 1
+        self.logger.debug('(i) -> Retention: {}'.format(self._get_retention_string(retention)))
+        catalog_backups = self._catalog.get_backups(path)
+        self.logger.debug('(i) -> Total backups found: {}'.format(len(catalog_backups)))
+        keep = set(backup['file'] for backup in catalog_backups[-retention['max_backups']:])
+        keep.update(self._get_gfs_backups(catalog_backups, retention))
+        chains = self._get_backup_chains(catalog_backups)
+        for chain in chains:
+            if [backup for backup in chain if backup['file'] in keep]:
+                continue
+            for backup in chain:
+                if backup['meta_file']:
+                    self.logger.info('-> Removing old metadata backup: {}'.format(backup['meta_file']))
+                    self._deleter.delete(backup['meta_file'])
+                if backup['digest_file']:
+                    self._deleter.delete(backup['digest_file'])
+                if backup['index_file']:
+                    self._deleter.delete(backup['index_file'])
+                self.logger.info('-> Removing old backup: {}'.format(backup['file']))
+                self._catalog.remove_backup(backup['file'])
+                if backup['file'].endswith('.manifest') and self._store is not None:
+                    self._deleter.delete(backup['file'], self._store.remove_manifest)
+                else:
+                    self._deleter.delete(backup['file'])
         return True
 
-    def _run_xe_cmd(self, cmd):
+    def _run_buffered_job(self, job, value):
         """
-            Run the given command with xe and report only success or failure
+            Run the given job on a worker thread holding its log output until
+            the job completes so the report is grouped by job
         """
-        cmd = '{}/xe {}'.format(self._xe_path, cmd)
+        self._local.logger = util.BufferedLogger(self._logger)
         try:
-            result = self._h.run_cmd(cmd)
-            if result <> 0:
-                self.logger.debug('(i) ---> Command returned non-zero exit status')
-            else:
-                self.logger.debug('(i) ---> Command successful')
-                return True
-        except OSError as e:
-            self.logger.error('(!) Unable to run command: {}'.format(e))
-        return False
+            job(value)
+        finally:
+            self._local.logger.flush()
+            self._local.logger = None
+            self._local.job = None
+
+    def _run_buffered_subtask(self, job, logger, subtask, value):
+        """
+            Run the given subtask of a job on a worker thread with status
+            counts of its own and its log output held until it completes
 
+            @return Tuple of the result of the subtask and its status counts
+        """
+        self._local.logger = util.BufferedLogger(logger)
+        self._local.job = dict(job, error=0, warning=0, success=0)
+        try:
+            return (subtask(*value), self._local.job)
+        finally:
+            self._local.logger.flush()
+            self._local.logger = None
+            self._local.job = None
+
+    def _run_jobs(self, job, values, prepare=None):
+        """
+            Run the given job for each value either in order or concurrently
+            on a pool of max_parallel_exports worker threads. Jobs run in order
+            are pipelined with the given preparation of the next job if any
+        """
+        workers = min(self.config['max_parallel_exports'], len(values))
+        if workers <= 1 and prepare and len(values) > 1:
+            self._run_pipelined_jobs(job, prepare, values)
+            return
+        if workers <= 1:
+            for value in values:
+                job(value)
+            return
+
+        self.logger.info('(i) Running {} jobs with {} parallel workers'.format(len(values), workers))
+        pool = ThreadPool(workers)
+        try:
+            results = [pool.apply_async(self._run_buffered_job, (job, value)) for value in values]
+            for result in results:
+                result.get()
+        finally:
+            pool.close()
+            pool.join()
+
+    def _run_pipelined_jobs(self, job, prepare, values):
+        """
+            Run the given job for each value in order while the given
+            preparation of the job for the next value runs on a lookahead
+            thread, so looking up the next VM, backing up its metadata, and
+            removing its old snapshot overlap with the running export. The
+            snapshot itself is still taken by the job just before exporting
+        """
+        pool = ThreadPool(1)
+        try:
+            pending = pool.apply_async(self._prefetch_job, (prepare, values[0]))
+            for i, value in enumerate(values):
+                prefetched = pending.get()
+                if i + 1 < len(values):
+                    pending = pool.apply_async(self._prefetch_job, (prepare, values[i + 1]))
+                job(value, prefetched)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _run_subtasks(self, subtask, values):
+        """
+            Run the given subtask of the running job for each tuple of
+            arguments either in order or concurrently on a pool of
+            max_parallel_disks worker threads, adding their status counts to
+            the job
+
+            @return List of the results of the subtask
+        """
+        workers = min(self.config['max_parallel_disks'], len(values))
+        if workers <= 1:
+            return [subtask(*value) for value in values]
+
+        self.logger.info('(i) Running {} disk exports with {} parallel workers'.format(len(values), workers))
+        job = self._local.job
+        pool = ThreadPool(workers)
+        try:
+            results = [pool.apply_async(self._run_buffered_subtask, (job, self.logger, subtask, value)) for value in values]
+            results = [result.get() for result in results]
+        finally:
+            pool.close()
+            pool.join()
+        for result, counts in results:
+            for status_type in ['error', 'warning', 'success']:
+                job[status_type] += counts[status_type]
+        return [result for result, counts in results]
+
+    @phase('uninstall')
+    def _save_cbt_base(self, uuid, snap_uuid):
+        """
+            Keep the exported snapshot of the VDI with the given uuid as a
+            metadata-only CBT snapshot for the next incremental backup and
+            destroy the one kept by the previous backup
+        """
+        self.logger.info('> Keeping snapshot metadata for next incremental backup')
+        self._cleanup_snapshot(uuid, 'vdi', 'ONYXBACKUP-CBT')
+        if not self._backend.destroy_snapshot_data(snap_uuid, 'ONYXBACKUP-CBT'):
+            self._add_status('warning', '(!) Failed to keep CBT snapshot, next backup of disk will be full')
+            self._destroy_snapshot(snap_uuid, 'vdi')
+            return False
+        return True
+
+    @phase('snapshot')
     def _snapshot(self, uuid, snapshot_type='vm', snap_name='ONYXBACKUP'):
         """
             Take snapshot of VM or VDI identified by given uuid
@@ -822,17 +1704,11 @@ class XenApiService(object):
         """
         self.logger.info('> Taking snapshot of {}'.format(snapshot_type.upper()))
 
-        if snapshot_type == 'vm':
-            cmd = 'vm-snapshot vm={} new-name-label="{}"'.format(uuid, snap_name)
-        elif snapshot_type == 'vm-vss':
-            cmd = 'vm-snapshot-with-quiesce vm={} new-name-label="{}"'.format(uuid, snap_name)
-        elif snapshot_type == 'vdi':
-            cmd = 'vdi-snapshot uuid={}'.format(uuid)
-        else:
+        if snapshot_type not in ['vm', 'vm-vss', 'vdi']:
             self._add_status('error', '(!) Invalid snapshot type: {}'.format(snapshot_type))
             return False
 
-        snap_uuid = self._get_xe_cmd_result(cmd)
+        snap_uuid = self._backend.snapshot(uuid, snapshot_type, snap_name)
         if not snap_uuid:
             if snapshot_type == 'vm-vss':
                 self._add_status('warning', '(!) VSS snapshot failed. Falling back to standard snapshot.')
@@ -841,6 +1717,29 @@ class XenApiService(object):
             return False
         return snap_uuid
 
+    def _snapshot_vdis(self, plans):
+        """
+            Take snapshots of the disks of a vdi-export prepared by
+            _prepare_vdi_backup() one right after the other, before any of
+            them is exported, so they are captured as close to the same time
+            as possible. Disks resuming an export keep their snapshot and
+            disks failing to snapshot are left with no snapshot
+        """
+        pending = [plan for plan in plans if not plan['resumed']]
+        if len(pending) > 1:
+            self.logger.info('> Taking snapshots of disks {}'.format(', '.join([plan['disk'] for plan in pending])))
+        start = time()
+        for plan in pending:
+            self._local.job['subtask'] = plan['disk']
+            plan['snapshot'] = self._snapshot(plan['vdi_uuid'], 'vdi')
+            self._local.job['subtask'] = None
+        if len(pending) > 1:
+            self.logger.info('-> Took snapshots of {} disks within {:.2f} seconds'.format(len(pending), time() - start))
+        for plan in pending:
+            if not plan['snapshot']:
+                self._h.delete_file(plan['meta_file'])
+                self.logger.info('-> Skipping disk {} due to error'.format(plan['disk']))
+
     def _start_function(self, title):
         """
             Perform initial setup for a named function
@@ -852,19 +1751,29 @@ class XenApiService(object):
 
     def _start_task(self, title):
         """
-            Perform initial setup for a named task
-        """
-        self.status['task'] = title
-        self.status['task_start'] = datetime.now()
-        self._print_task_header(title, self.status['task_start'])
+            Perform initial setup for a named task which keeps its own status
+            counts until stopped
+        """
+        job = {}
+        job['task'] = title
+        job['task_start'] = datetime.now()
+        job['subtask'] = None
+        job['subtask_start'] = None
+        job['reservation'] = None
+        job['error'] = 0
+        job['warning'] = 0
+        job['success'] = 0
+        self._local.job = job
+        self._print_task_header(title, job['task_start'])
 
     def _start_subtask(self, title):
         """
             Perform initial setup for a named subtask
         """
-        self.status['subtask'] = title
-        self.status['subtask_start'] = datetime.now()
-        self._print_task_header(title, self.status['subtask_start'])
+        job = self._local.job
+        job['subtask'] = title
+        job['subtask_start'] = datetime.now()
+        self._print_task_header(title, job['subtask_start'])
 
     def _stop_function(self):
         """
@@ -878,25 +1787,68 @@ class XenApiService(object):
         """
             Perform closing actions for a named subtask
         """
-        self._print_task_footer(self.status['subtask'], self.status['subtask_start'])
-        self.status['subtask'] = None
-        self.status['subtask_start'] = None
+        job = self._local.job
+        self._print_task_footer(job['subtask'], job['subtask_start'])
+        job['subtask'] = None
+        job['subtask_start'] = None
 
     def _stop_task(self):
         """
-            Perform closing actions for a named task
+            Perform closing actions for a named task and add its status
+            counts to those of the running function
+        """
+        job = self._local.job
+        self._print_task_footer(job['task'], job['task_start'])
+        self._metrics.add_job(self.status['function'].lower(), job['task'],
+            (datetime.now() - job['task_start']).total_seconds(), job['error'] == 0)
+        if job['reservation'] is not None:
+            self._space.release(job['reservation'])
+        with self._status_lock:
+            for status_type in ['error', 'warning', 'success']:
+                self.status[status_type] += job[status_type]
+        self._local.job = None
+
+    def _take_prefetched(self, prefetched):
+        """
+            Log the output of a preparation prefetched by _prefetch_job() in
+            the running job and add its status counts to it
+
+            @return Result of the preparation
+        """
+        result, logger, counts = prefetched
+        self.logger.debug('(i) Prepared while the previous export ran')
+        logger.replay(self.logger)
+        for status_type in ['error', 'warning', 'success']:
+            self._local.job[status_type] += counts[status_type]
+        return result
+
+    def _teardown_snapshot(self, uuid, snapshot_type='vm'):
+        """
+            Remove the exported snapshot with the given uuid on the background
+            teardown threads so the next export does not wait for it, or
+            right away if teardown_workers is 0. VM snapshots are uninstalled
+            along with their disks
         """
-        self._print_task_footer(self.status['task'], self.status['task_start'])
-        self.status['task'] = None
-        self.status['task_start'] = None
+        if self._teardown is None:
+            if snapshot_type == 'vm':
+                return self._uninstall_vm(uuid)
+            return self._destroy_snapshot(uuid, snapshot_type)
 
+        self.logger.info('> Removing snapshot in background')
+        if snapshot_type == 'vm':
+            remove_func = self._backend.uninstall_vm
+        else:
+            remove_func = lambda snap_uuid: self._backend.destroy_snapshot(snap_uuid, snapshot_type)
+        self._teardown.remove(uuid, remove_func, self._get_job_labels(), self._record_teardown)
+        return True
+
+    @phase('uninstall')
     def _uninstall_vm(self, uuid):
         """
             Uninstall VM with given uuid
         """
         self.logger.info('> Uninstalling snapshot')
-        cmd = 'vm-uninstall uuid={} force=true'.format(uuid)
-        if not self._run_xe_cmd(cmd):
+        if not self._backend.uninstall_vm(uuid):
             self._add_status('error', '(!) Failed to uninstall snapshot')
             return False
         return True
@@ -922,8 +1874,6 @@ class XenApiService(object):
         for type, list in dict.items():
             self.logger.debug('(i) -> Validating {} list'.format(type))
             self.logger.debug('(i) --> {} = {}'.format(type, list))
-            validated_list = []
-            vm_matched = []
 
             if list == []:
                 self.logger.debug('(i) --> Skipping empty list: {}'.format(type))
@@ -934,11 +1884,9 @@ class XenApiService(object):
                 self.config[type] = []
                 continue
 
+            entries = []
             for value in list:
-                self.logger.debug('(i) --> Checking for matches: {}'.format(value))
                 if value == '':
-                    if value in self.config[type]:
-                        self.config[type].remove(value)
                     self.logger.warning('(!) --> Skipping blank entry for {}'.format(type))
                     continue
 
@@ -946,55 +1894,50 @@ class XenApiService(object):
                 vm_name = values[0]
                 vm_backups = ''
                 vdi_disks = ''
-                found_match = False
 
                 if len(values) > 1:
                     try:
-                        tmp_max = int(values[1])
-                        if isinstance(tmp_max, (int, long)) and (tmp_max == -1 or tmp_max > 0):
-                            vm_backups = values[1]
-                            if len(values) == 3:
-                                vdi_disks = values[2]
-                        else:
-                            self.logger.warning('(!) max_backups out of range for {}: {}'.format(vm_name, values[1]))
+                        self._get_retention(values[1])
+                        vm_backups = values[1]
+                        if len(values) == 3:
+                            vdi_disks = values[2]
                     except ValueError as e:
-                        self.logger.warning('(!) max_backups non-integer for {}: {}'.format(vm_name, values[1]))
+                        self.logger.warning('{} for {}: {}'.format(e, vm_name, values[1]))
 
-                if not self._is_vm_name(vm_name) and not self._is_valid_regex(vm_name):
+                if not self._is_valid_regex(vm_name):
                     self.logger.warning('(!) Invalid regex: {}'.format(vm_name))
                     continue
+                entries.append((value, vm_name, vm_backups, vdi_disks))
+
+            matcher = util.NameMatcher([entry[1] for entry in entries])
+            matched = []
+            matched_entries = set()
+            for position, vm in enumerate(sanitized_vms):
+                index = matcher.match(vm)
+                if index is None:
+                    continue
+                matched_entries.add(index)
+                value, vm_name, vm_backups, vdi_disks = entries[index]
+                self.logger.debug('(i) --> Match found for {}: {}'.format(value, vm))
+                if type == 'excludes' or vm_backups == '':
+                    new_value = vm
+                elif not vdi_disks == '':
+                    new_value = '{}:{}:{}'.format(vm, vm_backups, vdi_disks)
+                else:
+                    new_value = '{}:{}'.format(vm, vm_backups)
+                matched.append((index, position, vm, new_value))
 
-                for vm in sanitized_vms:
-                    if ((self._is_vm_name(vm_name) and vm_name == vm) or
-                            (not self._is_vm_name(vm_name) and re.match(vm_name, vm))):
-                        self.logger.debug('(i) --> Match found: {}'.format(vm))
-                        found_match = True
-                        if type == 'excludes' or vm_backups == '':
-                            new_value = vm
-                        elif not vm_backups == '' and not vdi_disks == '':
-                            new_value = '{}:{}:{}'.format(vm, vm_backups, vdi_disks)
-                        else:
-                            new_value = '{}:{}'.format(vm, vm_backups)
-
-                        if not vm in vm_matched:
-                            validated_list.append(new_value)
-                        else:
-                            self.logger.debug('(i) ---> VM ignored as it has already been matched: {}'.format(vm))
-
-                        if not type == 'excludes':
-                            vm_matched.append(vm)
-
-                if not found_match:
-                    self.logger.warning('(!) No matching VMs found for {} in {}'.format(value, type))
-                elif found_match and type == 'excludes':
-                    for vm in validated_list:
-                        if vm in sanitized_vms:
-                            self.logger.debug('(i) --> Removing VM from sanitized list as it has been excluded: {}'.format(vm))
-                            sanitized_vms.remove(vm)
-                        else:
-                            self.logger.debug('(i) --> VM no longer in santized list to remove: {}'.format(vm))
-
-                self.config[type] = sorted(validated_list, key=str.lower)
+            vm_set = set(sanitized_vms)
+            for index, entry in enumerate(entries):
+                if index not in matched_entries and not matcher.matches_any(index, vm_set):
+                    self.logger.warning('(!) No matching VMs found for {} in {}'.format(entry[0], type))
+
+            if type == 'excludes':
+                excluded = set(vm for index, position, vm, new_value in matched)
+                self.logger.debug('(i) --> Removing VMs from sanitized list as they have been excluded: {}'.format(sorted(excluded)))
+                sanitized_vms = [vm for vm in sanitized_vms if vm not in excluded]
+
+            self.config[type] = sorted([new_value for index, position, vm, new_value in sorted(matched)], key=str.lower)
 
     def _verify_backup_dir(self, path):
         """
@@ -1011,3 +1954,39 @@ class XenApiService(object):
             Check if provided VM name contains any invalid characters
         """
         return re.search('[\:\"/\\\\]', name)
+
+    def _write_cbt_meta(self, file, snap_uuid, backup_file, cbt_base=None):
+        """
+            Add CBT section to the given metadata backup file recording the
+            snapshot to compare the next incremental backup against and the
+            backup this one depends on
+        """
+        chain_length = int(cbt_base['chain_length']) + 1 if cbt_base else 0
+        try:
+            with open(file, 'a') as meta_out:
+                meta_out.write('******* CBT *******\n')
+                meta_out.write('snapshot={}\n'.format(snap_uuid))
+                meta_out.write('backup_file={}\n'.format(basename(backup_file)))
+                meta_out.write('parent={}\n'.format(cbt_base['backup_file'] if cbt_base else ''))
+                meta_out.write('chain_length={}\n'.format(chain_length))
+                meta_out.write('\n')
+        except IOError as e:
+            self._add_status('error', '(!) Unable to write CBT metadata to file: {}'.format(file))
+            return False
+        return True
+
+    def _write_metrics(self):
+        """
+            Write metrics of the jobs run to a Prometheus textfile and JSON
+            run summary in metrics_dir
+        """
+        if not self.config['metrics_dir'] or not self._metrics.has_records():
+            return
+        prom_file = join(self.config['metrics_dir'], 'onyxbackup.prom')
+        json_file = join(self.config['metrics_dir'], 'onyxbackup-metrics.json')
+        try:
+            self._metrics.write_prometheus(prom_file)
+            self._metrics.write_json(json_file)
+            self.logger.debug('(i) Metrics written to: {}'.format(prom_file))
+        except (IOError, OSError) as e:
+            self._add_status('warning', '(!) Unable to write metrics: {}'.format(e))
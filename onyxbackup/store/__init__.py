@@ -0,0 +1,6 @@
+#!/usr/bin/env python
+
+from catalog import *
+from store import *
+from verify import *
+from xva import *
\ No newline at end of file
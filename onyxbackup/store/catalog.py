@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+
+# part of OnyxBackupVM
+# Copyright (c) 2017-2020 OnyxFire, Inc.
+	
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sqlite3
+import threading
+from hashlib import sha256
+from logging import getLogger
+from os import listdir, stat
+from os.path import basename, dirname, exists, getsize, join, relpath
+from stat import S_ISDIR
+from time import time
+import onyxbackup.util as util
+
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+class Catalog(object):
+	"""
+		Catalog of the backups written to backup_dir kept in an SQLite
+		database so rotation and listing query it instead of listing and
+		stat'ing every file on the share. Each artifact (backup file,
+		metadata file, digest file, and XVA index) is recorded with its size, checksum
+		where known (for backups the whole file digest of their digest file),
+		timestamp, VM uuid, and export type when written. Paths are kept
+		relative to backup_dir so the share can be mounted elsewhere
+	"""
+
+	def __init__(self, backup_dir):
+		self.logger = getLogger(__name__)
+		self._backup_dir = backup_dir
+		self._path = join(backup_dir, 'catalog.db')
+		self._lock = threading.Lock()
+		self._db = None
+
+	def add_backup(self, file, meta_file=None, export_type='vm', vm_uuid=None, parent=None, checksum=None):
+		"""
+			Record backup file written for the given export type along with
+			its metadata file, its digest and index files if written, and the
+			backup it depends on if incremental
+
+			@return True if recorded
+		"""
+		created = time()
+		try:
+			digest_file = '{}.digest'.format(file)
+			if checksum is None and exists(digest_file):
+				checksum = self._get_backup_checksum(file)
+			rows = [self._get_row(file, file, 'backup', export_type, vm_uuid, created, getsize(file), parent, checksum)]
+			if meta_file:
+				rows.append(self._get_row(meta_file, file, 'meta', export_type, vm_uuid, created, getsize(meta_file),
+					None, self._get_checksum(meta_file)))
+			if exists(digest_file):
+				rows.append(self._get_row(digest_file, file, 'digest', export_type, vm_uuid, created,
+					getsize(digest_file)))
+			index_file = '{}.index'.format(file)
+			if exists(index_file):
+				rows.append(self._get_row(index_file, file, 'index', export_type, vm_uuid, created,
+					getsize(index_file)))
+			self._open()
+			with self._lock:
+				self._db.executemany('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+				self._db.commit()
+		except (sqlite3.Error, IOError, OSError) as e:
+			self.logger.error('(!) Unable to add backup to catalog: {}'.format(e))
+			return False
+		return True
+
+	def add_file(self, file, backup, kind):
+		"""
+			Record a file written later for a backup in the catalog (i.e. an
+			index built for an existing backup)
+
+			@return True if recorded
+		"""
+		try:
+			self._open()
+			with self._lock:
+				row = self._db.execute('SELECT export_type, vm_uuid, created FROM artifacts WHERE path = ?',
+					(self._relative(backup),)).fetchone()
+				if row is None:
+					return False
+				self._db.execute('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+					self._get_row(file, backup, kind, row[0], row[1], row[2], getsize(file)))
+				self._db.commit()
+		except (sqlite3.Error, OSError) as e:
+			self.logger.error('(!) Unable to add file to catalog: {}'.format(e))
+			return False
+		return True
+
+	def close(self):
+		with self._lock:
+			if self._db is not None:
+				self._db.close()
+				self._db = None
+
+	def find_backups(self):
+		"""
+			Find the backups in backup_dir scanning it like rebuild() without
+			changing the catalog
+
+			@return List of (directory, backups, orphans) tuples with backups
+			as returned by get_backups() and orphans the metadata, digest, and
+			index files found without their backup
+		"""
+		directories = []
+		for path, files in self._scan(self._backup_dir):
+			if path == self._backup_dir:
+				continue
+			rows = sorted(self._get_dir_rows(path, files), key=lambda row: (row[8], row[1], row[2]))
+			backups = self._group_backups([(row[0], row[2], row[1], row[4], row[5], row[6], row[7], row[8], row[9])
+				for row in rows])
+			# Metadata files of unfinished exports are kept with their journal
+			names = set(basename(backup['file']).split('.', 1)[0] for backup in backups)
+			names.update(name.split('.', 1)[0] for name in files if name.endswith('.journal'))
+			orphans = [join(path, name) for name in sorted(files) if (name.endswith('.meta') and name.split('.', 1)[0] not in names)
+				or (name.split('.')[-1] in ['digest', 'index'] and name.rsplit('.', 1)[0] not in files)]
+			if backups or orphans:
+				directories.append((path, backups, orphans))
+		return sorted(directories, key=lambda directory: directory[0])
+
+	def get_backups(self, path):
+		"""
+			Get backups in the given directory oldest first
+
+			@return List of dictionaries with file, meta_file, digest_file,
+			index_file, parent, export_type, vm_uuid, size, checksum, and created of each
+			backup
+		"""
+		self._open()
+		with self._lock:
+			rows = self._db.execute('SELECT path, kind, backup, export_type, vm_uuid, size, checksum, created, parent '
+				'FROM artifacts WHERE directory = ? ORDER BY created, backup, kind', (self._relative(path),)).fetchall()
+		return self._group_backups(rows)
+
+	def get_directories(self):
+		"""
+			@return List of (directory, backups, total size) tuples
+		"""
+		self._open()
+		with self._lock:
+			rows = self._db.execute('SELECT directory, COUNT(DISTINCT backup), SUM(size) FROM artifacts '
+				'GROUP BY directory ORDER BY directory').fetchall()
+		return [(self._absolute(directory), count, size) for directory, count, size in rows]
+
+	def rebuild(self):
+		"""
+			Replace the catalog with the backups found in a single pass over
+			backup_dir. Files which are not recognized as backups are ignored
+
+			@return Number of backups found
+		"""
+		self.logger.debug('(i) -> Scanning {} for backups'.format(self._backup_dir))
+		rows = []
+		for path, files in self._scan(self._backup_dir):
+			# Backups are only kept in directories under backup_dir
+			if path != self._backup_dir:
+				rows += self._get_dir_rows(path, files)
+		self._open()
+		with self._lock:
+			self._db.execute('DELETE FROM artifacts')
+			self._db.executemany('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+			self._db.commit()
+		return len([row for row in rows if row[2] == 'backup'])
+
+	def remove_backup(self, file):
+		"""
+			Remove backup file and its metadata, digest, and index files from
+			the catalog
+		"""
+		self._open()
+		with self._lock:
+			self._db.execute('DELETE FROM artifacts WHERE backup = ?', (self._relative(file),))
+			self._db.commit()
+
+	# Private Functions
+
+	def _absolute(self, path):
+		return join(self._backup_dir, path)
+
+	def _get_backup_checksum(self, file):
+		"""
+			Get the whole file digest of a backup from its digest file as
+			<algorithm>:<hex digest>
+		"""
+		digest = util.ExportDigest.load(file)
+		if digest is None:
+			return None
+		return '{}:{}'.format(digest['algorithm'], digest['digest'])
+
+	def _get_checksum(self, file):
+		with open(file, 'rb') as file_in:
+			return sha256(file_in.read()).hexdigest()
+
+	def _get_dir_rows(self, path, files):
+		"""
+			Pair backup files found in a directory with their metadata files
+			by the name before the first extension and their digest and index
+			files
+		"""
+		rows = []
+		metas = dict((name.split('.', 1)[0], name) for name in files if name.endswith('.meta'))
+		for name, (mtime, size) in files.items():
+			if '.' not in name or name.split('.')[-1] in ['meta', 'tmp', 'journal', 'digest', 'index']:
+				continue
+			# Exports with a journal are unfinished
+			if '{}.journal'.format(name) in files:
+				continue
+			export_type = self._get_export_type(name.split('.', 1)[1])
+			if export_type is None:
+				continue
+			file = join(path, name)
+			parent = None
+			if name.endswith('.delta'):
+				try:
+					parent = join(path, util.DeltaReader(file).parent)
+				except (IOError, ValueError, KeyError) as e:
+					self.logger.debug('(i) -> Unable to read delta header: {}'.format(e))
+			meta_name = metas.get(name.split('.', 1)[0])
+			vm_uuid = self._read_vm_uuid(join(path, meta_name)) if meta_name else None
+			digest_name = '{}.digest'.format(name)
+			checksum = self._get_backup_checksum(file) if digest_name in files else None
+			rows.append(self._get_row(file, file, 'backup', export_type, vm_uuid, mtime, size, parent, checksum))
+			if digest_name in files:
+				rows.append(self._get_row(join(path, digest_name), file, 'digest', export_type, vm_uuid, mtime,
+					files[digest_name][1]))
+			index_name = '{}.index'.format(name)
+			if index_name in files:
+				rows.append(self._get_row(join(path, index_name), file, 'index', export_type, vm_uuid, mtime,
+					files[index_name][1]))
+			if meta_name:
+				meta_file = join(path, meta_name)
+				rows.append(self._get_row(meta_file, file, 'meta', export_type, vm_uuid, mtime, files[meta_name][1],
+					None, self._get_checksum(meta_file)))
+		return rows
+
+	def _get_export_type(self, extension):
+		if extension in ['db', 'xbk']:
+			return 'pool' if extension == 'db' else 'host'
+		for prefix, export_type in [('xva', 'vm'), ('raw', 'vdi'), ('vhd', 'vdi')]:
+			if extension.startswith(prefix):
+				return export_type
+		return None
+
+	def _get_row(self, file, backup, kind, export_type, vm_uuid, created, size, parent=None, checksum=None):
+		return (self._relative(file), self._relative(backup), kind, self._relative(dirname(file)), export_type,
+			vm_uuid, size, checksum, created, self._relative(parent) if parent else None)
+
+	def _group_backups(self, rows):
+		"""
+			Group (path, kind, backup, export_type, vm_uuid, size, checksum,
+			created, parent) artifact rows by backup in the order given
+		"""
+		backups = []
+		by_file = {}
+		for path, kind, backup, export_type, vm_uuid, size, checksum, created, parent in rows:
+			if backup not in by_file:
+				by_file[backup] = {'file': self._absolute(backup), 'meta_file': None, 'digest_file': None, 'index_file': None,
+					'parent': None, 'export_type': export_type, 'vm_uuid': vm_uuid, 'size': 0, 'checksum': None,
+					'created': created}
+				backups.append(by_file[backup])
+			if kind == 'meta':
+				by_file[backup]['meta_file'] = self._absolute(path)
+			elif kind == 'digest':
+				by_file[backup]['digest_file'] = self._absolute(path)
+			elif kind == 'index':
+				by_file[backup]['index_file'] = self._absolute(path)
+			else:
+				by_file[backup]['parent'] = self._absolute(parent) if parent else None
+				by_file[backup]['checksum'] = checksum
+			by_file[backup]['size'] += size
+		return backups
+
+	def _open(self):
+		with self._lock:
+			if self._db is not None:
+				return
+			rebuild = not exists(self._path)
+			self._db = sqlite3.connect(self._path, check_same_thread=False)
+			self._db.execute('CREATE TABLE IF NOT EXISTS artifacts (path TEXT PRIMARY KEY, backup TEXT, kind TEXT, '
+				'directory TEXT, export_type TEXT, vm_uuid TEXT, size INTEGER, checksum TEXT, created REAL, parent TEXT)')
+			self._db.execute('CREATE INDEX IF NOT EXISTS artifacts_directory ON artifacts (directory, created)')
+			self._db.execute('CREATE INDEX IF NOT EXISTS artifacts_backup ON artifacts (backup)')
+			self._db.commit()
+		if rebuild:
+			self.logger.info('-> Creating backup catalog from existing backups')
+			self.rebuild()
+
+	def _read_vm_uuid(self, meta_file):
+		"""
+			Read uuid of the VM from the first orig_uuid entry of a metadata file
+		"""
+		try:
+			with open(meta_file) as meta_in:
+				for line in meta_in:
+					if line.startswith('orig_uuid='):
+						return line.strip().split('=', 1)[1]
+		except IOError as e:
+			self.logger.debug('(i) -> Unable to read metadata file: {}'.format(e))
+		return None
+
+	def _relative(self, path):
+		return relpath(path, self._backup_dir)
+
+	def _scan(self, path):
+		"""
+			Walk the directories under path yielding (directory, {name: (mtime,
+			size)}) for the files in each, skipping the chunk store. Uses scandir
+			where available to avoid a separate stat of directories
+		"""
+		files = {}
+		directories = []
+		if scandir is not None:
+			for entry in scandir(path):
+				if entry.is_dir(follow_symlinks=False):
+					directories.append(entry.path)
+				elif entry.is_file(follow_symlinks=False):
+					file_stat = entry.stat()
+					files[entry.name] = (file_stat.st_mtime, file_stat.st_size)
+		else:
+			for name in listdir(path):
+				file_stat = stat(join(path, name))
+				if S_ISDIR(file_stat.st_mode):
+					directories.append(join(path, name))
+				else:
+					files[name] = (file_stat.st_mtime, file_stat.st_size)
+		yield (path, files)
+		for directory in directories:
+			if directory != join(self._backup_dir, '.chunks'):
+				for result in self._scan(directory):
+					yield result
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+
+# part of OnyxBackupVM
+# Copyright (c) 2017-2020 OnyxFire, Inc.
+	
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sqlite3
+import threading
+from hashlib import sha256
+from logging import getLogger
+from os import listdir, mkdir, remove, rename, walk
+from os.path import exists, getsize, join
+
+class Chunker(object):
+	"""
+		Split a stream into content-defined chunks. A chunk ends after the
+		first occurrence of the anchor bytes found at least min_size bytes
+		into it, or at max_size if there is none, so boundaries follow the
+		content and realign after data is inserted or removed upstream
+		(i.e. empty blocks left out of an XVA). Searching for the anchor
+		runs at str.find() speed instead of hashing every byte in Python
+	"""
+
+	def __init__(self, min_size=1048576, max_size=8388608, anchor='\xa5\x5a'):
+		self._min_size = min_size
+		self._max_size = max_size
+		self._anchor = anchor
+		self._buffer = ''
+
+	def feed(self, data):
+		"""
+			Add data to the stream
+
+			@return List of chunks completed by the data
+		"""
+		self._buffer += data
+		chunks = []
+		start = 0
+		while len(self._buffer) - start >= self._min_size:
+			limit = min(start + self._max_size, len(self._buffer))
+			end = self._buffer.find(self._anchor, start + self._min_size, limit)
+			if end != -1:
+				end += len(self._anchor)
+			elif limit - start == self._max_size:
+				end = limit
+			else:
+				break
+			chunks.append(self._buffer[start:end])
+			start = end
+		self._buffer = self._buffer[start:]
+		return chunks
+
+	def finish(self):
+		"""
+			@return List holding the remaining partial chunk if any
+		"""
+		chunks = [self._buffer] if self._buffer else []
+		self._buffer = ''
+		return chunks
+
+class ChunkStore(object):
+	"""
+		Deduplicated store keeping each distinct chunk of exported data once
+		under its SHA-256 digest. Each backup is a manifest listing its
+		chunks in order, and the number of manifest entries referencing each
+		chunk is counted in an SQLite index so chunks are deleted as soon as
+		the last manifest using them is removed. Only one OnyxBackupVM run
+		should use a store at a time
+	"""
+
+	header = '# OnyxBackupVM manifest v1\n'
+
+	def __init__(self, path):
+		self.logger = getLogger(__name__)
+		self._path = path
+		self._lock = threading.Lock()
+		self._pending = 0
+		self._db = None
+		self._stats = {}
+
+	def check_manifest(self, manifest):
+		"""
+			Check the chunks listed by the given manifest are in the store
+			with the size recorded without reading them
+
+			@return List of problems found
+		"""
+		problems = []
+		with open(manifest, 'r') as manifest_in:
+			if manifest_in.readline() != self.header:
+				return ['Not an OnyxBackupVM manifest']
+		try:
+			for digest, size in self._read_manifest(manifest):
+				path = self._chunk_path(digest)
+				if not exists(path):
+					problems.append('Missing chunk {}'.format(digest))
+				elif getsize(path) != size:
+					problems.append('Chunk {} is {} bytes instead of {}'.format(digest, getsize(path), size))
+		except ValueError:
+			problems.append('Manifest is corrupt')
+		return problems
+
+	def close(self):
+		with self._lock:
+			if self._db is not None:
+				self._db.commit()
+				self._db.close()
+				self._db = None
+
+	def get_stats(self, manifest):
+		"""
+			Get total and newly stored bytes of the given manifest written
+			during this run
+
+			@return Tuple of (total bytes, stored bytes) or None
+		"""
+		return self._stats.get(manifest)
+
+	def open_manifest(self, manifest):
+		"""
+			@return ManifestWriter sink storing data written to it as a
+			backup with the given manifest file
+		"""
+		self._open()
+		return ManifestWriter(self, manifest)
+
+	def rebuild_index(self, backup_dir):
+		"""
+			Recount chunk references from all manifests under backup_dir
+			and delete chunks no manifest references
+		"""
+		self._open()
+		with self._lock:
+			self._db.execute('UPDATE chunks SET refs = 0')
+			for dirpath, dirnames, filenames in walk(backup_dir):
+				if dirpath == self._path:
+					dirnames[:] = []
+					continue
+				for name in filenames:
+					if name.endswith('.manifest'):
+						for digest, size in self._read_manifest(join(dirpath, name)):
+							self._add_ref(digest, size)
+			self._db.commit()
+		removed = 0
+		freed = 0
+		for prefix in listdir(self._path):
+			prefix_dir = join(self._path, prefix)
+			if len(prefix) != 2:
+				continue
+			for name in listdir(prefix_dir):
+				row = self._db.execute('SELECT refs FROM chunks WHERE digest = ?', (name,)).fetchone()
+				if row is None or row[0] == 0:
+					freed += getsize(join(prefix_dir, name))
+					remove(join(prefix_dir, name))
+					removed += 1
+		with self._lock:
+			self._db.execute('DELETE FROM chunks WHERE refs = 0')
+			self._db.commit()
+		return (removed, freed)
+
+	def remove_manifest(self, manifest):
+		"""
+			Delete the given manifest and release its chunk references,
+			deleting chunks no longer referenced
+
+			@return Bytes freed from the store
+		"""
+		self._open()
+		freed = 0
+		with self._lock:
+			for digest, size in self._read_manifest(manifest):
+				freed += self._release_ref(digest)
+			self._db.commit()
+		remove(manifest)
+		return freed
+
+	def restore(self, manifest, out):
+		"""
+			Write the data of the backup with the given manifest to out
+			verifying each chunk against its digest
+
+			@return Number of bytes written
+		"""
+		written = 0
+		for digest, size in self._read_manifest(manifest):
+			with open(self._chunk_path(digest), 'rb') as chunk_in:
+				chunk = chunk_in.read()
+			if sha256(chunk).hexdigest() != digest:
+				raise IOError('(!) Chunk is corrupt: {}'.format(digest))
+			out.write(chunk)
+			written += len(chunk)
+		return written
+
+	# Private Functions
+
+	def _add_ref(self, digest, size):
+		cursor = self._db.execute('UPDATE chunks SET refs = refs + 1 WHERE digest = ?', (digest,))
+		if cursor.rowcount == 0:
+			self._db.execute('INSERT INTO chunks (digest, size, refs) VALUES (?, ?, 1)', (digest, size))
+
+	def _chunk_path(self, digest):
+		return join(self._path, digest[:2], digest)
+
+	def _open(self):
+		with self._lock:
+			if self._db is not None:
+				return
+			if not exists(self._path):
+				mkdir(self._path)
+			self._db = sqlite3.connect(join(self._path, 'index.db'), check_same_thread=False)
+			self._db.execute('CREATE TABLE IF NOT EXISTS chunks (digest TEXT PRIMARY KEY, size INTEGER, refs INTEGER)')
+			self._db.commit()
+
+	def _read_manifest(self, manifest):
+		with open(manifest, 'r') as manifest_in:
+			for line in manifest_in:
+				if line.startswith('#'):
+					continue
+				digest, size = line.split()
+				yield (digest, int(size))
+
+	def _release_ref(self, digest):
+		self._db.execute('UPDATE chunks SET refs = refs - 1 WHERE digest = ?', (digest,))
+		row = self._db.execute('SELECT refs, size FROM chunks WHERE digest = ?', (digest,)).fetchone()
+		if row is None or row[0] > 0:
+			return 0
+		self._db.execute('DELETE FROM chunks WHERE digest = ?', (digest,))
+		path = self._chunk_path(digest)
+		if exists(path):
+			remove(path)
+		return row[1]
+
+	def _store_chunk(self, chunk):
+		"""
+			Reference chunk storing it if it is not in the store yet
+
+			@return Tuple of (digest, stored bytes)
+		"""
+		digest = sha256(chunk).hexdigest()
+		path = self._chunk_path(digest)
+		with self._lock:
+			# Referenced under the lock so a concurrent manifest removal can not
+			# delete the chunk between checking for it and using it
+			stored = 0
+			if not exists(path):
+				prefix_dir = join(self._path, digest[:2])
+				if not exists(prefix_dir):
+					mkdir(prefix_dir)
+				tmp_path = '{}.tmp'.format(path)
+				with open(tmp_path, 'wb') as chunk_out:
+					chunk_out.write(chunk)
+				rename(tmp_path, path)
+				stored = len(chunk)
+			self._add_ref(digest, len(chunk))
+			self._pending += 1
+			if self._pending >= 256:
+				self._db.commit()
+				self._pending = 0
+		return (digest, stored)
+
+class ManifestWriter(object):
+	"""
+		Sink chunking and storing the data written to it and recording the
+		chunks in a manifest which is only put in place once finished
+	"""
+
+	def __init__(self, store, manifest):
+		self._store = store
+		self._manifest = manifest
+		self._tmp_manifest = '{}.tmp'.format(manifest)
+		self._chunker = Chunker()
+		self._total = 0
+		self._stored = 0
+		self._out = open(self._tmp_manifest, 'w')
+		self._out.write(ChunkStore.header)
+
+	def abort(self):
+		"""
+			Discard the manifest releasing references taken so far
+		"""
+		self._out.close()
+		self._store.remove_manifest(self._tmp_manifest)
+
+	def finish(self):
+		self._add_chunks(self._chunker.finish())
+		self._out.close()
+		with self._store._lock:
+			# References are committed before the manifest is put in place so
+			# a crash can not leave a manifest using unreferenced chunks
+			self._store._db.commit()
+			self._store._pending = 0
+		rename(self._tmp_manifest, self._manifest)
+		self._store._stats[self._manifest] = (self._total, self._stored)
+
+	def write(self, data):
+		self._add_chunks(self._chunker.feed(data))
+
+	# Private Functions
+
+	def _add_chunks(self, chunks):
+		for chunk in chunks:
+			digest, stored = self._store._store_chunk(chunk)
+			self._out.write('{} {}\n'.format(digest, len(chunk)))
+			self._total += len(chunk)
+			self._stored += stored
@@ -0,0 +1,458 @@
+#!/usr/bin/env python
+
+# part of OnyxBackupVM
+# Copyright (c) 2017-2020 OnyxFire, Inc.
+	
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import tarfile
+from collections import deque
+from hashlib import sha1
+from multiprocessing import Pool, Semaphore
+from multiprocessing.pool import ThreadPool
+from os.path import basename, exists, getsize, splitext
+from time import time
+import onyxbackup.util as util
+from store import ChunkStore
+from xva import DecompressingReader, XvaIndex
+
+try:
+	import xxhash
+except ImportError:
+	xxhash = None
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+# Semaphore limiting reads of the worker processes set by _init_worker()
+_io_lock = None
+
+def _sha1_hex(data):
+	return [sha1(data).hexdigest()]
+
+def _xxhash_hex(data):
+	# Versions of xapi differ in the xxhash variant written to .xxhash members
+	values = [xxhash.xxh64(data).hexdigest()]
+	if hasattr(xxhash, 'xxh3_64'):
+		values.append(xxhash.xxh3_64(data).hexdigest())
+	return values
+
+# Functions hashing disk chunks of an XVA to the values which may be in
+# each kind of checksum member, None if unavailable
+_chunk_hashes = {'.checksum': _sha1_hex, '.xxhash': _xxhash_hex if xxhash is not None else None}
+
+def _init_worker(io_lock):
+	global _io_lock
+	_io_lock = io_lock
+
+def _verify_backup(args):
+	backup, chunk_dir, threads, read_size = args
+	check = BackupCheck(backup, chunk_dir, threads, read_size, _io_lock)
+	try:
+		check.run()
+	except Exception as e:
+		check.errors.append('Unable to verify: {}'.format(e))
+	return check.get_result()
+
+class BackupCheck(object):
+	"""
+		Check a single backup as found by Catalog.find_backups(): re-hash
+		it against its digest file while walking its structure in the same
+		pass (tar members of .xva files, records of .delta files, and the
+		footer of .vhd files) and check its metadata file belongs to it.
+		Disk chunks of .xva files are hashed on threads and checked against
+		the checksum member xapi writes after each of them
+	"""
+
+	def __init__(self, backup, chunk_dir, threads=2, read_size=8388608, io_lock=None):
+		self.backup = backup
+		self.errors = []
+		self.warnings = []
+		self._chunk_dir = chunk_dir
+		self._threads = threads
+		self._read_size = read_size
+		self._io_lock = io_lock
+		self._bytes = 0
+		self._start = time()
+
+	def get_result(self):
+		return {'file': self.backup['file'], 'errors': self.errors, 'warnings': self.warnings,
+			'bytes': self._bytes, 'seconds': time() - self._start}
+
+	def run(self):
+		file = self.backup['file']
+		name = basename(file)
+		if not exists(file):
+			self.errors.append('Backup file is missing')
+			return
+		disk = self._check_meta()
+		if name.endswith('.manifest'):
+			self.errors += ChunkStore(self._chunk_dir).check_manifest(file)
+			return
+
+		hasher = None
+		digest = None
+		if self.backup['digest_file']:
+			digest = util.ExportDigest.load(file)
+			if digest is None:
+				self.errors.append('Digest file is unreadable')
+			elif not util.BlockHasher.is_available(digest['algorithm']):
+				self.warnings.append('Digest not checked, {} is not available'.format(digest['algorithm']))
+			else:
+				hasher = util.BlockHasher(digest['algorithm'], digest['block_size'], 'sha256' in digest)
+		elif '.xva' not in name:
+			self.warnings.append('No digest file, contents not checked')
+
+		structured = '.xva' in name or name.endswith('.delta') or name.endswith('.vhd')
+		if hasher is None and not structured:
+			return
+		with open(file, 'rb') as file_in:
+			reader = HashingReader(file_in, hasher, self._read_size, self._io_lock)
+			if '.xva' in name:
+				self._check_xva(reader, name, digest is not None)
+			elif name.endswith('.delta'):
+				self._check_delta(reader, disk)
+			reader.drain()
+			self._bytes = reader.position
+			if name.endswith('.vhd') and not reader.tail.startswith('conectix'):
+				self.errors.append('VHD footer is missing')
+		if hasher is not None:
+			self._check_digest(digest, hasher.finish())
+
+	# Private Functions
+
+	def _check_delta(self, reader, disk):
+		"""
+			Walk the header and block records of a delta file
+		"""
+		if reader.readline() != util.DeltaWriter.header:
+			self.errors.append('Not an OnyxBackupVM delta file')
+			return
+		header = {}
+		for line in iter(reader.readline, '\n'):
+			if not line.endswith('\n') or '=' not in line:
+				self.errors.append('Delta header is truncated')
+				return
+			key, value = line.rstrip('\n').split('=', 1)
+			header[key] = value
+		size = int(header.get('size', 0))
+		if disk and disk.get('virtual_size') and int(disk['virtual_size']) != size:
+			self.errors.append('Delta is for a {} byte disk, metadata has {}'.format(size, disk['virtual_size']))
+		if self.backup['parent'] and not exists(self.backup['parent']):
+			self.errors.append('Parent backup is missing: {}'.format(basename(self.backup['parent'])))
+		while True:
+			record = reader.read(util.DeltaWriter.record.size)
+			if len(record) < util.DeltaWriter.record.size:
+				self.errors.append('Delta file is truncated')
+				return
+			offset, length = util.DeltaWriter.record.unpack(record)
+			if length == 0:
+				break
+			if offset + length > size:
+				self.errors.append('Delta block at {} is past the end of the disk'.format(offset))
+				return
+			if reader.skip(length) < length:
+				self.errors.append('Delta file is truncated')
+				return
+		if reader.read(1):
+			self.errors.append('Delta file has data after its end')
+
+	def _check_digest(self, digest, values):
+		if values['size'] != digest['size']:
+			self.errors.append('Size is {} bytes, digest has {}'.format(values['size'], digest['size']))
+		bad_blocks = [index for index, (block, expected) in enumerate(zip(values['blocks'], digest['blocks']))
+			if block != expected]
+		if bad_blocks:
+			self.errors.append('{} blocks do not match their digest, first at offset {}'.format(len(bad_blocks),
+				bad_blocks[0] * digest['block_size']))
+		elif values['digest'] != digest['digest']:
+			self.errors.append('Digest does not match')
+		if 'sha256' in digest and values['sha256'] != digest['sha256']:
+			self.errors.append('SHA-256 does not match')
+
+	def _check_meta(self):
+		"""
+			Check the metadata file of VM and VDI backups names the VM and,
+			for VDI backups, the disk backed up whose size raw backups have
+
+			@return Metadata of the disk of a VDI backup or None
+		"""
+		file = self.backup['file']
+		if self.backup['export_type'] not in ['vm', 'vdi']:
+			return None
+		if not self.backup['meta_file']:
+			self.errors.append('Metadata file is missing')
+			return None
+		sections = []
+		try:
+			with open(self.backup['meta_file']) as meta_in:
+				for line in meta_in:
+					line = line.rstrip('\n')
+					if line.startswith('*******') or line.startswith('----'):
+						sections.append((line.strip('*- '), {}))
+					elif '=' in line and sections:
+						key, value = line.split('=', 1)
+						sections[-1][1].setdefault(key, value)
+		except IOError as e:
+			self.errors.append('Unable to read metadata file: {}'.format(e))
+			return None
+		if not sections or sections[0][0] != 'VM' or not sections[0][1].get('orig_uuid'):
+			self.errors.append('Metadata file has no VM section')
+			return None
+		for section, values in sections:
+			if section == 'CBT' and values.get('backup_file') not in [None, basename(file)]:
+				self.errors.append('Metadata file is for {}'.format(values['backup_file']))
+
+		parts = basename(file).split('_')
+		if self.backup['export_type'] != 'vdi' or len(parts) < 3:
+			return None
+		disk = None
+		for index, (section, values) in enumerate(sections):
+			if section == 'DISK' and values.get('device') == parts[1]:
+				disk = dict(values)
+				if index + 1 < len(sections) and sections[index + 1][0] == 'VDI':
+					disk.update(sections[index + 1][1])
+		if disk is None:
+			self.errors.append('Metadata file has no disk {}'.format(parts[1]))
+		elif file.endswith('.raw') and disk.get('virtual_size') and getsize(file) != int(disk['virtual_size']):
+			self.errors.append('Raw disk is {} bytes, metadata has {}'.format(getsize(file), disk['virtual_size']))
+		return disk
+
+	def _check_xva(self, reader, name, digest=False):
+		"""
+			Walk the tar members of an XVA checking ova.xml comes first, the
+			archive ends with its end marker, the chunks of each disk add up
+			to its size in ova.xml, and each chunk matches the .checksum
+			(SHA-1) or .xxhash member following it
+		"""
+		if name.endswith('.gz'):
+			reader = DecompressingReader(reader, 'gzip')
+		elif name.endswith('.zst'):
+			if zstandard is None:
+				self.warnings.append('Structure not checked, zstandard is not available')
+				return
+			reader = DecompressingReader(reader, 'zstd')
+		pool = ThreadPool(self._threads)
+		try:
+			self._walk_xva(reader, pool, digest)
+		finally:
+			pool.terminate()
+			pool.join()
+
+	def _read_ova_xml(self, data):
+		"""
+			Get the virtual size of each disk in ova.xml of an XVA
+
+			@return Dictionary of VDI ids (i.e. Ref:12) to sizes or None
+		"""
+		try:
+			return dict((value['id'], int(value['snapshot']['virtual_size'])) for value in XvaIndex.read_ova_xml(data)
+				if value['class'] == 'VDI')
+		except (ValueError, TypeError, KeyError) as e:
+			self.errors.append('XVA has an invalid ova.xml: {}'.format(e))
+		return None
+
+	def _walk_xva(self, reader, pool, digest):
+		members = 0
+		disks = {}
+		ends = {}
+		chunk = None
+		pending = deque()
+		failed = []
+		checked = 0
+		unchecked = set()
+		while True:
+			header = reader.read(tarfile.BLOCKSIZE)
+			if len(header) < tarfile.BLOCKSIZE:
+				self.errors.append('XVA is truncated after {} members'.format(members))
+				return
+			if header == tarfile.NUL * tarfile.BLOCKSIZE:
+				break
+			try:
+				member = tarfile.TarInfo.frombuf(header)
+			except tarfile.HeaderError as e:
+				self.errors.append('XVA member {} has an invalid header: {}'.format(members + 1, e))
+				return
+			if members == 0 and member.name != 'ova.xml':
+				self.errors.append('XVA does not start with ova.xml')
+				return
+			members += 1
+			padding = -member.size % tarfile.BLOCKSIZE
+			base, extension = splitext(member.name)
+			match = XvaIndex.chunk_name.match(member.name)
+			if member.name == 'ova.xml' or match or extension in _chunk_hashes:
+				data = reader.read(member.size)
+				if len(data) < member.size or reader.skip(padding) < padding:
+					self.errors.append('XVA is truncated in member {}'.format(member.name))
+					return
+			elif reader.skip(member.size + padding) < member.size + padding:
+				self.errors.append('XVA is truncated in member {}'.format(member.name))
+				return
+
+			if member.name == 'ova.xml':
+				disks = self._read_ova_xml(data)
+				if disks is None:
+					return
+			elif match:
+				vdi, index = match.group(1), int(match.group(2))
+				if vdi not in disks:
+					self.errors.append('XVA has chunks of disk {} not in ova.xml'.format(vdi))
+					return
+				if index * XvaIndex.chunk_size < ends.get(vdi, 0) or member.size > XvaIndex.chunk_size:
+					self.errors.append('XVA chunk {} is out of order'.format(member.name))
+					return
+				ends[vdi] = index * XvaIndex.chunk_size + member.size
+				chunk = (member.name, data)
+			elif extension in _chunk_hashes and chunk is not None and chunk[0] == base:
+				if _chunk_hashes[extension] is None:
+					unchecked.add(extension)
+					continue
+				pending.append((base, pool.apply_async(_chunk_hashes[extension], (chunk[1],)), data.strip()))
+				chunk = None
+				# Compare hashes of earlier chunks while later ones are read keeping
+				# a bounded number of chunks in memory
+				while len(pending) > self._threads * 2 or (pending and pending[0][1].ready()):
+					chunk_name, result, expected = pending.popleft()
+					checked += 1
+					if expected not in result.get():
+						failed.append(chunk_name)
+		for chunk_name, result, expected in pending:
+			checked += 1
+			if expected not in result.get():
+				failed.append(chunk_name)
+
+		if members == 0:
+			self.errors.append('XVA has no members')
+		for vdi, size in sorted(disks.items()):
+			if vdi in ends and ends[vdi] != size:
+				self.errors.append('Chunks of disk {} end at {} bytes, ova.xml has {}'.format(vdi, ends[vdi], size))
+		if failed:
+			self.errors.append('{} chunks do not match their checksum, first {}'.format(len(failed), failed[0]))
+		if unchecked:
+			self.warnings.append('Chunk {} members not checked, xxhash is not available'.format(', '.join(sorted(unchecked))))
+		if not checked and not digest:
+			self.warnings.append('No digest file or chunk checksums, contents not checked')
+
+class BackupVerifier(object):
+	"""
+		Verify backups on a pool of worker processes hashing many files at
+		once, while at most io_limit of them read from backup_dir at a time
+		so a share is not overloaded
+	"""
+
+	def __init__(self, chunk_dir, workers=4, io_limit=2, threads=2, read_size=8388608):
+		self._chunk_dir = chunk_dir
+		self._workers = workers
+		self._io_limit = io_limit
+		self._threads = threads
+		self._read_size = read_size
+
+	def verify(self, backups):
+		"""
+			Verify the given backups yielding the result of each in order as
+			they complete
+
+			@return Generator of dictionaries with file, errors, warnings,
+			bytes read, and seconds taken
+		"""
+		if not backups:
+			return
+		pool = Pool(min(self._workers, len(backups)), _init_worker, (Semaphore(self._io_limit),))
+		try:
+			for result in pool.imap(_verify_backup, [(backup, self._chunk_dir, self._threads, self._read_size)
+				for backup in backups]):
+				yield result
+		finally:
+			pool.terminate()
+			pool.join()
+
+class HashingReader(object):
+	"""
+		Reader of a file doing large sequential reads, each while holding
+		the given lock, which are hashed with the given BlockHasher and
+		served in reads of any size. The last bytes of the file read are
+		kept for checks of footers
+	"""
+
+	tail_size = 512
+
+	def __init__(self, file_in, hasher=None, read_size=8388608, io_lock=None):
+		self._in = file_in
+		self._hasher = hasher
+		self._read_size = read_size
+		self._io_lock = io_lock
+		self._buffer = ''
+		self._offset = 0
+		self.position = 0
+		self.tail = ''
+
+	def drain(self):
+		"""
+			Read and hash the rest of the file
+		"""
+		self._buffer = ''
+		self._offset = 0
+		while self._fill():
+			self._buffer = ''
+
+	def read(self, size):
+		while len(self._buffer) - self._offset < size and self._fill():
+			pass
+		data = self._buffer[self._offset:self._offset + size]
+		self._offset += len(data)
+		return data
+
+	def readline(self):
+		end = self._buffer.find('\n', self._offset)
+		while end < 0 and self._fill():
+			end = self._buffer.find('\n', self._offset)
+		return self.read(end - self._offset + 1 if end >= 0 else len(self._buffer) - self._offset)
+
+	def skip(self, size):
+		"""
+			Skip size bytes without copying them
+
+			@return Number of bytes skipped
+		"""
+		skipped = 0
+		while skipped < size:
+			if self._offset >= len(self._buffer) and not self._fill():
+				break
+			length = min(size - skipped, len(self._buffer) - self._offset)
+			self._offset += length
+			skipped += length
+		return skipped
+
+	# Private Functions
+
+	def _fill(self):
+		if self._io_lock is not None:
+			with self._io_lock:
+				data = self._in.read(self._read_size)
+		else:
+			data = self._in.read(self._read_size)
+		if not data:
+			return False
+		if self._hasher is not None:
+			self._hasher.update(self.position, data)
+		self.position += len(data)
+		self.tail = (self.tail + data[-self.tail_size:])[-self.tail_size:]
+		self._buffer = self._buffer[self._offset:] + data
+		self._offset = 0
+		return True
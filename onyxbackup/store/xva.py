@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+
+# part of OnyxBackupVM
+# Copyright (c) 2017-2020 OnyxFire, Inc.
+	
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import re
+import tarfile
+import xmlrpclib
+import zlib
+from bisect import bisect_right
+from collections import deque
+from logging import getLogger
+from os import remove, rename
+from os.path import exists
+from time import time
+from xml.parsers.expat import ExpatError
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+class DecompressingReader(object):
+	"""
+		Reader decompressing a gzip or zstd file made of any number of
+		members or frames, as written by ParallelCompressor. With a
+		restart_interval, (uncompressed, compressed) offsets of members at
+		least that many bytes apart are kept in restarts like
+		ParallelCompressor does
+	"""
+
+	# Most data produced by a single decompress call, so blocks of zeroes
+	# compressed a thousand times over are not expanded all at once
+	output_size = 1048576
+
+	def __init__(self, reader, compress_type='gzip', restart_interval=0):
+		self.restarts = []
+		self._reader = reader
+		self._compress_type = compress_type
+		self._restart_interval = restart_interval
+		self._decompressor = self._new_decompressor()
+		self._input = ''
+		self._full = False
+		self._chunks = deque()
+		self._offset = 0
+		self._buffered = 0
+		self._position = 0
+		self._compressed_position = 0
+
+	def read(self, size):
+		while self._buffered < size:
+			if not self._decompress():
+				break
+		output = []
+		remaining = size
+		while remaining and self._chunks:
+			chunk = self._chunks[0]
+			data = chunk[self._offset:self._offset + remaining]
+			output.append(data)
+			remaining -= len(data)
+			self._offset += len(data)
+			if self._offset == len(chunk):
+				self._chunks.popleft()
+				self._offset = 0
+		self._buffered -= size - remaining
+		return ''.join(output)
+
+	def skip(self, size):
+		skipped = 0
+		while skipped < size:
+			data = self.read(min(size - skipped, 1048576))
+			if not data:
+				break
+			skipped += len(data)
+		return skipped
+
+	# Private Functions
+
+	def _decompress(self):
+		"""
+			Decompress at most output_size bytes (or one zstd frame) of the
+			input read so far, reading more once it is used up and no output
+			is left over from the last call
+
+			@return False at the end of the file
+		"""
+		if not self._input and not self._full:
+			self._input = self._reader.read(1048576)
+			if not self._input:
+				return False
+			self._compressed_position += len(self._input)
+		if self._compress_type == 'zstd':
+			data = self._decompressor.decompress(self._input)
+			self._input = ''
+		else:
+			data = self._decompressor.decompress(self._input, self.output_size)
+			self._input = self._decompressor.unconsumed_tail
+			self._full = len(data) == self.output_size
+		if data:
+			self._chunks.append(data)
+			self._buffered += len(data)
+			self._position += len(data)
+		# Data past the end of a member or frame starts the next one
+		unused = getattr(self._decompressor, 'unused_data', '')
+		if unused:
+			self._input = unused
+			self._decompressor = self._new_decompressor()
+			last = self.restarts[-1][0] if self.restarts else 0
+			if self._restart_interval and self._position - last >= self._restart_interval:
+				self.restarts.append((self._position, self._compressed_position - len(unused)))
+		return True
+
+	def _new_decompressor(self):
+		if self._compress_type == 'zstd':
+			return zstandard.ZstdDecompressor().decompressobj()
+		return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+class XvaIndex(object):
+	"""
+		Index of an XVA mapping ova.xml and the chunks of each disk to their
+		offsets in the tar stream, kept in a .index file next to the
+		backup. Compressed XVAs also get restart points, offsets where
+		decompression can start, so single disks or blocks are read without
+		reading the archive from its start. The index is built from the tar
+		stream given to update(), as it is written or read from a file
+	"""
+
+	# Size of the disk chunks xapi writes to an XVA
+	chunk_size = 1048576
+
+	chunk_name = re.compile(r'^(Ref:[^/]+)/(\d{8})$')
+
+	restart_interval = 67108864
+
+	def __init__(self, compress_type=None):
+		self.logger = getLogger(__name__)
+		self.compress_type = compress_type
+		self.complete = False
+		self.disks = {}
+		self.members = {}
+		self.restarts = []
+		self.size = 0
+		self._header = ''
+		self._skip = 0
+		self._ova_xml = None
+		self._ova_xml_size = 0
+
+	@classmethod
+	def build(cls, file, read_size=8388608):
+		"""
+			Index an existing XVA reading it once
+
+			@return XvaIndex
+		"""
+		compress_type = 'gzip' if file.endswith('.gz') else 'zstd' if file.endswith('.zst') else None
+		index = cls(compress_type)
+		with open(file, 'rb') as file_in:
+			reader = file_in
+			if compress_type:
+				reader = DecompressingReader(file_in, compress_type, cls.restart_interval)
+			for data in iter(lambda: reader.read(read_size), ''):
+				index.update(data)
+		if compress_type:
+			index.restarts = list(reader.restarts)
+		return index
+
+	@classmethod
+	def load(cls, file):
+		"""
+			Load the index of the given XVA from its .index file
+
+			@return XvaIndex or None if missing or unreadable
+		"""
+		try:
+			with open('{}.index'.format(file)) as index_in:
+				values = json.load(index_in)
+			index = cls(values['compress_type'])
+			index.complete = values['complete']
+			index.disks = values['disks']
+			index.members = values['members']
+			index.restarts = [tuple(restart) for restart in values['restarts']]
+			index.size = values['size']
+		except (IOError, ValueError, KeyError):
+			return None
+		return index
+
+	@classmethod
+	def read_ova_xml(cls, data):
+		"""
+			Parse ova.xml of an XVA
+
+			@return List of dictionaries of the objects in ova.xml with
+			class, id, and snapshot (the record of the object)
+			@raise ValueError if ova.xml is invalid
+		"""
+		data = re.sub(r'^\s*<\?xml[^>]*\?>', '', data)
+		try:
+			values = xmlrpclib.loads('<methodResponse><params><param>{}</param></params></methodResponse>'.format(data))[0][0]
+			return [value for value in values['objects'] if 'class' in value and 'id' in value]
+		except (xmlrpclib.Error, ExpatError, TypeError, KeyError, IndexError) as e:
+			raise ValueError(e)
+
+	def find_disk(self, disk):
+		"""
+			Find a disk by its id in the XVA (i.e. Ref:12), device (xvda), or
+			userdevice (0)
+
+			@return Id of the disk or None
+		"""
+		if disk in self.disks:
+			return disk
+		for vdi, values in sorted(self.disks.items()):
+			if disk in [values.get('device'), values.get('userdevice')]:
+				return vdi
+		return None
+
+	def get_chunks(self, vdi):
+		"""
+			Get the chunks of a disk present in the XVA in order
+
+			@return Generator of (chunk number, offset of data) tuples
+		"""
+		for first, count, offset, stride in self.disks[vdi]['runs']:
+			for chunk in range(count):
+				yield (first + chunk, offset + chunk * stride)
+
+	def save(self, file):
+		"""
+			Write the index to the .index file of the given XVA through a
+			temporary file renamed over it
+
+			@return True if written
+		"""
+		index_file = '{}.index'.format(file)
+		tmp_file = '{}.tmp'.format(index_file)
+		values = {'compress_type': self.compress_type, 'complete': self.complete, 'created': time(),
+			'disks': self.disks, 'members': self.members, 'restarts': self.restarts, 'size': self.size}
+		try:
+			with open(tmp_file, 'w') as index_out:
+				json.dump(values, index_out, sort_keys=True)
+			rename(tmp_file, index_file)
+		except (IOError, OSError) as e:
+			self.logger.warning('(!) Unable to write index file {}: {}'.format(index_file, e))
+			if exists(tmp_file):
+				remove(tmp_file)
+			return False
+		return True
+
+	def update(self, data):
+		"""
+			Index the next data of the tar stream
+		"""
+		offset = 0
+		while offset < len(data):
+			if self.complete:
+				self.size += len(data) - offset
+				return
+			if self._skip:
+				length = min(self._skip, len(data) - offset)
+				if self._ova_xml is not None:
+					self._ova_xml.append(data[offset:offset + length])
+				self._skip -= length
+			else:
+				length = min(tarfile.BLOCKSIZE - len(self._header), len(data) - offset)
+				self._header += data[offset:offset + length]
+			offset += length
+			self.size += length
+			if len(self._header) == tarfile.BLOCKSIZE:
+				self._add_member(self._header)
+				self._header = ''
+			elif not self._skip and self._ova_xml is not None:
+				self._read_disks(''.join(self._ova_xml)[:self._ova_xml_size])
+				self._ova_xml = None
+
+	# Private Functions
+
+	def _add_chunk(self, vdi, chunk, offset, size):
+		"""
+			Add a chunk to the runs of chunks of its disk. Consecutive chunks
+			spaced evenly are kept as one run of (first chunk, number of
+			chunks, offset of first chunk, spacing)
+		"""
+		disk = self.disks.setdefault(vdi, {'runs': [], 'size': 0})
+		disk['size'] = chunk * self.chunk_size + size
+		if disk['runs']:
+			run = disk['runs'][-1]
+			if chunk == run[0] + run[1] and (run[1] == 1 or offset == run[2] + run[1] * run[3]):
+				if run[1] == 1:
+					run[3] = offset - run[2]
+				run[1] += 1
+				return
+		disk['runs'].append([chunk, 1, offset, 0])
+
+	def _add_member(self, header):
+		if header == tarfile.NUL * tarfile.BLOCKSIZE:
+			self.complete = True
+			return
+		try:
+			member = tarfile.TarInfo.frombuf(header)
+		except tarfile.HeaderError as e:
+			raise ValueError('Invalid tar header at {}: {}'.format(self.size - tarfile.BLOCKSIZE, e))
+		self._skip = (member.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+		match = self.chunk_name.match(member.name)
+		if match:
+			self._add_chunk(match.group(1), int(match.group(2)), self.size, member.size)
+		elif not member.name.endswith('.checksum') and not member.name.endswith('.xxhash'):
+			self.members[member.name] = [self.size, member.size]
+			if member.name == 'ova.xml':
+				self._ova_xml = []
+				self._ova_xml_size = member.size
+
+	def _read_disks(self, data):
+		"""
+			Add the device and name of each disk from ova.xml to the index
+		"""
+		try:
+			objects = self.read_ova_xml(data)
+		except ValueError as e:
+			self.logger.debug('(i) -> Unable to read ova.xml: {}'.format(e))
+			return
+		disks = {}
+		for value in objects:
+			if value['class'] == 'VDI':
+				disks.setdefault(value['id'], {})['name_label'] = value['snapshot'].get('name_label', '')
+				disks[value['id']]['virtual_size'] = int(value['snapshot'].get('virtual_size', 0))
+		for value in objects:
+			if value['class'] == 'VBD' and value['snapshot'].get('VDI') in disks:
+				disks[value['snapshot']['VDI']]['device'] = value['snapshot'].get('device', '')
+				disks[value['snapshot']['VDI']]['userdevice'] = value['snapshot'].get('userdevice', '')
+		for vdi, values in disks.items():
+			self.disks.setdefault(vdi, {'runs': [], 'size': 0}).update(values)
+
+class XvaIndexSink(object):
+	"""
+		Sink indexing an XVA while it is written to the wrapped sink (i.e.
+		FileSink or ParallelCompressor) and saving the index next to the
+		file when finished, with the restart points of the compressor. Data
+		which can not be indexed is still written without an index
+	"""
+
+	def __init__(self, out, file):
+		self.logger = getLogger(__name__)
+		self._out = out
+		self._file = file
+		self._index = XvaIndex(getattr(out, 'compress_type', None))
+
+	def abort(self):
+		self._out.abort()
+
+	def finish(self):
+		self._out.finish()
+		if self._index is not None:
+			self._index.restarts = list(getattr(self._out, 'restarts', []))
+			self._index.save(self._file)
+
+	def write(self, data):
+		if self._index is not None:
+			try:
+				self._index.update(data)
+			except ValueError as e:
+				self.logger.warning('(!) Unable to index {}: {}'.format(self._file, e))
+				self._index = None
+		self._out.write(data)
+
+class XvaReader(object):
+	"""
+		Random access reader of an XVA using its index. Reads of compressed
+		XVAs decompress from the closest restart point before them or
+		continue decompressing when reading forward
+	"""
+
+	def __init__(self, file, index, read_size=8388608):
+		self._index = index
+		self._read_size = read_size
+		self._in = open(file, 'rb')
+		self._reader = None
+		self._position = 0
+
+	def close(self):
+		self._in.close()
+
+	def read(self, offset, length):
+		"""
+			Read length bytes of the tar stream at offset
+		"""
+		self._seek(offset)
+		data = self._reader.read(length)
+		self._position += len(data)
+		return data
+
+	def read_disk(self, vdi, out, offset=0, length=None):
+		"""
+			Write length bytes of the image of a disk from offset to the
+			given SparseFileSink. Chunks not in the XVA are all zeroes
+		"""
+		size = self._index.disks[vdi].get('virtual_size') or self._index.disks[vdi]['size']
+		if length is None:
+			length = max(size - offset, 0)
+		end = offset + length
+		for chunk, data_offset in self._index.get_chunks(vdi):
+			start = chunk * XvaIndex.chunk_size
+			chunk_end = min(start + XvaIndex.chunk_size, size)
+			if chunk_end <= offset:
+				continue
+			if start >= end:
+				break
+			read_start = max(start, offset)
+			read_length = min(chunk_end, end) - read_start
+			data = self.read(data_offset + read_start - start, read_length)
+			if len(data) < read_length:
+				raise IOError('XVA is truncated in chunk {}/{:08d}'.format(vdi, chunk))
+			out.write_block(read_start - offset, data)
+		out.set_size(length)
+
+	def read_member(self, name):
+		"""
+			Read a member of the XVA other than disk chunks (i.e. ova.xml)
+		"""
+		offset, size = self._index.members[name]
+		data = self.read(offset, size)
+		if len(data) < size:
+			raise IOError('XVA is truncated in member {}'.format(name))
+		return data
+
+	# Private Functions
+
+	def _seek(self, offset):
+		if not self._index.compress_type:
+			self._in.seek(offset)
+			self._reader = self._in
+			self._position = offset
+			return
+		restarts = [(0, 0)] + self._index.restarts
+		restart = restarts[bisect_right(restarts, (offset, float('inf'))) - 1]
+		# Continue decompressing forward unless a restart point is closer
+		if self._reader is None or offset < self._position or restart[0] > self._position:
+			self._in.seek(restart[1])
+			self._reader = DecompressingReader(self._in, self._index.compress_type)
+			self._position = restart[0]
+		self._position += self._reader.skip(offset - self._position)
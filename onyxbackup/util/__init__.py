@@ -1,3 +1,13 @@
 #!/usr/bin/env python
 
+from checksum import *
+from compress import *
+from deleter import *
+from delta import *
+from journal import *
+from matcher import *
+from metrics import *
+from space import *
+from stream import *
+from teardown import *
 from util import *
\ No newline at end of file
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+# part of OnyxBackupVM
+# Copyright (c) 2017-2020 OnyxFire, Inc.
+	
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import threading
+from logging import getLogger
+from os import rename
+from Queue import Queue
+from time import time
+
+try:
+	import xxhash
+except ImportError:
+	xxhash = None
+
+try:
+	import blake3
+except ImportError:
+	blake3 = None
+
+class BlockHasher(object):
+	"""
+		Hash data of a file handed over in order of offset, keeping a digest
+		of each block of block_size bytes and a digest of the whole file
+		computed over the block digests (and optionally a SHA-256 of the
+		file contents). Gaps between data are hashed as the zeroes of sparse
+		holes using the digest of an all-zero block for whole blocks
+	"""
+
+	algorithms = ['xxh3', 'blake3', 'sha256']
+
+	def __init__(self, algorithm='xxh3', block_size=67108864, sha256=False):
+		self.algorithm = algorithm
+		self.block_size = block_size
+		self.position = 0
+		self._sha256 = hashlib.sha256() if sha256 else None
+		self._zero_buffer = '\0' * min(block_size, 1048576)
+		self._zero_digest = None
+		self._blocks = []
+		self._block = None
+
+	@classmethod
+	def get_default(cls):
+		"""
+			Get the fastest algorithm available on this system
+		"""
+		for algorithm in cls.algorithms:
+			if cls.is_available(algorithm):
+				return algorithm
+
+	@classmethod
+	def is_available(cls, algorithm):
+		"""
+			Check if given algorithm is supported on this system
+		"""
+		if algorithm == 'xxh3':
+			return xxhash is not None and hasattr(xxhash, 'xxh3_64')
+		if algorithm == 'blake3':
+			return blake3 is not None
+		return algorithm == 'sha256'
+
+	def finish(self, size=None):
+		"""
+			Hash the zeroes of any hole up to size and finish the last block
+
+			@return Dictionary with algorithm, block_size, size, digest,
+			blocks, and sha256 if computed
+		"""
+		if size is not None and size > self.position:
+			self._hash_zeroes(size - self.position)
+		if self._block is not None:
+			self._finish_block()
+		digest = self._new_hash()
+		for block_digest in self._blocks:
+			digest.update(block_digest)
+		values = {'algorithm': self.algorithm, 'block_size': self.block_size, 'size': self.position,
+			'digest': digest.hexdigest(), 'blocks': [block_digest.encode('hex') for block_digest in self._blocks]}
+		if self._sha256 is not None:
+			values['sha256'] = self._sha256.hexdigest()
+		return values
+
+	def update(self, offset, data):
+		"""
+			Hash data at the given offset splitting it at block boundaries
+		"""
+		if offset < self.position:
+			raise IOError('(!) Data to hash at {} is before {}'.format(offset, self.position))
+		if offset > self.position:
+			self._hash_zeroes(offset - self.position)
+		start = 0
+		while start < len(data):
+			length = min(len(data) - start, self.block_size - self.position % self.block_size)
+			chunk = data if length == len(data) else data[start:start + length]
+			if self._block is None:
+				self._block = self._new_hash()
+			self._block.update(chunk)
+			if self._sha256 is not None:
+				self._sha256.update(chunk)
+			start += length
+			self.position += length
+			if self.position % self.block_size == 0:
+				self._finish_block()
+
+	# Private Functions
+
+	def _finish_block(self):
+		self._blocks.append(self._block.digest())
+		self._block = None
+
+	def _hash_zero_block(self):
+		block = self._new_hash()
+		remaining = self.block_size
+		while remaining > 0:
+			chunk = self._zero_buffer[:remaining]
+			block.update(chunk)
+			remaining -= len(chunk)
+		return block.digest()
+
+	def _hash_zeroes(self, length):
+		while length > 0:
+			size = min(length, self.block_size - self.position % self.block_size)
+			whole_block = size == self.block_size
+			if whole_block and self._zero_digest is None:
+				self._zero_digest = self._hash_zero_block()
+			remaining = size
+			while remaining > 0 and (self._sha256 is not None or not whole_block):
+				chunk = self._zero_buffer[:remaining]
+				if not whole_block:
+					if self._block is None:
+						self._block = self._new_hash()
+					self._block.update(chunk)
+				if self._sha256 is not None:
+					self._sha256.update(chunk)
+				remaining -= len(chunk)
+			self.position += size
+			length -= size
+			if whole_block:
+				self._blocks.append(self._zero_digest)
+			elif self.position % self.block_size == 0:
+				self._finish_block()
+
+	def _new_hash(self):
+		if self.algorithm == 'xxh3':
+			return xxhash.xxh3_64()
+		if self.algorithm == 'blake3':
+			return blake3.blake3()
+		return hashlib.sha256()
+
+class ExportDigest(object):
+	"""
+		Hash a backup file with a BlockHasher on a separate thread as it is
+		written, so no second read of the file is needed, and write the
+		digests to <file>.digest when finished
+	"""
+
+	def __init__(self, file, algorithm='xxh3', block_size=67108864, sha256=False, buffers=16):
+		self.logger = getLogger(__name__)
+		self.file = file
+		self.digest_file = '{}.digest'.format(file)
+		self.algorithm = algorithm
+		self._hasher = BlockHasher(algorithm, block_size, sha256)
+		self._errors = []
+		self._queue = Queue(buffers)
+		self._thread = None
+
+	@classmethod
+	def load(cls, file):
+		"""
+			Load the digests written for the given backup file
+
+			@return Dictionary as returned by BlockHasher.finish() along
+			with created or None if there is no readable digest file
+		"""
+		try:
+			with open('{}.digest'.format(file)) as digest_in:
+				return json.load(digest_in)
+		except (IOError, ValueError) as e:
+			getLogger(__name__).debug('(i) -> Unable to read digest file: {}'.format(e))
+		return None
+
+	def abort(self):
+		if self._thread is not None and self._thread.is_alive():
+			self._queue.put(None)
+			self._thread.join()
+
+	def finish(self, size=None):
+		"""
+			Wait for data handed over to be hashed, hash the zeroes of any
+			hole up to size, and write the digest file
+
+			@return Whole file digest as <algorithm>:<hex digest> or None if
+			the file could not be hashed
+		"""
+		self._put((size, None))
+		self._queue.put(None)
+		self._thread.join()
+		if self._errors:
+			self.logger.warning('(!) Unable to hash {}: {}'.format(self.file, self._errors[0]))
+			return None
+		values = self._values
+		values['created'] = time()
+		tmp_file = '{}.tmp'.format(self.digest_file)
+		try:
+			with open(tmp_file, 'w') as digest_out:
+				json.dump(values, digest_out)
+			rename(tmp_file, self.digest_file)
+		except (IOError, OSError) as e:
+			self.logger.warning('(!) Unable to write digest file {}: {}'.format(self.digest_file, e))
+			return None
+		return '{}:{}'.format(self.algorithm, values['digest'])
+
+	def update(self, offset, data):
+		"""
+			Queue data written at the given offset of the file to be hashed.
+			Data must be handed over in order of offset
+		"""
+		self._put((offset, data))
+
+	def update_from_file(self, end):
+		"""
+			Queue the part of the file already written up to end to be hashed,
+			reading it back from the file
+		"""
+		self.logger.debug('(i) -> Reading back {} bytes of {} to hash'.format(end, self.file))
+		with open(self.file, 'rb') as file_in:
+			offset = 0
+			while offset < end:
+				data = file_in.read(min(4194304, end - offset))
+				if not data:
+					break
+				self.update(offset, data)
+				offset += len(data)
+
+	# Private Functions
+
+	def _put(self, item):
+		"""
+			Queue item for the hashing thread starting it on first use
+		"""
+		if self._thread is None:
+			self._thread = threading.Thread(target=self._run, name='export-digest')
+			self._thread.daemon = True
+			self._thread.start()
+		self._queue.put(item)
+
+	def _run(self):
+		"""
+			Hash data queued by update() until stopped, ignoring data queued
+			after an error so writers are never blocked
+		"""
+		while True:
+			item = self._queue.get()
+			if item is None:
+				return
+			if self._errors:
+				continue
+			offset, data = item
+			try:
+				if data is not None:
+					self._hasher.update(offset, data)
+				else:
+					self._values = self._hasher.finish(offset)
+			except Exception as e:
+				self.logger.debug('(i) ---> Hashing failed: {}'.format(e))
+				self._errors.append(e)
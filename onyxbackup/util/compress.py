@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+# part of OnyxBackupVM
+# Copyright (c) 2017-2020 OnyxFire, Inc.
+	
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import zlib
+from collections import deque
+from logging import getLogger
+from multiprocessing.pool import ThreadPool
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+class ParallelCompressor(object):
+	"""
+		Sink compressing data written to it in independent blocks on a pool
+		of worker threads and writing them in order to the wrapped sink
+		(i.e. FileSink). Each block is a complete gzip member or zstd frame, and since
+		both formats allow concatenation the output is a standard .gz/.zst
+		file readable with the usual tools. Since every block can be
+		decompressed on its own, (uncompressed, compressed) offsets of a
+		block at least restart_interval bytes apart are kept in restarts to
+		start decompressing from the middle of the file
+	"""
+
+	levels = {'gzip': (1, 9), 'zstd': (1, 22)}
+
+	def __init__(self, out, compress_type='gzip', level=6, workers=2, block_size=1048576, restart_interval=67108864):
+		self.logger = getLogger(__name__)
+		self.compress_type = compress_type
+		self.restarts = []
+		self._out = out
+		self._level = level
+		self._workers = workers
+		self._block_size = block_size
+		self._restart_interval = restart_interval
+		self._pending = deque()
+		self._chunks = []
+		self._buffered = 0
+		self._position = 0
+		self._compressed_position = 0
+		self._pool = ThreadPool(workers)
+
+	@classmethod
+	def is_available(cls, compress_type):
+		"""
+			Check if given compression type is supported on this system
+		"""
+		if compress_type == 'zstd':
+			return zstandard is not None
+		return compress_type == 'gzip'
+
+	def abort(self):
+		"""
+			Stop the worker pool and abort the wrapped sink
+		"""
+		self._pool.terminate()
+		self._pool.join()
+		self._out.abort()
+
+	def finish(self):
+		"""
+			Compress remaining data, write all outstanding blocks, stop the
+			worker pool, and finish the wrapped sink
+		"""
+		if self._buffered:
+			self._submit(''.join(self._chunks))
+		while self._pending:
+			self._write_block()
+		self._pool.close()
+		self._pool.join()
+		self._out.finish()
+
+	def write(self, data):
+		self._chunks.append(data)
+		self._buffered += len(data)
+		if self._buffered < self._block_size:
+			return
+		data = ''.join(self._chunks)
+		self._chunks = []
+		self._buffered = 0
+		for offset in range(0, len(data) - self._block_size + 1, self._block_size):
+			self._submit(data[offset:offset + self._block_size])
+		remainder = len(data) % self._block_size
+		if remainder:
+			self._chunks.append(data[-remainder:])
+			self._buffered = remainder
+
+	# Private Functions
+
+	def _compress(self, block):
+		if self.compress_type == 'zstd':
+			return zstandard.ZstdCompressor(level=self._level).compress(block)
+		compressor = zlib.compressobj(self._level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+		return compressor.compress(block) + compressor.flush()
+
+	def _submit(self, block):
+		"""
+			Queue block for compression writing finished blocks in order once
+			enough are in flight to keep every worker busy
+		"""
+		while len(self._pending) >= self._workers * 2:
+			self._write_block()
+		self._pending.append((len(block), self._pool.apply_async(self._compress, (block,))))
+
+	def _write_block(self):
+		size, result = self._pending.popleft()
+		data = result.get()
+		last = self.restarts[-1][0] if self.restarts else 0
+		if self._position - last >= self._restart_interval:
+			self.restarts.append((self._position, self._compressed_position))
+		self._out.write(data)
+		self._position += size
+		self._compressed_position += len(data)
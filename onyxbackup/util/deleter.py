@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+# part of OnyxBackupVM
+# Copyright (c) 2017-2020 OnyxFire, Inc.
+	
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from logging import getLogger
+from os import remove
+from os.path import exists, getsize
+from Queue import Queue
+from time import sleep
+
+class BackgroundDeleter(object):
+	"""
+		Delete files on a single background thread so slow unlinks (i.e. of
+		large exports on NFS) do not hold up the next export. Large files are
+		truncated in steps before being removed and the thread pauses between
+		steps so deletion never competes with exports for long. Queueing
+		blocks once queue_size files are waiting
+	"""
+
+	def __init__(self, interval=0.5, step_size=1073741824, queue_size=64):
+		self.logger = getLogger(__name__)
+		self._interval = interval
+		self._step_size = step_size
+		self._queue = Queue(queue_size)
+		self._thread = None
+		self._lock = threading.Lock()
+		self.deleted = 0
+		self.failed = []
+
+	def delete(self, file, remove_func=None):
+		"""
+			Queue file for deletion calling remove_func(file) in place of
+			deleting it directly if given
+		"""
+		with self._lock:
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._run, name='background-deleter')
+				self._thread.daemon = True
+				self._thread.start()
+		self._queue.put((file, remove_func))
+
+	def finish(self):
+		"""
+			Wait for all queued files to be deleted and stop the thread
+
+			@return Number of files deleted
+		"""
+		if self._thread is not None:
+			self._queue.put(None)
+			self._thread.join()
+			self._thread = None
+		return self.deleted
+
+	# Private Functions
+
+	def _delete(self, file):
+		if not exists(file):
+			self.logger.debug('(i) ---> File does not exist: {}'.format(file))
+			return
+		size = getsize(file)
+		if size > self._step_size:
+			with open(file, 'r+b') as f:
+				while size > self._step_size:
+					size -= self._step_size
+					f.truncate(size)
+					sleep(self._interval)
+		remove(file)
+
+	def _run(self):
+		while True:
+			item = self._queue.get()
+			if item is None:
+				break
+			file, remove_func = item
+			self.logger.debug('(i) ---> Deleting in background: {}'.format(file))
+			try:
+				if remove_func is not None:
+					remove_func(file)
+				else:
+					self._delete(file)
+				self.deleted += 1
+			except (IOError, OSError) as e:
+				self.logger.error('(!) Unable to delete file "{}": {}'.format(file, e))
+				self.failed.append(file)
+			sleep(self._interval)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+# part of OnyxBackupVM
+# Copyright (c) 2017-2020 OnyxFire, Inc.
+	
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import struct
+from os import remove, rename
+
+class ChangedBlockFilter(object):
+	"""
+		Sink passing only the given (offset, length) extents of a raw disk
+		image written to it in order on to a DeltaWriter
+	"""
+
+	def __init__(self, writer, extents):
+		self._writer = writer
+		self._extents = extents
+		self._index = 0
+		self._position = 0
+
+	def write(self, data):
+		start = self._position
+		end = start + len(data)
+		self._position = end
+		while self._index < len(self._extents):
+			offset, length = self._extents[self._index]
+			if offset >= end:
+				break
+			block_start = max(offset, start)
+			block_end = min(offset + length, end)
+			if block_end > block_start:
+				self._writer.write_block(block_start, data[block_start - start:block_end - start])
+			if offset + length > end:
+				break
+			self._index += 1
+
+class DeltaReader(object):
+	"""
+		Read the header of a delta file and apply its blocks over a copy of
+		the backup it is based on
+	"""
+
+	def __init__(self, file):
+		self.file = file
+		with open(file, 'rb') as delta_in:
+			self._read_header(delta_in)
+
+	def apply(self, out):
+		"""
+			Write the blocks of the delta over the disk image open in out
+
+			@return Number of bytes written
+		"""
+		written = 0
+		with open(self.file, 'rb') as delta_in:
+			self._read_header(delta_in)
+			while True:
+				record = delta_in.read(DeltaWriter.record.size)
+				if len(record) < DeltaWriter.record.size:
+					raise IOError('(!) Delta file is truncated: {}'.format(self.file))
+				offset, length = DeltaWriter.record.unpack(record)
+				if length == 0:
+					break
+				data = delta_in.read(length)
+				if len(data) < length:
+					raise IOError('(!) Delta file is truncated: {}'.format(self.file))
+				out.seek(offset)
+				out.write(data)
+				written += length
+		out.truncate(self.size)
+		return written
+
+	# Private Functions
+
+	def _read_header(self, delta_in):
+		if delta_in.readline() != DeltaWriter.header:
+			raise IOError('(!) Not an OnyxBackupVM delta file: {}'.format(self.file))
+		header = {}
+		for line in iter(delta_in.readline, '\n'):
+			if not line:
+				raise IOError('(!) Delta file is truncated: {}'.format(self.file))
+			key, value = line.rstrip('\n').split('=', 1)
+			header[key] = value
+		self.size = int(header['size'])
+		self.parent = header['parent']
+
+class DeltaWriter(object):
+	"""
+		Write changed blocks of a disk with their offsets to a delta file
+		which rebuilds the full raw image of the disk when applied over the
+		backup named as its parent. The file is only put in place once
+		finished. Data written is handed to the given ExportDigest to be
+		hashed
+	"""
+
+	header = '# OnyxBackupVM delta v1\n'
+	record = struct.Struct('>QI')
+
+	def __init__(self, file, size, parent, digest=None):
+		self._file = file
+		self._tmp_file = '{}.tmp'.format(file)
+		self._size = size
+		self._digest = digest
+		self._position = 0
+		self.written = 0
+		self._out = open(self._tmp_file, 'wb')
+		self._write(self.header)
+		self._write('size={}\nparent={}\n\n'.format(size, parent))
+
+	def abort(self):
+		self._out.close()
+		remove(self._tmp_file)
+		if self._digest is not None:
+			self._digest.abort()
+
+	def finish(self):
+		# Zero length record marks the end so truncated files are detected
+		self._write(self.record.pack(self._size, 0))
+		self._out.close()
+		rename(self._tmp_file, self._file)
+		if self._digest is not None:
+			self._digest.finish(self._position)
+
+	def write_block(self, offset, data):
+		self._write(self.record.pack(offset, len(data)))
+		self._write(data)
+		self.written += len(data)
+
+	# Private Functions
+
+	def _write(self, data):
+		self._out.write(data)
+		if self._digest is not None:
+			self._digest.update(self._position, data)
+		self._position += len(data)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+# part of OnyxBackupVM
+# Copyright (c) 2017-2020 OnyxFire, Inc.
+	
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+from logging import getLogger
+from os import fsync, remove, rename
+from os.path import exists
+from zlib import crc32
+from stream import SparseFileSink
+
+class ExportJournal(object):
+	"""
+		Sidecar journal (<image>.journal) of a raw disk image export naming
+		the snapshot exported and the offset up to which the image has been
+		written and flushed, so an interrupted export of the same snapshot
+		can continue from there. The checksum of the last block written
+		before the offset is kept to verify the image still holds it
+	"""
+
+	def __init__(self, image_file, snapshot='', size=0):
+		self.logger = getLogger(__name__)
+		self.image_file = image_file
+		self.file = '{}.journal'.format(image_file)
+		self.snapshot = snapshot
+		self.size = size
+		self.offset = 0
+		self.check = None
+
+	@classmethod
+	def load(cls, image_file):
+		"""
+			Load the journal of the given image file
+
+			@return ExportJournal or None if there is no readable journal
+		"""
+		journal = cls(image_file)
+		try:
+			with open(journal.file) as journal_in:
+				values = json.load(journal_in)
+			journal.snapshot = values['snapshot']
+			journal.size = values['size']
+			journal.offset = values['offset']
+			journal.check = values['check']
+		except (IOError, ValueError, KeyError) as e:
+			journal.logger.debug('(i) -> Unable to read export journal: {}'.format(e))
+			return None
+		return journal
+
+	def discard(self):
+		"""
+			Remove the image and journal of an export which will not be resumed
+		"""
+		for file in [self.image_file, self.file]:
+			if exists(file):
+				remove(file)
+
+	def remove(self):
+		if exists(self.file):
+			remove(self.file)
+
+	def save(self):
+		"""
+			Write the journal to a temporary file flushed to disk and renamed
+			over the journal so it is never left partially written
+		"""
+		tmp_file = '{}.tmp'.format(self.file)
+		with open(tmp_file, 'w') as journal_out:
+			json.dump({'snapshot': self.snapshot, 'size': self.size, 'offset': self.offset, 'check': self.check}, journal_out)
+			journal_out.flush()
+			fsync(journal_out.fileno())
+		rename(tmp_file, self.file)
+
+	def verify(self):
+		"""
+			Check the image still holds the block recorded at the last
+			checkpoint starting over from the beginning of the image if not
+
+			@return Offset to continue the export from
+		"""
+		if self.offset and self.check and exists(self.image_file):
+			offset, length, checksum = self.check
+			try:
+				with open(self.image_file, 'rb') as image_in:
+					image_in.seek(offset)
+					data = image_in.read(length)
+				# Holes at the end of a sparse image read as zeroes
+				data += '\0' * (length - len(data))
+				if crc32(data) & 0xffffffff == checksum:
+					return self.offset
+			except IOError as e:
+				self.logger.debug('(i) -> Unable to read image: {}'.format(e))
+			self.logger.debug('(i) -> Image does not match export journal, starting over')
+		self.offset = 0
+		self.check = None
+		return 0
+
+class ResumableFileSink(SparseFileSink):
+	"""
+		Sink writing a raw disk image from the offset of the given journal,
+		flushing the image and saving the journal whenever writing crosses a
+		segment boundary. All-zero blocks are left as holes when sparse. The
+		image is checkpointed as far as it was written and kept along with
+		the journal when aborted so the export can be resumed, and the
+		journal is removed once the image is finished. Data written is
+		handed to the given ExportDigest to be hashed
+	"""
+
+	check_size = 65536
+
+	def __init__(self, journal, segment_size=268435456, sparse=True, digest=None):
+		super(ResumableFileSink, self).__init__(journal.image_file, offset=journal.offset, digest=digest)
+		self.logger = getLogger(__name__)
+		self._journal = journal
+		self._segment_size = segment_size
+		self._sparse = sparse
+		self._next_checkpoint = (journal.offset // segment_size + 1) * segment_size
+		self._last_block = None
+
+	def abort(self):
+		try:
+			self.checkpoint()
+		except (IOError, OSError) as e:
+			self.logger.debug('(i) -> Unable to checkpoint image: {}'.format(e))
+		try:
+			self._out.close()
+		except (IOError, OSError) as e:
+			self.logger.debug('(i) -> Unable to close image: {}'.format(e))
+		if self._digest is not None:
+			self._digest.abort()
+
+	def checkpoint(self):
+		"""
+			Flush the image to disk and record the offset written up to
+		"""
+		if self._last_block is None:
+			return
+		self._out.flush()
+		fsync(self._out.fileno())
+		offset, data = self._last_block
+		self._journal.offset = self._position
+		self._journal.check = [offset, len(data), crc32(data) & 0xffffffff]
+		self._journal.save()
+		self._next_checkpoint = (self._position // self._segment_size + 1) * self._segment_size
+
+	def finish(self):
+		super(ResumableFileSink, self).finish()
+		self._journal.remove()
+
+	def write_block(self, offset, data):
+		if self._sparse:
+			super(ResumableFileSink, self).write_block(offset, data)
+		else:
+			if self._digest is not None:
+				self._digest.update(offset, data)
+			self._write_run(offset, data)
+			self._position = offset + len(data)
+			self._size = max(self._size, self._position)
+		if data:
+			self._last_block = (self._position - min(len(data), self.check_size), data[-self.check_size:])
+		if self._position >= self._next_checkpoint:
+			self.checkpoint()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+# part of OnyxBackupVM
+# Copyright (c) 2017-2020 OnyxFire, Inc.
+	
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+
+class NameMatcher(object):
+	"""
+		Match names against a list of patterns finding the first pattern
+		matching each name. Simple names are looked up in a dict and regexes
+		(matched from the start of the name like re.match) are compiled into
+		as few alternations with one named group per pattern as possible, so
+		matching a name does not loop over the patterns
+	"""
+
+	literal = re.compile(r'^[\w\s]+$')
+	unsafe = re.compile(r'\\[1-9]|\(\?P[<=]|\(\?[iLmsux]')
+	group_limit = 99
+
+	def __init__(self, patterns):
+		self._patterns = list(patterns)
+		self._literals = {}
+		self._regexes = {}
+		self._combined = []
+		combinable = []
+		for index, pattern in enumerate(self._patterns):
+			if self.is_literal(pattern):
+				self._literals.setdefault(pattern, index)
+				continue
+			regex = re.compile(pattern)
+			self._regexes[index] = regex
+			if self.unsafe.search(pattern) or regex.groups + 1 > self.group_limit:
+				self._combined.append((regex, None, index))
+			else:
+				combinable.append(index)
+		self._combine(combinable)
+
+	@classmethod
+	def is_literal(cls, pattern):
+		"""
+			Check if pattern is a simple name containing only letters,
+			numbers, spaces, and underscores
+		"""
+		return cls.literal.match(pattern) is not None
+
+	def match(self, name):
+		"""
+			Get index of the first pattern matching name
+
+			@return Index or None if no pattern matches
+		"""
+		first = self._literals.get(name)
+		for regex, groups, index in self._combined:
+			if first is not None and index > first:
+				break
+			m = regex.match(name)
+			if m is None:
+				continue
+			if groups is not None:
+				index = groups[m.lastgroup]
+			if first is None or index < first:
+				first = index
+		return first
+
+	def matches_any(self, index, names):
+		"""
+			Check if the pattern at index matches any of the given names
+		"""
+		pattern = self._patterns[index]
+		if index not in self._regexes:
+			return pattern in names
+		regex = self._regexes[index]
+		for name in names:
+			if regex.match(name):
+				return True
+		return False
+
+	# Private Functions
+
+	def _combine(self, indexes):
+		"""
+			Compile regexes at the given indexes into alternations keeping
+			each under the group limit, falling back to single regexes if an
+			alternation does not compile
+		"""
+		chunk = []
+		groups = 0
+		for index in indexes + [None]:
+			size = self._regexes[index].groups + 1 if index is not None else 0
+			if chunk and (index is None or groups + size > self.group_limit):
+				alternation = '|'.join('(?P<p{}>{})'.format(i, self._patterns[i]) for i in chunk)
+				try:
+					regex = re.compile('(?:{})'.format(alternation))
+					self._combined.append((regex, dict(('p{}'.format(i), i) for i in chunk), chunk[0]))
+				except (re.error, AssertionError, OverflowError):
+					self._combined += [(self._regexes[i], None, i) for i in chunk]
+				chunk = []
+				groups = 0
+			if index is not None:
+				chunk.append(index)
+				groups += size
+		self._combined.sort(key=lambda combined: combined[2])
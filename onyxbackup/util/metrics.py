@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+# part of OnyxBackupVM
+# Copyright (c) 2017-2020 OnyxFire, Inc.
+	
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import threading
+from collections import OrderedDict
+from os import rename
+from time import time
+
+class RunMetrics(object):
+	"""
+		Time and bytes written for each phase (i.e. snapshot, export) of
+		every backup job in a run, written as a Prometheus node-exporter
+		textfile and a JSON run summary. A phase run more than once for the
+		same job and target adds to the same record
+	"""
+
+	prefix = 'onyxbackup'
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._start = time()
+		self._phases = OrderedDict()
+		self._jobs = OrderedDict()
+
+	def add_job(self, job_type, job, seconds, success=True):
+		"""
+			Record total time and result of a job
+		"""
+		with self._lock:
+			self._jobs[(job_type, job)] = {'seconds': seconds, 'success': success}
+
+	def add_phase(self, job_type, job, target, phase, seconds, bytes=0, success=True):
+		"""
+			Record time and bytes written of a phase of a job where target
+			is the disk for vdi-exports or empty
+		"""
+		with self._lock:
+			record = self._phases.setdefault((job_type, job, target, phase), {'seconds': 0.0, 'bytes': 0, 'success': True})
+			record['seconds'] += seconds
+			record['bytes'] += bytes
+			record['success'] = record['success'] and success
+
+	def get_summary(self):
+		"""
+			Get run summary with jobs and their phases
+
+			@return Dict of run start, end, duration, and list of jobs
+		"""
+		end = time()
+		jobs = OrderedDict()
+		with self._lock:
+			for (job_type, job), record in self._jobs.items():
+				jobs[(job_type, job)] = {'type': job_type, 'job': job, 'seconds': round(record['seconds'], 3),
+					'success': record['success'], 'phases': []}
+			for (job_type, job, target, phase), record in self._phases.items():
+				summary = jobs.setdefault((job_type, job), {'type': job_type, 'job': job, 'seconds': None,
+					'success': None, 'phases': []})
+				summary['phases'].append({'phase': phase, 'target': target, 'seconds': round(record['seconds'], 3),
+					'bytes': record['bytes'], 'bytes_per_second': int(self._get_rate(record)),
+					'mb_per_second': round(self._get_rate(record) / 1048576, 2),
+					'success': record['success']})
+		return {'start': self._start, 'end': end, 'seconds': round(end - self._start, 3), 'jobs': jobs.values()}
+
+	def has_records(self):
+		with self._lock:
+			return bool(self._phases or self._jobs)
+
+	def write_json(self, file):
+		"""
+			Write run summary to file as JSON
+		"""
+		self._write(file, json.dumps(self.get_summary(), indent=2) + '\n')
+
+	def write_prometheus(self, file):
+		"""
+			Write gauges for the run, jobs, and phases to file in the Prometheus
+			text format read by the node-exporter textfile collector
+		"""
+		summary = self.get_summary()
+		lines = []
+		self._add_metric(lines, 'last_run_timestamp_seconds', 'Time the last run finished', [({}, summary['end'])])
+		self._add_metric(lines, 'run_duration_seconds', 'Duration of the last run', [({}, summary['seconds'])])
+		jobs = [job for job in summary['jobs'] if job['seconds'] is not None]
+		self._add_metric(lines, 'job_duration_seconds', 'Duration of each backup job',
+			[({'type': job['type'], 'job': job['job']}, job['seconds']) for job in jobs])
+		self._add_metric(lines, 'job_success', 'Whether each backup job completed without errors',
+			[({'type': job['type'], 'job': job['job']}, int(job['success'])) for job in jobs])
+		phases = [(dict(type=job['type'], job=job['job'], target=phase['target'], phase=phase['phase']), phase)
+			for job in summary['jobs'] for phase in job['phases']]
+		self._add_metric(lines, 'phase_duration_seconds', 'Time spent in each phase of a backup job',
+			[(labels, phase['seconds']) for labels, phase in phases])
+		self._add_metric(lines, 'phase_bytes', 'Bytes written by each phase of a backup job',
+			[(labels, phase['bytes']) for labels, phase in phases if phase['bytes']])
+		self._add_metric(lines, 'phase_throughput_bytes_per_second', 'Rate each phase of a backup job wrote data at',
+			[(labels, phase['bytes_per_second']) for labels, phase in phases if phase['bytes']])
+		self._add_metric(lines, 'phase_success', 'Whether each phase of a backup job succeeded',
+			[(labels, int(phase['success'])) for labels, phase in phases])
+		self._write(file, '\n'.join(lines) + '\n')
+
+	# Private Functions
+
+	def _add_metric(self, lines, name, help, samples):
+		name = '{}_{}'.format(self.prefix, name)
+		lines.append('# HELP {} {}'.format(name, help))
+		lines.append('# TYPE {} gauge'.format(name))
+		for labels, value in samples:
+			label_text = ','.join('{}="{}"'.format(key, self._escape(labels[key])) for key in sorted(labels))
+			lines.append('{}{} {}'.format(name, '{' + label_text + '}' if label_text else '',
+				repr(value) if isinstance(value, float) else value))
+
+	def _escape(self, value):
+		if isinstance(value, unicode):
+			value = value.encode('utf8')
+		return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+	def _get_rate(self, record):
+		return record['bytes'] / record['seconds'] if record['seconds'] else 0.0
+
+	def _write(self, file, text):
+		"""
+			Write text to a temporary file renamed over file so readers
+			never see a partial file
+		"""
+		tmp_file = '{}.tmp'.format(file)
+		with open(tmp_file, 'w') as f:
+			f.write(text)
+		rename(tmp_file, file)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+# part of OnyxBackupVM
+# Copyright (c) 2017-2020 OnyxFire, Inc.
+	
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from logging import getLogger
+from os import stat, statvfs
+
+class SpaceReservation(object):
+	"""
+		Space reserved for a backup job along with the files it writes so
+		the space they already take is not counted twice
+	"""
+
+	def __init__(self, size, name=''):
+		self.size = size
+		self.name = name
+		self.files = []
+
+	def add_file(self, file):
+		self.files.append(file)
+
+	def get_outstanding(self):
+		"""
+			Get reserved bytes not yet written to the files of the reservation
+		"""
+		written = 0
+		for file in self.files:
+			try:
+				written += stat(file).st_blocks * 512
+			except OSError:
+				continue
+		return max(0, self.size - written)
+
+class SpaceAdmission(object):
+	"""
+		Admit backup jobs only when the estimated size of their output fits
+		in the free space of the backup directory filesystem while leaving
+		threshold percent free, counting space reserved by jobs still
+		running. Jobs which only fit once running jobs finish wait for them
+	"""
+
+	def __init__(self, path, threshold=0, poll=5):
+		self.logger = getLogger(__name__)
+		self._path = path
+		self._threshold = threshold
+		self._poll = poll
+		self._reservations = []
+		self._condition = threading.Condition()
+
+	def get_usage(self):
+		"""
+			Get free and total bytes of the backup directory filesystem
+
+			@return Tuple of free and total bytes
+		"""
+		fs = statvfs(self._path)
+		return (fs.f_bavail * fs.f_frsize, fs.f_blocks * fs.f_frsize)
+
+	def get_reserved(self):
+		"""
+			Get bytes reserved by running jobs and not yet written
+		"""
+		with self._condition:
+			return sum(reservation.get_outstanding() for reservation in self._reservations)
+
+	def release(self, reservation):
+		with self._condition:
+			if reservation in self._reservations:
+				self._reservations.remove(reservation)
+			self._condition.notify_all()
+
+	def reserve(self, size, name=''):
+		"""
+			Reserve size bytes waiting for running jobs to finish while the
+			reservation only fits without theirs
+
+			@return SpaceReservation or None if size does not fit
+		"""
+		waiting = False
+		with self._condition:
+			while True:
+				free, total = self.get_usage()
+				reserved = sum(reservation.get_outstanding() for reservation in self._reservations)
+				minimum = total * self._threshold / 100
+				self.logger.debug('(i) -> Space free: {} reserved: {} requested: {} minimum: {}'.format(free, reserved, size, minimum))
+				if free - reserved - size >= minimum:
+					reservation = SpaceReservation(size, name)
+					self._reservations.append(reservation)
+					return reservation
+				if not self._reservations or free - size < minimum:
+					return None
+				if not waiting:
+					self.logger.info('-> Waiting for {} running exports to free reserved space'.format(len(self._reservations)))
+					waiting = True
+				self._condition.wait(self._poll)
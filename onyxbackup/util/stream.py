@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+# part of OnyxBackupVM
+# Copyright (c) 2017-2020 OnyxFire, Inc.
+	
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from logging import getLogger
+from os import remove
+from Queue import Empty, Full, Queue
+from time import time
+
+class FileSink(object):
+	"""
+		Sink writing a stream to a file which is removed if the stream is
+		aborted. Data written is handed to the given ExportDigest to be
+		hashed
+	"""
+
+	def __init__(self, file, digest=None):
+		self._file = file
+		self._digest = digest
+		self._position = 0
+		self._out = open(file, 'wb')
+
+	def abort(self):
+		self._out.close()
+		remove(self._file)
+		if self._digest is not None:
+			self._digest.abort()
+
+	def finish(self):
+		self._out.close()
+		if self._digest is not None:
+			self._digest.finish(self._position)
+
+	def write(self, data):
+		self._out.write(data)
+		if self._digest is not None:
+			self._digest.update(self._position, data)
+		self._position += len(data)
+
+class SparseFileSink(object):
+	"""
+		Sink writing a raw disk image to a file leaving holes in place of
+		all-zero blocks, either as data is written in order or at the offsets
+		of allocated extents given to write_block(). The file keeps the full
+		size of the image and is removed if the stream is aborted. Writing
+		continues an existing file from the given offset. Data written is
+		handed to the given ExportDigest to be hashed
+	"""
+
+	def __init__(self, file, block_size=65536, offset=0, digest=None):
+		self._file = file
+		self._digest = digest
+		self._block_size = block_size
+		self._zero_block = '\0' * block_size
+		self._position = offset
+		self._size = offset
+		self.data_bytes = 0
+		self._out = open(file, 'r+b' if offset else 'wb')
+
+	@property
+	def hole_bytes(self):
+		return self._size - self.data_bytes
+
+	def abort(self):
+		self._out.close()
+		remove(self._file)
+		if self._digest is not None:
+			self._digest.abort()
+
+	def finish(self):
+		"""
+			Set the file to its full size so trailing holes are kept
+		"""
+		self._out.truncate(self._size)
+		self._out.close()
+		if self._digest is not None:
+			self._digest.finish(self._size)
+
+	def set_size(self, size):
+		"""
+			Set the size of the image for data ending before its end
+		"""
+		self._size = max(self._size, size)
+
+	def write(self, data):
+		self.write_block(self._position, data)
+
+	def write_block(self, offset, data):
+		"""
+			Write data at the given offset seeking past all-zero blocks
+		"""
+		if self._digest is not None:
+			self._digest.update(offset, data)
+		start = 0
+		run_start = None
+		while start < len(data):
+			end = min(start + self._block_size, len(data))
+			if data[start:end] == self._zero_block[:end - start]:
+				if run_start is not None:
+					self._write_run(offset + run_start, data[run_start:start])
+					run_start = None
+			elif run_start is None:
+				run_start = start
+			start = end
+		if run_start is not None:
+			self._write_run(offset + run_start, data[run_start:])
+		self._position = offset + len(data)
+		self._size = max(self._size, self._position)
+
+	# Private Functions
+
+	def _write_run(self, offset, data):
+		if self._out.tell() != offset:
+			self._out.seek(offset)
+		self._out.write(data)
+		self.data_bytes += len(data)
+
+class StreamCopier(object):
+	"""
+		Copy a readable stream to a writable one using a reader thread and a
+		writer thread passing fixed-size buffers through a bounded queue, so
+		memory use stays at (buffers + 2) * buffer_size whatever the size of
+		the stream. The calling thread reports progress while they run
+	"""
+
+	def __init__(self, buffer_size=4194304, buffers=2, interval=60):
+		self.logger = getLogger(__name__)
+		self._buffer_size = buffer_size
+		self._buffers = buffers
+		self._interval = interval
+		self._poll = 1
+
+	def copy(self, source, sink, progress=None):
+		"""
+			Copy all data from source to sink calling progress(bytes, seconds)
+			every interval and once more when finished
+
+			@return Number of bytes copied
+		"""
+		self._queue = Queue(self._buffers)
+		self._stop = threading.Event()
+		self._errors = []
+		self._written = 0
+
+		start = time()
+		reader = threading.Thread(target=self._read, args=(source,), name='stream-reader')
+		writer = threading.Thread(target=self._write, args=(sink,), name='stream-writer')
+		reader.daemon = True
+		writer.daemon = True
+		reader.start()
+		writer.start()
+
+		last_report = start
+		while writer.is_alive():
+			writer.join(self._poll)
+			if progress and writer.is_alive() and time() - last_report >= self._interval:
+				last_report = time()
+				progress(self._written, last_report - start)
+		self._stop.set()
+		reader.join()
+
+		if self._errors:
+			raise self._errors[0]
+		if progress:
+			progress(self._written, time() - start)
+		return self._written
+
+	# Private Functions
+
+	def _put(self, item):
+		"""
+			Queue item for the writer unless the copy has been stopped
+		"""
+		while not self._stop.is_set():
+			try:
+				self._queue.put(item, True, self._poll)
+				return True
+			except Full:
+				continue
+		return False
+
+	def _read(self, source):
+		try:
+			while not self._stop.is_set():
+				data = self._read_buffer(source)
+				if not data:
+					break
+				if not self._put(data):
+					return
+		except Exception as e:
+			self.logger.debug('(i) ---> Stream read failed: {}'.format(e))
+			self._errors.append(e)
+		self._put(None)
+
+	def _read_buffer(self, source):
+		"""
+			Read a full buffer from source unless the stream ends first
+		"""
+		chunks = []
+		remaining = self._buffer_size
+		while remaining > 0:
+			chunk = source.read(remaining)
+			if not chunk:
+				break
+			chunks.append(chunk)
+			remaining -= len(chunk)
+		if len(chunks) == 1:
+			return chunks[0]
+		return ''.join(chunks)
+
+	def _write(self, sink):
+		try:
+			while True:
+				try:
+					data = self._queue.get(True, self._poll)
+				except Empty:
+					if self._stop.is_set():
+						return
+					continue
+				if data is None:
+					return
+				sink.write(data)
+				self._written += len(data)
+		except Exception as e:
+			self.logger.debug('(i) ---> Stream write failed: {}'.format(e))
+			self._errors.append(e)
+			self._stop.set()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+# part of OnyxBackupVM
+# Copyright (c) 2017-2020 OnyxFire, Inc.
+	
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from logging import getLogger
+from Queue import Queue
+from time import sleep, time
+
+class SnapshotTeardown(object):
+	"""
+		Remove snapshots on a few background threads once their exports
+		complete so slow removals (i.e. vm-uninstall of a snapshot on a thick
+		provisioned SR) do not hold up the next export. Failed removals are
+		retried with a growing pause in between. Queueing blocks once
+		queue_size snapshots are waiting, bounding how many snapshots are
+		left around at a time
+	"""
+
+	def __init__(self, workers=2, retries=2, retry_interval=10, queue_size=16):
+		self.logger = getLogger(__name__)
+		self._workers = workers
+		self._retries = retries
+		self._retry_interval = retry_interval
+		self._queue = Queue(queue_size)
+		self._threads = []
+		self._lock = threading.Lock()
+		self.removed = 0
+		self.failed = []
+
+	def finish(self):
+		"""
+			Wait for all queued snapshots to be removed and stop the threads
+
+			@return Number of snapshots removed
+		"""
+		for thread in self._threads:
+			self._queue.put(None)
+		for thread in self._threads:
+			thread.join()
+		self._threads = []
+		return self.removed
+
+	def remove(self, uuid, remove_func, label=None, callback=None):
+		"""
+			Queue the snapshot with the given uuid to be removed by calling
+			remove_func(uuid), returning True if successful, and then
+			callback(label, seconds, removed) if given. Snapshots which could
+			not be removed are added to failed along with their label
+		"""
+		with self._lock:
+			if not self._threads:
+				for i in range(self._workers):
+					thread = threading.Thread(target=self._run, name='snapshot-teardown-{}'.format(i))
+					thread.daemon = True
+					thread.start()
+					self._threads.append(thread)
+		self._queue.put((uuid, remove_func, label, callback))
+
+	# Private Functions
+
+	def _remove(self, uuid, remove_func):
+		for attempt in range(self._retries + 1):
+			if attempt:
+				sleep(self._retry_interval * attempt)
+				self.logger.debug('(i) ---> Retrying removal of snapshot: {}'.format(uuid))
+			try:
+				if remove_func(uuid):
+					return True
+			except Exception as e:
+				self.logger.debug('(i) ---> Removal of snapshot failed: {}'.format(e))
+		return False
+
+	def _run(self):
+		while True:
+			item = self._queue.get()
+			if item is None:
+				break
+			uuid, remove_func, label, callback = item
+			self.logger.debug('(i) ---> Removing snapshot in background: {}'.format(uuid))
+			start = time()
+			removed = self._remove(uuid, remove_func)
+			with self._lock:
+				if removed:
+					self.removed += 1
+				else:
+					self.failed.append((uuid, label))
+			if callback is not None:
+				callback(label, time() - start, removed)
@@ -20,13 +20,73 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import subprocess
+import sys
+import threading
 from datetime import datetime
 from logging import getLogger
-from os import devnull, mkdir, remove
+from os import devnull, mkdir, remove, stat
 from os.path import exists, getsize, join
 from shlex import split
 from decimal import Decimal
 
+class BufferedLogger(object):
+	"""
+		Logger stand-in that holds messages for a single job and writes them
+		to the wrapped logger as one uninterrupted block when flushed so
+		output of concurrent jobs does not interleave in the report. Loggers
+		may be nested, flushing into the buffer of the outer one
+	"""
+
+	_flush_lock = threading.Lock()
+
+	def __init__(self, logger):
+		self._logger = logger
+		self._records = []
+
+	@property
+	def unbuffered(self):
+		"""
+			Innermost wrapped logger which writes messages as they are logged
+		"""
+		logger = self._logger
+		while isinstance(logger, BufferedLogger):
+			logger = logger._logger
+		return logger
+
+	def critical(self, msg, *args, **kwargs):
+		self._records.append(('critical', msg, args, kwargs))
+
+	def debug(self, msg, *args, **kwargs):
+		self._records.append(('debug', msg, args, kwargs))
+
+	def error(self, msg, *args, **kwargs):
+		self._records.append(('error', msg, args, kwargs))
+
+	def exception(self, msg, *args, **kwargs):
+		kwargs['exc_info'] = sys.exc_info()
+		self._records.append(('error', msg, args, kwargs))
+
+	def info(self, msg, *args, **kwargs):
+		self._records.append(('info', msg, args, kwargs))
+
+	def warning(self, msg, *args, **kwargs):
+		self._records.append(('warning', msg, args, kwargs))
+
+	def flush(self):
+		with self._flush_lock:
+			if not isinstance(self._logger, BufferedLogger):
+				print('')
+			self.replay(self._logger)
+
+	def replay(self, logger):
+		"""
+			Write held messages to the given logger without the separating
+			blank line of flush()
+		"""
+		for level, msg, args, kwargs in self._records:
+			getattr(logger, level)(msg, *args, **kwargs)
+		self._records = []
+
 class Helper():
 
 	def __init__(self):
@@ -45,9 +105,20 @@ class Helper():
 			return True
 		return False
 
-	def get_cmd_result(self, cmd_line, strip_newline=True):
+	def get_allocated_size(self, file):
+		"""
+			Get bytes allocated on disk for file which is less than its size
+			for sparse files
+		"""
+		try:
+			return stat(file).st_blocks * 512
+		except (OSError, AttributeError) as e:
+			self.logger.debug('(i) --> Unable to get allocated size: {}'.format(e))
+		return 0
+
+	def get_cmd_result(self, cmd_line, strip_newline=True, default=''):
 		self.logger.debug('(i) ---> Running command: {}'.format(cmd_line))
-		result = ''
+		result = default
 		cmd = split(cmd_line)
 		try:
 			result = subprocess.check_output(cmd)
@@ -98,42 +169,32 @@ class Helper():
 
 	def get_file_size(self, file):
 		size = 0
-		symbol = 'B'
 		if exists(file):
 			try:
-				size = Decimal(float(getsize(file)))
-				if size < 1024:
-					symbol = 'B'
-				elif (size / 1024) < 1024:
-					size = size / 1024
-					symbol = 'KB'
-				elif (size / (1024 * 1024)) < 1024:
-					size = size / (1024 * 1024)
-					symbol = 'MB'
-				else:
-					size = size / (1024 * 1024 * 1024)
-					symbol = 'GB'
+				size = getsize(file)
 			except OSError as e:
 				self.logger.error('(!) Unable to get file size: {}'.format(e))
 		else:
 			self.logger.debug('(i) --> File does not exist: {}'.format(file))
+		return self.get_size_string(size)
+
+	def get_size_string(self, size):
+		size = Decimal(float(size))
+		if size < 1024:
+			symbol = 'B'
+		elif (size / 1024) < 1024:
+			size = size / 1024
+			symbol = 'KB'
+		elif (size / (1024 * 1024)) < 1024:
+			size = size / (1024 * 1024)
+			symbol = 'MB'
+		else:
+			size = size / (1024 * 1024 * 1024)
+			symbol = 'GB'
 
 		sizeString = '{}{}'.format(str(size.quantize(Decimal('0.00'))), symbol)
 		return sizeString
 
-	def get_remaining_space(self, filesystem):
-		cmd = '/bin/df --output=pcent {}'.format(filesystem)
-		fs_info = self.get_cmd_result(cmd)
-		try:
-			output = fs_info.split('\n')[1].lstrip()[:-1]
-			self.logger.debug('(i) ---> Used space: {}%'.format(output))
-			percent_used = int(output)
-		except ValueError as e:
-			self.logger.debug('(i) ---> Unexpectedly returned non-integer; defaulting to 100%')
-			percent_used = int(100)
-		percent_remaining = 100 - percent_used
-		return percent_remaining
-
 	def get_time_string(self, date=''):
 		if not date:
 			now = datetime.now()